@@ -7,26 +7,106 @@ Created on Jan 13, 2014
 @author: diegob
 '''
 import argparse
+from cStringIO import StringIO
 import json
+import mimetypes
+from multiprocessing.pool import ThreadPool
+import os.path
 import sys
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    from PIL import Image
+except ImportError:
+    # Images are uploaded without downscaling
+    Image = None
 
 
-def create_waypoint(name, latitude, longitude, image_path, base_host):
-    # Make sure that the file exist before doing anything
-    files = {'image': open(image_path, 'rb')}
+# Longest edge in pixels of the uploaded images, larger ones are downscaled.
+MAX_IMAGE_EDGE = 1600
+# Attempts to send a chunk of an image before giving up on the upload.
+_CHUNK_ATTEMPTS = 5
 
-    # Get the URL for uploading the image
-    url_server = '%s/upload' % base_host
-    response_1 = requests.get(url_server)
-    response_1.raise_for_status()
-    data = response_1.json()
 
-    # Upload the image to the given url and retrieve the key
-    response_2 = requests.post(data['upload_url'], files=files)
-    response_2.raise_for_status()
-    image_data = response_2.json()
+def prepare_image(image_path, max_edge=MAX_IMAGE_EDGE):
+    '''
+    Read an image for uploading, it is downscaled and re-encoded as JPEG if
+    its longest edge exceeds max_edge. Images are read as they are if
+    max_edge is 0 or PIL is not installed.
+
+    Returns:
+        A (data, content_type) pair.
+    '''
+    with open(image_path, 'rb') as image_file:
+        data = image_file.read()
+    content_type = mimetypes.guess_type(image_path)[0] or 'image/jpeg'
+    if Image is None or not max_edge:
+        return data, content_type
+    image = Image.open(StringIO(data))
+    if max(image.size) <= max_edge:
+        return data, content_type
+    image.thumbnail((max_edge, max_edge), Image.ANTIALIAS)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output = StringIO()
+    image.save(output, 'JPEG', quality=85, optimize=True)
+    return output.getvalue(), 'image/jpeg'
+
+def upload_image(image_path, base_host, max_edge=MAX_IMAGE_EDGE,
+                 session=requests):
+    '''
+    Upload an image in resumable chunks, failed chunks are retried from the
+    offset the server received.
+
+    Returns:
+        Dictionary with the image_key and image_url of the uploaded image.
+    '''
+    data, content_type = prepare_image(image_path, max_edge)
+    headers = {'content-type': 'application/json'}
+    response = session.post('%s/uploads' % base_host,
+                            data=json.dumps({'size': len(data),
+                                             'content_type': content_type}),
+                            headers=headers)
+    response.raise_for_status()
+    upload = response.json()
+    upload_url = upload['content_url']
+    chunk_size = upload['chunk_size']
+
+    offset = 0
+    failures = 0
+    while offset < len(data):
+        try:
+            response = session.put(
+                upload_url, params={'offset': offset},
+                data=data[offset:offset + chunk_size],
+                headers={'content-type': 'application/octet-stream'})
+            response.raise_for_status()
+        except requests.RequestException:
+            failures += 1
+            if failures >= _CHUNK_ATTEMPTS:
+                raise
+            time.sleep(2 ** failures)
+            # Continue from what the server actually received
+            try:
+                response = session.get(upload_url)
+                response.raise_for_status()
+            except requests.RequestException:
+                continue
+        else:
+            # Attempts are counted per chunk
+            failures = 0
+        offset = response.json()['received']
+
+    response = session.post('%s/finish' % upload_url)
+    response.raise_for_status()
+    return response.json()
+
+def create_waypoint(name, latitude, longitude, image_path, base_host,
+                    max_edge=MAX_IMAGE_EDGE, session=requests):
+    image_data = upload_image(image_path, base_host, max_edge, session)
 
     # Upload the metadata with the image key
     headers = {'content-type': 'application/json'}
@@ -35,24 +115,26 @@ def create_waypoint(name, latitude, longitude, image_path, base_host):
                    'name': name,
                    'image_key': image_data['image_key']}
     url_waypoint = '%s/waypoints' % base_host
-    response_3 = requests.post(url_waypoint, data=json.dumps(data_object),
-                               headers=headers)
+    response_3 = session.post(url_waypoint, data=json.dumps(data_object),
+                              headers=headers)
     response_3.raise_for_status()
 
 
-def create_waypoint_with_url(name, latitude, longitude, image_url, base_host):
+def create_waypoint_with_url(name, latitude, longitude, image_url, base_host,
+                             session=requests):
     headers = {'content-type': 'application/json'}
     data_object = {'latitude': latitude,
                    'longitude': longitude,
                    'name': name,
                    'image_url': image_url}
     url_waypoint = '%s/waypoints' % base_host
-    response = requests.post(url_waypoint, data=json.dumps(data_object),
-                             headers=headers)
+    response = session.post(url_waypoint, data=json.dumps(data_object),
+                            headers=headers)
     response.raise_for_status()
 
 
-def update_waypoint(name, latitude, longitude, image_path, base_host):
+def update_waypoint(name, latitude, longitude, image_path, base_host,
+                    max_edge=MAX_IMAGE_EDGE):
     # PUT the data that is not None
     url_waypoint = '%s/waypoints/%s' % (base_host, name)
     headers = {'content-type' : 'application/json'}
@@ -62,17 +144,7 @@ def update_waypoint(name, latitude, longitude, image_path, base_host):
     if longitude is not None:
         data_object['longitude'] = longitude
     if image_path is not None:
-        # Get the URL for uploading the image
-        url_server = '%s/upload' % base_host
-        response_1 = requests.get(url_server)
-        response_1.raise_for_status()
-        data = response_1.json()
-
-        # Upload the image to the given url and retrieve the key
-        files = {'image' : open(image_path, 'rb')}
-        response_2 = requests.post(data['upload_url'], files = files)
-        response_2.raise_for_status()
-        image_data = response_2.json()
+        image_data = upload_image(image_path, base_host, max_edge)
         data_object['image_key'] = image_data['image_key']
 
     response = requests.put(url_waypoint, data = json.dumps(data_object), headers = headers)
@@ -88,13 +160,13 @@ def delete_waypoint(name, base_host):
     response.raise_for_status()
     return
 
-def create_mission(name, waypoint_names, base_host):
+def create_mission(name, waypoint_names, base_host, session=requests):
     # POST the required data, nothing fancy
     url_mission = '%s/missions' % base_host
     headers = {'content-type' : 'application/json'}
     data_object = {'name' : name,
                   'waypoints' : waypoint_names}
-    response = requests.post(url_mission, data = json.dumps(data_object), headers = headers)
+    response = session.post(url_mission, data = json.dumps(data_object), headers = headers)
     response.raise_for_status()
     return
 
@@ -116,6 +188,85 @@ def delete_mission(name, base_host):
     response.raise_for_status()
     return
 
+def start_migration(name, base_host):
+    # POST to the migration to start it in the server
+    url_migration = '%s/migrations/%s' % (base_host, name)
+    response = requests.post(url_migration)
+    response.raise_for_status()
+    return
+
+def create_session(workers):
+    '''
+    Create a session to share between the given number of workers, its
+    connection pool keeps a connection alive for each of them.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def read_checkpoint(checkpoint_path):
+    # Names of the items completed by previous runs, one per line
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, 'r') as checkpoint:
+        return set(line.strip() for line in checkpoint if line.strip())
+
+def bulk_import(items, upload, workers=8, checkpoint_path=None):
+    '''
+    Upload items concurrently with a pool of workers that share a session.
+
+    Args:
+        items: Iterable of (name, args) pairs, each item is uploaded by
+            calling upload(*args, session=session).
+        upload: Upload function, e.g. create_waypoint.
+        workers: Maximum number of concurrent uploads.
+        checkpoint_path: Optional file where the names of the uploaded items
+            are appended, items already listed there are skipped so an
+            interrupted import resumes where it stopped.
+
+    Returns:
+        The list of (name, error) pairs of the failed uploads, they are not
+        checkpointed so running the import again retries them.
+    '''
+    done = read_checkpoint(checkpoint_path)
+    pending = [item for item in items if item[0] not in done]
+    session = create_session(workers)
+    checkpoint = open(checkpoint_path, 'a') if checkpoint_path else None
+    checkpoint_lock = threading.Lock()
+
+    def run(item):
+        name, args = item
+        try:
+            upload(*args, session=session)
+        except (requests.RequestException, IOError) as ex:
+            return name, ex
+        if checkpoint is not None:
+            with checkpoint_lock:
+                checkpoint.write(name + '\n')
+                checkpoint.flush()
+        return name, None
+
+    failures = []
+    pool = ThreadPool(workers)
+    try:
+        for count, (name, error) in enumerate(pool.imap_unordered(run,
+                                                                  pending),
+                                              1):
+            if error is not None:
+                failures.append((name, error))
+                print >> sys.stderr, 'Failed to upload %s: %s' % (name, error)
+            if count % 100 == 0 or count == len(pending):
+                print >> sys.stderr, 'Uploaded %d/%d (%d skipped)' % \
+                    (count - len(failures), len(pending), len(done))
+    finally:
+        pool.close()
+        pool.join()
+        if checkpoint is not None:
+            checkpoint.close()
+    return failures
+
 def check_location_tuple(arg):
     value = tuple(float(x) for x in arg.split(','))
     return value
@@ -127,16 +278,29 @@ def build_options():
     option_parser.add_argument('--url', default = 'http://dev.street-view-density.appspot.com/api')
 
     # Add the options to create, delete, update
-    option_parser.add_argument('action', choices = ['create', 'delete', 'update'])
-    # Add the options to either act on missions or waypoints
-    option_parser.add_argument('target', choices = ['mission', 'waypoint'])
+    option_parser.add_argument('action', choices = ['create', 'delete', 'update', 'migrate'])
+    # Add the options to either act on missions or waypoints, or the
+    # migration to start
+    option_parser.add_argument('target', choices = ['mission', 'waypoint', 'name-keys',
+                                                   'mission-routes', 'progress-events',
+                                                   'image-hashes', 'image-variants'])
 
     # Add the options for waypoints
     option_parser.add_argument('--location', type = check_location_tuple, nargs = '+', metavar = 'LAT,LON')
     option_parser.add_argument('--image-path', nargs = '+')
+    option_parser.add_argument('--max-edge', type = int, default = MAX_IMAGE_EDGE,
+                               help = 'Longest edge in pixels of the uploaded '
+                                      'images, 0 to upload them unchanged.')
 
     # Add the name option
     option_parser.add_argument('--name', nargs = '+')
+
+    # Add the options for bulk imports
+    option_parser.add_argument('--workers', type = int, default = 8,
+                               help = 'Maximum number of concurrent uploads.')
+    option_parser.add_argument('--checkpoint',
+                               help = 'File to record uploaded waypoints in, '
+                                      'a restarted import skips them.')
     return option_parser
 
 def main():
@@ -149,8 +313,14 @@ def main():
             raise Exception("Number of locations and images doesn't match")
         if len(options.location) != len(options.name):
             raise Exception("Number of locations and names doesn't match")
-        for location, path, name in zip(options.location, options.image_path, options.name):
-            create_waypoint(name, location[0], location[1], path, options.url)
+        items = [(name, (name, location[0], location[1], path, options.url,
+                         options.max_edge))
+                 for location, path, name in zip(options.location,
+                                                 options.image_path,
+                                                 options.name)]
+        if bulk_import(items, create_waypoint, options.workers,
+                       options.checkpoint):
+            return 1
     elif options.action == 'create' and options.target == 'mission':
         if len(options.name) <= 1:
             raise Exception("At least a valid waypoint name must be specified.")
@@ -161,7 +331,8 @@ def main():
                 if len(options.location) != len(options.name) - 1:
                     raise Exception("Number of locations and names doesn't match")
                 for location, path, name in zip(options.location, options.image_path, options.name[1:]):
-                    create_waypoint(name, location[0], location[1], path, options.url)
+                    create_waypoint(name, location[0], location[1], path, options.url,
+                                    options.max_edge)
             create_mission(options.name[0], options.name[1:], options.url)
     elif options.action == 'delete':
         for name in options.name:
@@ -169,6 +340,8 @@ def main():
                 delete_mission(name, options.url)
             elif options.target == 'waypoint':
                 delete_waypoint(name, options.url)
+    elif options.action == 'migrate':
+        start_migration(options.target, options.url)
     elif options.action == 'update':
         if options.target == 'waypoint':
             if len(options.name) != 1:
@@ -176,10 +349,11 @@ def main():
             if options.location and options.image_path:
                 update_waypoint(options.name[0], options.location[0][0],
                                 options.location[0][1], options.image_path[0],
-                                options.url)
+                                options.url, options.max_edge)
             elif options.image_path:
                 update_waypoint(options.name[0], None, None,
-                                options.image_path[0], options.url)
+                                options.image_path[0], options.url,
+                                options.max_edge)
             elif options.location:
                 update_waypoint(options.name[0], options.location[0][0],
                                 options.location[0][1], None, options.url)
@@ -1,52 +1,184 @@
 '''
-Utility script to dump all missions and waypoints from the datastore into a
-json file with a reasonably stable format for resubmission to other instance
-of the server.
+Utility script to dump all missions and waypoints from the datastore into
+NDJSON manifests with a reasonably stable format for resubmission to other
+instance of the server.
+
+The collections are paged through the API and every manifest line is written
+as soon as its item is complete. Waypoint images are downloaded concurrently
+and stored by the SHA-1 of their content, images listed by the previous dump
+whose file is still present are not downloaded again, so re-dumps only fetch
+new images. The entries written by interrupted dumps are kept in a partial
+manifest until a dump completes, so their images are not downloaded again
+either.
 Created on Feb 5, 2014
 
 @author: diegob
 '''
-
+import argparse
+import hashlib
 import json
+from multiprocessing.pool import ThreadPool
+import os
 import os.path
-import requests
 import sys
+import tempfile
+
+from admin_utils import create_session
+
+
+WAYPOINT_MANIFEST = 'waypoints.ndjson'
+MISSION_MANIFEST = 'missions.ndjson'
+IMAGE_DIR = 'images'
+# Maximum page size accepted by the API
+_PAGE_SIZE = 500
+_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_collection(session, url, name, params=None):
+    '''
+    Yield the items of a collection of the API, following the next_cursor
+    of each page.
+    '''
+    params = dict(params or {}, max_results=_PAGE_SIZE)
+    while True:
+        response = session.get(url, params=params)
+        response.raise_for_status()
+        data = response.json()
+        for item in data[name]:
+            yield item
+        if not data.get('next_cursor'):
+            return
+        params['cursor'] = data['next_cursor']
+
+def read_manifest(manifest_path):
+    # Items of a previous dump, keyed by name. The last line of a partial
+    # manifest may be truncated, lines that can not be parsed are skipped
+    items = {}
+    if not os.path.exists(manifest_path):
+        return items
+    with open(manifest_path, 'r') as manifest:
+        for line in manifest:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            items[item['name']] = item
+    return items
+
+def download_image(session, image_url, data_dir):
+    '''
+    Download an image in large chunks and store it under the SHA-1 of its
+    content, relative to data_dir.
+
+    Returns:
+        A (image_path, sha1) pair.
+    '''
+    image_dir = os.path.join(data_dir, IMAGE_DIR)
+    response = session.get(image_url, stream=True)
+    response.raise_for_status()
+    sha1 = hashlib.sha1()
+    descriptor, temp_path = tempfile.mkstemp(dir=image_dir)
+    try:
+        with os.fdopen(descriptor, 'wb') as image:
+            for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                sha1.update(chunk)
+                image.write(chunk)
+        image_path = os.path.join(IMAGE_DIR, sha1.hexdigest() + '.jpeg')
+        if os.path.exists(os.path.join(data_dir, image_path)):
+            os.remove(temp_path)
+        else:
+            os.rename(temp_path, os.path.join(data_dir, image_path))
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return image_path, sha1.hexdigest()
+
+def dump_waypoints(session, base_host, data_dir, workers):
+    manifest_path = os.path.join(data_dir, WAYPOINT_MANIFEST)
+    # The manifest is replaced once complete, an interrupted dump leaves the
+    # previous one in place. The entries it wrote are appended to the partial
+    # manifest, whose entries are newer than those of the previous one
+    temp_path = manifest_path + '.tmp'
+    partial_path = manifest_path + '.partial'
+    if os.path.exists(temp_path):
+        with open(temp_path, 'r') as interrupted, \
+                open(partial_path, 'a') as partial:
+            for line in interrupted:
+                # Complete the truncated last line, it is skipped when read
+                partial.write(line if line.endswith('\n') else line + '\n')
+        os.remove(temp_path)
+    previous = read_manifest(manifest_path)
+    previous.update(read_manifest(partial_path))
+    if not os.path.isdir(os.path.join(data_dir, IMAGE_DIR)):
+        os.makedirs(os.path.join(data_dir, IMAGE_DIR))
+
+    def save(waypoint):
+        entry = {'name': waypoint['name'],
+                 'latitude': waypoint['latitude'],
+                 'longitude': waypoint['longitude'],
+                 'image_url': waypoint.get('image_url')}
+        old_entry = previous.get(waypoint['name'], {})
+        if entry['image_url'] is None:
+            pass
+        elif old_entry.get('image_url') == entry['image_url'] and \
+            old_entry.get('image_path') and \
+            os.path.exists(os.path.join(data_dir, old_entry['image_path'])):
+            entry['image_path'] = old_entry['image_path']
+            entry['sha1'] = old_entry['sha1']
+        else:
+            entry['image_path'], entry['sha1'] = download_image(
+                session, entry['image_url'], data_dir)
+        return entry
 
+    pool = ThreadPool(workers)
+    try:
+        with open(temp_path, 'w') as manifest:
+            waypoints = iter_collection(session, '%s/waypoints' % base_host,
+                                        'waypoints')
+            for count, entry in enumerate(pool.imap_unordered(save,
+                                                              waypoints),
+                                          1):
+                manifest.write(json.dumps(entry) + '\n')
+                # Written entries survive even if the dump is killed
+                manifest.flush()
+                if count % 500 == 0:
+                    print >> sys.stderr, 'Dumped %d waypoints' % count
+    finally:
+        pool.close()
+        pool.join()
+    os.rename(temp_path, manifest_path)
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
 
-def save_images(waypoints, image_dir):
-    for waypoint in waypoints['waypoints']:
-        image = waypoint['image_url']
-        response_1 = requests.get(image, stream = True)
-        response_1.raise_for_status()
-        file_path = os.path.join(image_dir, image.split('/')[-1] + '.jpeg')
-        with open(file_path, 'wb') as f:
-            for chunk in response_1.iter_content():
-                f.write(chunk)
-        waypoint['image_url'] = file_path
-
-def get_waypoints(base_host, output_file, image_dir):
-    url_server = '%s/waypoints' % base_host
-    response_1 = requests.get(url_server)
-    response_1.raise_for_status()
-    data = response_1.json()
-    save_images(data, image_dir)
-    json.dump(data, output_file)
-
-def get_missions(base_host, output_file):
-    url_server = '%s/missions' % base_host
-    response_1 = requests.get(url_server)
-    response_1.raise_for_status()
-    data = response_1.json()
-    json.dump(data, output_file)
+def dump_missions(session, base_host, data_dir):
+    manifest_path = os.path.join(data_dir, MISSION_MANIFEST)
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as manifest:
+        for mission in iter_collection(session, '%s/missions' % base_host,
+                                       'missions', {'detailed': 'true'}):
+            entry = {'name': mission['name'],
+                     'waypoints': [waypoint['name']
+                                   for waypoint in mission['waypoints']]}
+            manifest.write(json.dumps(entry) + '\n')
+    os.rename(temp_path, manifest_path)
 
 def main():
-    data_dir = os.path.join(os.path.dirname(__file__), '../data/dev')
-    waypoint_file = open(os.path.join(data_dir, 'waypoints.json'), 'w')
-    mission_file = open(os.path.join(data_dir, 'missions.json'), 'w')
-    get_waypoints('https://dev-dot-street-view-density.appspot.com/api', waypoint_file, data_dir)
-    get_missions('https://dev-dot-street-view-density.appspot.com/api', mission_file)
-    waypoint_file.close()
-    mission_file.close()
+    option_parser = argparse.ArgumentParser(
+        description='Dump the missions and waypoints of a server.')
+    option_parser.add_argument(
+        '--url', default='https://dev-dot-street-view-density.appspot.com/api')
+    option_parser.add_argument(
+        '--data-dir',
+        default=os.path.join(os.path.dirname(__file__), '../data/dev'))
+    option_parser.add_argument('--workers', type=int, default=16,
+                               help='Maximum number of concurrent downloads.')
+    options = option_parser.parse_args()
+    if not os.path.isdir(options.data_dir):
+        os.makedirs(options.data_dir)
+    session = create_session(options.workers)
+    dump_waypoints(session, options.url, options.data_dir, options.workers)
+    dump_missions(session, options.url, options.data_dir)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -1,35 +1,68 @@
 '''
-Utility script to restore a datastore instance from json files and images
-created from the dump_datastore script.
+Utility script to restore a datastore instance from the manifests and images
+created by the dump_datastore script. Uploads run concurrently and are
+recorded in checkpoint files next to the manifests, so an interrupted restore
+resumes where it stopped when run again.
 Created on Feb 6, 2014
 
 @author: diegob
 '''
+import argparse
 import json
 import os.path
 import sys
 
-from admin_utils import create_waypoint, create_mission
+from admin_utils import bulk_import, create_mission, create_waypoint, \
+    create_waypoint_with_url
+from dump_datastore import MISSION_MANIFEST, WAYPOINT_MANIFEST
 
 
-def upload_waypoints(waypoint_json, base_host):
-    waypoints = json.load(waypoint_json)
-    for waypoint in waypoints['waypoints']:
-        create_waypoint(waypoint['name'], waypoint['latitude'], waypoint['longitude'], waypoint['image_url'], base_host)
+def read_entries(manifest_path):
+    with open(manifest_path, 'r') as manifest:
+        return [json.loads(line) for line in manifest if line.strip()]
 
-def upload_missions(mission_json, base_host):
-    missions = json.load(mission_json)
-    for mission in missions['missions']:
-        create_mission(mission['name'], [x['name'] for x in mission['waypoints']], base_host)
+def upload_waypoint(waypoint, data_dir, base_host, session):
+    if waypoint.get('image_path'):
+        create_waypoint(waypoint['name'], waypoint['latitude'],
+                        waypoint['longitude'],
+                        os.path.join(data_dir, waypoint['image_path']),
+                        base_host, session=session)
+    else:
+        create_waypoint_with_url(waypoint['name'], waypoint['latitude'],
+                                 waypoint['longitude'], waypoint['image_url'],
+                                 base_host, session=session)
+
+def upload_waypoints(data_dir, base_host, workers):
+    items = [(waypoint['name'], (waypoint, data_dir, base_host))
+             for waypoint in read_entries(os.path.join(data_dir,
+                                                       WAYPOINT_MANIFEST))]
+    return bulk_import(items, upload_waypoint, workers,
+                       os.path.join(data_dir, 'waypoints.checkpoint'))
+
+def upload_missions(data_dir, base_host, workers):
+    items = [(mission['name'],
+              (mission['name'], mission['waypoints'], base_host))
+             for mission in read_entries(os.path.join(data_dir,
+                                                      MISSION_MANIFEST))]
+    return bulk_import(items, create_mission, workers,
+                       os.path.join(data_dir, 'missions.checkpoint'))
 
 def main():
-    data_dir = os.path.join(os.path.dirname(__file__), '../data/dev')
-    waypoint_json_f = open(os.path.join(data_dir, 'waypoints.json'))
-    upload_waypoints(waypoint_json_f, 'https://dev-dot-street-view-density.appspot.com/api')
-    waypoint_json_f.close()
-    mission_json_f = open(os.path.join(data_dir, 'missions.json'))
-    upload_missions(mission_json_f, 'https://dev-dot-street-view-density.appspot.com/api')
-    mission_json_f.close()
+    option_parser = argparse.ArgumentParser(
+        description='Restore the missions and waypoints of a dump.')
+    option_parser.add_argument(
+        '--url', default='https://dev-dot-street-view-density.appspot.com/api')
+    option_parser.add_argument(
+        '--data-dir',
+        default=os.path.join(os.path.dirname(__file__), '../data/dev'))
+    option_parser.add_argument('--workers', type=int, default=8,
+                               help='Maximum number of concurrent uploads.')
+    options = option_parser.parse_args()
+    # Missions reference the waypoints, they must all exist first
+    if upload_waypoints(options.data_dir, options.url, options.workers):
+        return 1
+    if upload_missions(options.data_dir, options.url, options.workers):
+        return 1
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -1,18 +1,17 @@
+import argparse
 import os.path
 import sys
 
-from admin_utils import create_waypoint_with_url
+from admin_utils import bulk_import, create_waypoint_with_url
 
 
 BASE_HOST = 'http://localhost:8080/api'
+DATA_FILE = os.path.join(os.path.dirname(__file__), '../data/valid_images.csv')
 
 
-def main():
-
-    with open(
-        os.path.join(
-            os.path.dirname(__file__), '../data/valid_images.csv'),
-            'r') as waypoints_file:
+def read_waypoints(base_host):
+    items = []
+    with open(DATA_FILE, 'r') as waypoints_file:
         for line in waypoints_file:
             tokens = line.strip().split(',')
             system_id = tokens[0]
@@ -21,9 +20,25 @@ def main():
             longitude = float(tokens[3])
             image_url = tokens[4]
 
-            create_waypoint_with_url(
-                'Waypoint %s' % (system_id),
-                latitude, longitude, image_url, BASE_HOST)
+            name = 'Waypoint %s' % (system_id)
+            items.append((name, (name, latitude, longitude, image_url,
+                                 base_host)))
+    return items
+
+def main():
+    option_parser = argparse.ArgumentParser(
+        description='Store the waypoints known to the tour generator.')
+    option_parser.add_argument('--url', default=BASE_HOST)
+    option_parser.add_argument('--workers', type=int, default=8,
+                               help='Maximum number of concurrent uploads.')
+    option_parser.add_argument('--checkpoint',
+                               default=DATA_FILE + '.checkpoint',
+                               help='File to record uploaded waypoints in, '
+                                    'a restarted import skips them.')
+    options = option_parser.parse_args()
+    if bulk_import(read_waypoints(options.url), create_waypoint_with_url,
+                   options.workers, options.checkpoint):
+        return 1
 
 if __name__ == '__main__':
     sys.exit(main())
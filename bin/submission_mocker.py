@@ -11,21 +11,13 @@ import sys
 
 import requests
 
+from admin_utils import MAX_IMAGE_EDGE, upload_image
 
-def post_submission(mission, waypoint, image_path, base_host):
-    # Make sure that the file exist before doing anything
-    files = {'image' : open(image_path, 'rb')}
 
-    # Get the URL for uploading the image
-    url_server = '%s/upload' % base_host
-    response_1 = requests.get(url_server)
-    response_1.raise_for_status()
-    data = response_1.json()
-
-    # Upload the image to the given url and retrieve the key
-    response_2 = requests.post(data['upload_url'], files = files)
-    response_2.raise_for_status()
-    image_data = response_2.json()
+def post_submission(mission, waypoint, image_path, base_host,
+                    max_edge = MAX_IMAGE_EDGE):
+    # Downscale the image and upload it in chunks
+    image_data = upload_image(image_path, base_host, max_edge)
 
     # Upload the metadata with the image key
     headers = {'content-type' : 'application/json'}
@@ -42,6 +34,9 @@ def build_options():
 
     # Add the option for the base URL
     option_parser.add_argument('--url', default = 'http://dev.street-view-density.appspot.com/api')
+    option_parser.add_argument('--max-edge', type = int, default = MAX_IMAGE_EDGE,
+                               help = 'Longest edge in pixels of the uploaded '
+                                      'image, 0 to upload it unchanged.')
 
     # Add the argument for image data
     option_parser.add_argument('image')
@@ -56,7 +51,7 @@ def main():
     option_parser = build_options()
     options = option_parser.parse_args()
     post_submission(options.mission, options.waypoint,
-                    options.image, options.url)
+                    options.image, options.url, options.max_edge)
 
 if __name__ == '__main__':
     sys.exit(main())
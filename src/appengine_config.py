@@ -9,6 +9,17 @@ Created on Jan 12, 2014
 import os
 
 
+# Store missions and waypoints keyed by their name, so that lookups by name
+# are key gets. Existing entities are rewritten by the name-keys migration,
+# started with: admin_utils.py migrate name-keys
+xplore_NAME_KEYED_ENTITIES = False
+
+# Base URLs of the tour generator backends, slow calls are hedged with the
+# next backend in the list. See xplore.webutils.tourclient for the retry and
+# circuit breaker settings.
+xplore_TOUR_GENERATOR_URLS = ['http://bandit06.ethz.ch:8082/']
+
+
 def namespace_manager_default_namespace_for_request():
     '''
     Set the namespace according to the current version answering the request.
@@ -2,6 +2,7 @@ import os.path
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), 'python/'))
 sys.path.append(os.path.join(os.path.dirname(__file__), 'lib/geomodel/'))
+sys.path.append(os.path.join(os.path.dirname(__file__), 'lib/cloudstorage/'))
 
 from webapp2 import RedirectHandler
 import webapp2
@@ -9,12 +10,22 @@ from webapp2_extras.routes import RedirectRoute
 
 from xplore import secrets
 from xplore.handler.api.auth import TokenResource
-from xplore.handler.api.imageservice import ImageUploadHandler, ImageUploadUrlProvider
+from xplore.handler.api.imageservice import ImageUploadHandler, ImageUploadUrlProvider, \
+    ResumableUploadResource
+from xplore.handler.api.migrations import MigrationResource
 from xplore.handler.api.missions import MissionResource
+from xplore.handler.api.stats import StatsResource
 from xplore.handler.api.submissions import SubmissionResource
 from xplore.handler.api.users import UserResource
 from xplore.handler.api.waypoints import WaypointResource
 from xplore.handler.pages.admin import AdminPage
+from xplore.handler.tasks.migrations import ImageHashMigrationWorker, \
+    ImageVariantMigrationWorker, MissionRouteMigrationWorker, NameKeyMigrationWorker, \
+    ProgressEventMigrationWorker
+from xplore.handler.tasks.submissions import SubmissionScoringWorker
+from xplore.handler.tasks.tours import TourJobWorker
+from xplore.handler.tasks.uploads import UploadCleanupWorker
+from xplore.handler.tasks.waypoints import ImageIndexWorker, ImageVariantWorker
 
 
 config = {}
@@ -36,9 +47,20 @@ app = webapp2.WSGIApplication([
   # API routes
   RedirectRoute(r'/api/upload', handler=ImageUploadHandler, methods=['POST'], name='image-upload', strict_slash=True),
   RedirectRoute(r'/api/upload', handler=ImageUploadUrlProvider, methods=['GET'], name='image-upload-url', strict_slash=True),
+  RedirectRoute(r'/api/uploads', handler=ResumableUploadResource, methods=['POST'], name='uploads-resource', strict_slash=True),
+  RedirectRoute(r'/api/uploads/<upload_id>', handler=ResumableUploadResource, methods=['GET', 'PUT'], name='uploads-resource-named',
+                strict_slash=True),
+  RedirectRoute(r'/api/uploads/<upload_id>/finish', handler=ResumableUploadResource, handler_method='finish',
+                name='uploads-resource-finish', methods=['POST'], strict_slash=True),
   RedirectRoute(r'/api/waypoints', handler=WaypointResource, name='waypoints-resource', strict_slash=True),
+  RedirectRoute(r'/api/waypoints:batch', handler=WaypointResource, handler_method='post_batch', name='waypoints-batch',
+                methods=['POST']),
   RedirectRoute(r'/api/waypoints/<name>', handler=WaypointResource, name='waypoints-resource-named', strict_slash=True),
   RedirectRoute(r'/api/missions', handler=MissionResource, name='missions-resource', strict_slash=True),
+  RedirectRoute(r'/api/missions:batch', handler=MissionResource, handler_method='post_batch', name='missions-batch',
+                methods=['POST']),
+  RedirectRoute(r'/api/missions/jobs/<job_id>', handler=MissionResource, handler_method='mission_job', name='missions-job',
+                methods=['GET'], strict_slash=True),
   RedirectRoute(r'/api/missions/<name>', handler=MissionResource, name='missions-resource-named', strict_slash=True),
   RedirectRoute(r'/api/missions/<name>/start', handler=MissionResource, handler_method='mission_start' , name='missions-resource-start',
                 methods=['POST'], strict_slash=True),
@@ -50,8 +72,30 @@ app = webapp2.WSGIApplication([
   RedirectRoute(r'/api/submissions/<name>', handler=SubmissionResource, name='submissions-resource-named', strict_slash=True),
   RedirectRoute(r'/api/users', handler=UserResource, name='users-resource', strict_slash=True),
   RedirectRoute(r'/api/users/<userkey>', handler=UserResource, name='users-resource-named', strict_slash=True),
+  RedirectRoute(r'/api/stats', handler=StatsResource, name='stats-resource', methods=['GET'], strict_slash=True),
+  RedirectRoute(r'/api/migrations/<name>', handler=MigrationResource, name='migrations-resource', methods=['POST'], strict_slash=True),
   # Auth API
   RedirectRoute(r'/auth/token', handler=TokenResource, name='auth-token-provider', methods=['GET'], strict_slash=True),
+  # Task queue workers
+  RedirectRoute(r'/tasks/tours/generate', handler=TourJobWorker, name='tour-job-worker', methods=['POST'], strict_slash=True),
+  RedirectRoute(r'/tasks/migrations/name-keys', handler=NameKeyMigrationWorker, name='name-key-migration-worker', methods=['POST'],
+                strict_slash=True),
+  RedirectRoute(r'/tasks/migrations/mission-routes', handler=MissionRouteMigrationWorker, name='mission-route-migration-worker',
+                methods=['POST'], strict_slash=True),
+  RedirectRoute(r'/tasks/migrations/progress-events', handler=ProgressEventMigrationWorker,
+                name='progress-event-migration-worker', methods=['POST'], strict_slash=True),
+  RedirectRoute(r'/tasks/migrations/image-hashes', handler=ImageHashMigrationWorker, name='image-hash-migration-worker',
+                methods=['POST'], strict_slash=True),
+  RedirectRoute(r'/tasks/migrations/image-variants', handler=ImageVariantMigrationWorker,
+                name='image-variant-migration-worker', methods=['POST'], strict_slash=True),
+  RedirectRoute(r'/tasks/submissions/score', handler=SubmissionScoringWorker, name='submission-scoring-worker',
+                methods=['GET', 'POST'], strict_slash=True),
+  RedirectRoute(r'/tasks/uploads/cleanup', handler=UploadCleanupWorker, name='upload-cleanup-worker',
+                methods=['GET', 'POST'], strict_slash=True),
+  RedirectRoute(r'/tasks/waypoints/index-images', handler=ImageIndexWorker, name='image-index-worker',
+                methods=['POST'], strict_slash=True),
+  RedirectRoute(r'/tasks/waypoints/image-variants', handler=ImageVariantWorker, name='image-variant-worker',
+                methods=['POST'], strict_slash=True),
   # HTML pages
   RedirectRoute(r'/admin', handler=AdminPage, name='admin-page', methods=['GET'], strict_slash=True),
   # Home
@@ -1,4 +1,6 @@
 __all__ = []
 
 from auth import *
-__all__ += auth.__all__
\ No newline at end of file
+__all__ += auth.__all__
+from general import *
+__all__ += general.__all__
@@ -0,0 +1,18 @@
+__all__ = ['NonExistentEntitiesError', 'InvalidCursorError']
+
+class NonExistentEntitiesError(Exception):
+    """Exception triggered when some of the names given for resolution do not
+    match any stored entity.
+
+    Attributes:
+        names -- Sorted list of the names without a matching entity.
+    """
+
+    def __init__(self, names):
+        Exception.__init__(self, ', '.join(names))
+        self.names = names
+
+class InvalidCursorError(Exception):
+    """Exception triggered when a pagination cursor can not be decoded or
+    does not belong to the requested query.
+    """
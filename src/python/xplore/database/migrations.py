@@ -0,0 +1,250 @@
+'''
+Module with the data migrations of the datastore. Migrations work in batches
+so they can be chained through the task queue over large datasets.
+'''
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+import logging
+
+from xplore.database.models import Mission, MissionProgress, \
+    MissionProgressEvent, MissionWaypoint, TourJob, UserSubmission
+from xplore.database.scoring import index_waypoint_images, \
+    store_image_hashes
+from xplore.database.thumbnails import add_image_variants
+
+
+# Order in which the kinds are migrated to name keys. Waypoints go first so
+# the missions copied afterwards already reference the new waypoint keys.
+NAME_KEYED_KINDS = [MissionWaypoint, Mission]
+
+# Models and properties that hold keys of each name keyed kind, they are
+# rewritten before the entities with the old keys are deleted.
+_REFERENCES = {
+    MissionWaypoint: [(Mission, Mission.waypoints),
+                      (Mission, Mission.start_waypoint),
+                      (MissionProgress, MissionProgress.current_waypoint),
+                      (MissionProgress, MissionProgress.completed_waypoints),
+                      (MissionProgressEvent, MissionProgressEvent.waypoint),
+                      (UserSubmission, UserSubmission.waypoint),
+                      (MissionWaypoint, MissionWaypoint.duplicate_of)],
+    Mission: [(MissionProgress, MissionProgress.mission),
+              (UserSubmission, UserSubmission.mission),
+              (TourJob, TourJob.mission),
+              (TourJob, TourJob.missions)]}
+# Entities rewritten by a single transaction.
+_REWRITE_BATCH_SIZE = 100
+
+
+def _copy_with_name_key(entity):
+    '''
+    Build a copy of the entity keyed by its name under the same parent. The
+    copy is not stored.
+    '''
+    values = dict((prop._code_name, prop._get_value(entity))
+                  for prop in entity._properties.itervalues()
+                  if not isinstance(prop, ndb.ComputedProperty))
+    return type(entity)(id=entity.name, parent=entity.key.parent(), **values)
+
+
+def _find_referencing_keys(model_class, old_keys):
+    '''
+    Find the entities that reference any of the old keys of the given kind
+    with batched keys only IN queries. Kinds without a default ancestor are
+    queried globally, so references written just before may be missed.
+
+    Returns:
+        The set of keys of the referencing entities.
+    '''
+    futures = []
+    for referencing_class, prop in _REFERENCES[model_class]:
+        for i in xrange(0, len(old_keys), model_class._MAX_IN_VALUES):
+            qry = referencing_class.query(
+                prop.IN(old_keys[i:i + model_class._MAX_IN_VALUES]),
+                ancestor=referencing_class.default_ancestor())
+            futures.append(qry.fetch_async(keys_only=True))
+    return set(key for future in futures for key in future.get_result())
+
+
+def _rewrite_references(model_class, key_mapping):
+    '''
+    Replace the old keys by the new ones in every entity that references
+    them. Entities are re-read and rewritten in transactions per entity
+    group, so concurrent writes to them are not lost. The transactions are
+    cross group since missions read their waypoints when stored.
+    '''
+    referencing_keys = _find_referencing_keys(model_class,
+                                              key_mapping.keys())
+    groups = {}
+    for key in referencing_keys:
+        groups.setdefault(key.root(), []).append(key)
+
+    @ndb.transactional(xg=True)
+    def rewrite_group(keys):
+        entities = [entity for entity in ndb.get_multi(keys)
+                    if entity is not None]
+        for entity in entities:
+            for referencing_class, prop in _REFERENCES[model_class]:
+                if not isinstance(entity, referencing_class):
+                    continue
+                value = prop._get_value(entity)
+                if prop._repeated:
+                    value = [key_mapping.get(key, key) for key in value]
+                else:
+                    value = key_mapping.get(value, value)
+                prop._set_value(entity, value)
+        ndb.put_multi(entities)
+
+    for keys in groups.itervalues():
+        for i in xrange(0, len(keys), _REWRITE_BATCH_SIZE):
+            rewrite_group(keys[i:i + _REWRITE_BATCH_SIZE])
+
+
+def migrate_to_name_keys(model_class, cursor=None, batch_size=100):
+    '''
+    Rewrite a batch of entities stored with automatic ids so that they are
+    keyed by their name. Entities whose name is already taken by another key
+    are left untouched and logged.
+
+    The copies keyed by name are stored first, then every reference to the
+    old keys is rewritten and only then the old entities are deleted. A
+    batch interrupted half way is resumed by running it again, copies that
+    match the old entity are reused.
+
+    Args:
+        model_class: Model to migrate, one of NAME_KEYED_KINDS.
+        cursor: Websafe cursor returned by the previous batch, if any.
+        batch_size: Number of entities to examine in this batch.
+
+    Returns:
+        The websafe cursor for the next batch or None if the kind is done.
+    '''
+    start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    qry = model_class.query(ancestor=model_class.default_ancestor())
+    entities, next_cursor, more = qry.fetch_page(batch_size,
+                                                 start_cursor=start_cursor)
+
+    legacy = [entity for entity in entities
+              if entity.key.id() != entity.name]
+    new_keys = [model_class.key_for_name(entity.name) for entity in legacy]
+    replacements = []
+    key_mapping = {}
+    for entity, existing in zip(legacy, ndb.get_multi(new_keys)):
+        replacement = _copy_with_name_key(entity)
+        if existing is None:
+            replacements.append(replacement)
+        elif existing != replacement:
+            logging.warning('Not migrating %s, the name %s is already used '
+                            'by another entity.', entity.key, entity.name)
+            continue
+        key_mapping[entity.key] = replacement.key
+
+    if key_mapping:
+        ndb.put_multi(replacements)
+        _rewrite_references(model_class, key_mapping)
+        ndb.delete_multi(key_mapping.keys())
+
+    if more and next_cursor is not None:
+        return next_cursor.urlsafe()
+    return None
+
+
+def backfill_progress_events(cursor=None, batch_size=100):
+    '''
+    Move the events of a batch of mission progress entities stored before
+    events were child entities, see MissionProgress.convert_legacy_events.
+    It should run before the migration to name keys, which does not rewrite
+    the waypoints of legacy events.
+
+    Args:
+        cursor: Websafe cursor returned by the previous batch, if any.
+        batch_size: Number of progress entities to examine in this batch.
+
+    Returns:
+        The websafe cursor for the next batch or None if all progress
+        entities are done.
+    '''
+    start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    qry = MissionProgress.query()
+    progresses, next_cursor, more = qry.fetch_page(batch_size,
+                                                   start_cursor=start_cursor)
+    for progress in progresses:
+        if progress.legacy_events:
+            MissionProgress.convert_legacy_events(progress.key)
+
+    if more and next_cursor is not None:
+        return next_cursor.urlsafe()
+    return None
+
+
+def backfill_mission_routes(cursor=None, batch_size=100):
+    '''
+    Fill the denormalized start and the route geometry of a batch of
+    missions stored before these were introduced.
+
+    Args:
+        cursor: Websafe cursor returned by the previous batch, if any.
+        batch_size: Number of missions to examine in this batch.
+
+    Returns:
+        The websafe cursor for the next batch or None if all missions are
+        done.
+    '''
+    start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    qry = Mission.query(ancestor=Mission.default_ancestor())
+    missions, next_cursor, more = qry.fetch_page(batch_size,
+                                                 start_cursor=start_cursor)
+    ndb.put_multi(Mission.update_routes(missions))
+
+    if more and next_cursor is not None:
+        return next_cursor.urlsafe()
+    return None
+
+
+def backfill_image_hashes(cursor=None, batch_size=50):
+    '''
+    Compute the image hash of a batch of waypoints stored before image hashes
+    were introduced.
+
+    Args:
+        cursor: Websafe cursor returned by the previous batch, if any.
+        batch_size: Number of waypoints to examine in this batch.
+
+    Returns:
+        The websafe cursor for the next batch or None if all waypoints are
+        done.
+    '''
+    start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    qry = MissionWaypoint.query(ancestor=MissionWaypoint.default_ancestor())
+    waypoints, next_cursor, more = qry.fetch_page(batch_size,
+                                                  start_cursor=start_cursor)
+    store_image_hashes(index_waypoint_images(
+        [waypoint for waypoint in waypoints if waypoint.image_hash is None]))
+
+    if more and next_cursor is not None:
+        return next_cursor.urlsafe()
+    return None
+
+
+def backfill_image_variants(cursor=None, batch_size=10):
+    '''
+    Generate the image variants of a batch of waypoints stored before image
+    variants were introduced.
+
+    Args:
+        cursor: Websafe cursor returned by the previous batch, if any.
+        batch_size: Number of waypoints to examine in this batch.
+
+    Returns:
+        The websafe cursor for the next batch or None if all waypoints are
+        done.
+    '''
+    start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    qry = MissionWaypoint.query(ancestor=MissionWaypoint.default_ancestor())
+    waypoints, next_cursor, more = qry.fetch_page(batch_size,
+                                                  start_cursor=start_cursor)
+    add_image_variants([waypoint for waypoint in waypoints
+                        if waypoint.variants_pending])
+
+    if more and next_cursor is not None:
+        return next_cursor.urlsafe()
+    return None
@@ -14,4 +14,7 @@ from user import *
 __all__ += user.__all__
 from submission import *
 __all__ += submission.__all__
-
+from tourjob import *
+__all__ += tourjob.__all__
+from upload import *
+__all__ += upload.__all__
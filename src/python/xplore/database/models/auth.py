@@ -1,20 +1,33 @@
 import base64
 from datetime import datetime, timedelta
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from Crypto import Random
 
 from . import GenericModel
 from ..errors import ExpiredTokenError, InvalidTokenError, NotExistentTokenError
+from xplore.utils.cache import HitCounter
 
 
 __all__ = ['AccessToken']
 
 class AccessToken(GenericModel):
-    """Access token ndb model"""
+    """Access token ndb model.
+
+    Tokens are keyed by their token string, so validating one is a strongly
+    consistent get. Validated tokens are cached in memcache as (user key,
+    expires_on, valid) tuples keyed by token string, for at most
+    _TOKEN_CACHE_TIME seconds and never past the expiration of the token.
+    Validation only adds missing entries while invalidation overwrites them,
+    so a validation in flight can not cache a revoked token as valid.
+    """
 
     _ACCESS_TOKEN_EXPIRATION_TIME = 24 * 3600
     _TOKEN_BYTE_LENGTH = 32
+    _TOKEN_CACHE_PREFIX = 'access-token:'
+    _TOKEN_CACHE_TIME = 3600
+    _TOKEN_CACHE_COUNTER = HitCounter('access-token')
 
     associated_user = ndb.KeyProperty(kind='User', required=True)
     created_on = ndb.DateTimeProperty(auto_now_add=True)
@@ -42,6 +55,7 @@ class AccessToken(GenericModel):
         random_bytes = Random.get_random_bytes(AccessToken._TOKEN_BYTE_LENGTH)
         session_token = base64.b64encode(random_bytes)
         token = cls(parent=cls.default_ancestor(),
+                    id=session_token,
                     associated_user=user.key,
                     token_string=session_token)
         token.put()
@@ -66,6 +80,41 @@ class AccessToken(GenericModel):
         for result in to_store:
             futures.append(result.put_async())
         ndb.Future.wait_all(futures)
+        memcache.set_multi(dict((result.token_string,
+                                 (result.associated_user, result.expires_on,
+                                  False))
+                                for result in to_store),
+                           time=cls._TOKEN_CACHE_TIME,
+                           key_prefix=cls._TOKEN_CACHE_PREFIX)
+
+    @classmethod
+    def _load_token(cls, query_token):
+        """Read the cache entry of a token from the datastore, tokens created
+        before they were keyed by token string are found with a query.
+
+        Raises:
+            NotExistentTokenError -- if the given token does not exist.
+        """
+        result = cls.get_by_id(query_token)
+        if result is None:
+            results = cls.query(cls.token_string == query_token,
+                                ancestor=cls.default_ancestor())
+            result = results.get()
+        if result is None:
+            raise NotExistentTokenError()
+        return result.associated_user, result.expires_on, result.valid
+
+    @classmethod
+    def _cache_token(cls, query_token, entry):
+        """Cache the entry of a token unless there is one already, which
+        may be the invalid entry written by invalidate_tokens.
+        """
+        time_left = entry[1] - datetime.utcnow()
+        cache_time = min(cls._TOKEN_CACHE_TIME,
+                         int(time_left.total_seconds()))
+        if cache_time > 0:
+            memcache.add(cls._TOKEN_CACHE_PREFIX + query_token, entry,
+                         time=cache_time)
 
     @classmethod
     def validate_token(cls, query_token):
@@ -84,14 +133,25 @@ class AccessToken(GenericModel):
             InvalidTokenError -- if the given token is invalid.
             NotExistentTokenError -- if the given token does not exist.
         """
-        results = cls.query(cls.token_string == query_token,
-                            ancestor=cls.default_ancestor())
-        result = results.get()
-        if result is not None:
-            if not result.valid:
-                raise InvalidTokenError()
-            if result.expires_on <= datetime.utcnow():
-                raise ExpiredTokenError()
-            return result.associated_user
+        cache_key = cls._TOKEN_CACHE_PREFIX + query_token
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            cls._TOKEN_CACHE_COUNTER.hit()
+            associated_user, expires_on, valid = cached
         else:
-            raise NotExistentTokenError()
+            cls._TOKEN_CACHE_COUNTER.miss()
+            entry = cls._load_token(query_token)
+            cls._cache_token(query_token, entry)
+            associated_user, expires_on, valid = entry
+        if not valid:
+            raise InvalidTokenError()
+        if expires_on <= datetime.utcnow():
+            raise ExpiredTokenError()
+        return associated_user
+
+    @classmethod
+    def cache_stats(cls):
+        """Return the hit and miss counters of the validated token cache in
+        this instance.
+        """
+        return cls._TOKEN_CACHE_COUNTER.as_dict()
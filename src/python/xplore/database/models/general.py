@@ -1,8 +1,18 @@
+from google.appengine.api import lib_config, memcache
 from google.appengine.ext import ndb
+import time
+
+from ..errors import NonExistentEntitiesError
+from ..pagination import QueryPage
 
 __all__ = ['GenericModel']
 
 
+# Settings that can be overriden in appengine_config.py with the xplore_
+# prefix, e.g. xplore_NAME_KEYED_ENTITIES = True.
+config = lib_config.register('xplore', {'NAME_KEYED_ENTITIES': False})
+
+
 class GenericModel(ndb.Model):
     """Based model for the system.
 
@@ -12,8 +22,22 @@ class GenericModel(ndb.Model):
     Class attributes:
         _MAX_QUERY_RESULTS: Default maximum number of results to return in a
             query.
+        _MAX_IN_VALUES: Maximum number of values in a single IN filter, larger
+            lists are split in several queries run in parallel.
+        _TRACK_GENERATION: Whether writes to the model bump a per-kind
+            generation counter in memcache, used to validate data derived
+            from the stored entities. Writes inside a transaction bump it
+            once the transaction commits.
+        _NAME_KEYABLE: Whether the model can be stored with its unique name
+            as key id. This is only used if the NAME_KEYED_ENTITIES setting is
+            enabled, in which case lookups by name become key gets.
     """
     _MAX_QUERY_RESULTS = int(1e6)
+    _MAX_IN_VALUES = 30
+    _TRACK_GENERATION = False
+    _NAME_KEYABLE = False
+    # Set while the entity is stored by put_multi_untracked
+    _untracked_put = False
 
     @classmethod
     def default_ancestor(cls):
@@ -36,9 +60,39 @@ class GenericModel(ndb.Model):
             The newly created model class. Note that the model is not yet
             stored in the datastore.
         """
+        if cls.is_name_keyed() and 'id' not in kwargs:
+            kwargs['id'] = kwargs.get('name')
         return cls(parent=cls.default_ancestor(),
                    **kwargs)
 
+    @classmethod
+    def is_name_keyed(cls):
+        """Check if new entities of the model are keyed by name."""
+        return cls._NAME_KEYABLE and config.NAME_KEYED_ENTITIES
+
+    @classmethod
+    def key_for_name(cls, name):
+        """Build the key that an entity with the given name has when the
+        model is keyed by name.
+        """
+        return ndb.Key(cls, name, parent=cls.default_ancestor())
+
+    @classmethod
+    def put_multi_untracked(cls, entities):
+        """Store the entities without bumping the generation counter, for
+        background updates of fields that the data derived from the
+        generation does not depend on, e.g. image hashes. The entities are
+        stored with a single batch put, within the current transaction if
+        any.
+        """
+        for entity in entities:
+            entity._untracked_put = True
+        try:
+            return ndb.put_multi(entities)
+        finally:
+            for entity in entities:
+                entity._untracked_put = False
+
     @classmethod
     def get_by_id(cls, entity_id, ancestor=None):
         if ancestor is None:
@@ -55,11 +109,69 @@ class GenericModel(ndb.Model):
 
     @classmethod
     def get_by_property(cls, prop, value):
+        if prop == 'name' and cls.is_name_keyed():
+            result = cls.key_for_name(value).get()
+            if result is not None:
+                return [result]
+            # Fall back to the query for entities not migrated yet
         qry = cls.query(getattr(cls, prop) == value,
                         ancestor=cls.default_ancestor())
         results = qry.fetch()
         return results
 
+    @classmethod
+    def get_key_map_by_name(cls, names):
+        """Resolve a list of entity names to keys with batched IN queries on
+        the name property, instead of a query per name. If the model is keyed
+        by name then the names are first resolved with a single batch get.
+
+        Args:
+            names: List of names to resolve, it may contain repetitions.
+
+        Returns:
+            Dictionary from name to key, names that do not match a stored
+            entity are left out.
+        """
+        unique_names = list(set(names))
+        keys_by_name = {}
+        if cls.is_name_keyed():
+            candidate_keys = [cls.key_for_name(name) for name in unique_names]
+            for key, entity in zip(candidate_keys,
+                                   ndb.get_multi(candidate_keys)):
+                if entity is not None:
+                    keys_by_name[entity.name] = key
+            # Only entities not migrated yet are left for the query
+            unique_names = [name for name in unique_names
+                            if name not in keys_by_name]
+        futures = []
+        for i in xrange(0, len(unique_names), cls._MAX_IN_VALUES):
+            qry = cls.query(
+                cls.name.IN(unique_names[i:i + cls._MAX_IN_VALUES]),
+                ancestor=cls.default_ancestor())
+            futures.append(qry.fetch_async())
+        for future in futures:
+            for entity in future.get_result():
+                keys_by_name.setdefault(entity.name, entity.key)
+        return keys_by_name
+
+    @classmethod
+    def get_keys_by_name(cls, names):
+        """Resolve a list of entity names to keys in batch, see
+        get_key_map_by_name.
+
+        Returns:
+            List with the key for each name, in the same order as names.
+
+        Raises:
+            NonExistentEntitiesError: If any of the names does not match a
+                stored entity, it reports all the missing names at once.
+        """
+        keys_by_name = cls.get_key_map_by_name(names)
+        missing = sorted(set(names) - set(keys_by_name))
+        if missing:
+            raise NonExistentEntitiesError(missing)
+        return [keys_by_name[name] for name in names]
+
     @classmethod
     def get_all(cls, max_results=None, ancestor=None):
         if ancestor is None:
@@ -70,6 +182,68 @@ class GenericModel(ndb.Model):
         results = qry.fetch(max_results)
         return results
 
+    @classmethod
+    def get_page(cls, page_size, cursor=None, ancestor=None,
+                 batch_size=None):
+        """Return a page with the entities of the model, starting at the
+        given cursor token. Entities are fetched lazily from the datastore in
+        batches of batch_size while iterating the page.
+
+        Raises:
+            InvalidCursorError: If the cursor token is not valid.
+        """
+        if ancestor is None:
+            ancestor = cls.default_ancestor()
+        qry = cls.query(ancestor=ancestor)
+        return QueryPage(qry, page_size, cursor, batch_size)
+
     @classmethod
     def delete(cls):
         cls.key.delete()
+
+    @classmethod
+    def _generation_key(cls):
+        return 'generation:%s' % cls._get_kind()
+
+    @classmethod
+    def generation(cls):
+        """Return the current generation counter for the kind.
+
+        If memcache lost the counter then it is seeded again from the clock,
+        so the new value can not match any generation handed out before.
+        Returns None only if memcache is not available.
+        """
+        key = cls._generation_key()
+        value = memcache.get(key)
+        if value is None:
+            memcache.add(key, int(time.time() * 1000))
+            value = memcache.get(key)
+        return value
+
+    @classmethod
+    def bump_generation(cls):
+        """Move the generation counter of the kind forward, invalidating
+        anything derived from a previous generation.
+        """
+        memcache.incr(cls._generation_key(),
+                      initial_value=int(time.time() * 1000))
+
+    @classmethod
+    def _bump_generation_on_commit(cls):
+        """Bump the generation counter once the current transaction commits,
+        right away outside of transactions. Bumping before the commit would
+        let a concurrent reader derive data from the uncommitted state and
+        keep it under the new generation.
+        """
+        ndb.get_context().call_on_commit(cls.bump_generation)
+
+    def _post_put_hook(self, future):
+        super(GenericModel, self)._post_put_hook(future)
+        if self._TRACK_GENERATION and not self._untracked_put:
+            self._bump_generation_on_commit()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(GenericModel, cls)._post_delete_hook(key, future)
+        if cls._TRACK_GENERATION:
+            cls._bump_generation_on_commit()
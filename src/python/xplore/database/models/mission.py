@@ -1,4 +1,11 @@
 from google.appengine.ext import ndb
+import math
+
+import geocell
+from geotypes import Box, Point
+from xplore.database.proximitycache import ProximityCache
+from xplore.database.spatialindex import fetch_entities
+from xplore.utils import geo
 
 from . import GenericModel
 
@@ -8,6 +15,10 @@ __all__ = ['Mission']
 class Mission(GenericModel):
 
     _DEFAULT_MISSION_ROOT = ndb.Key('MissionRoot', 'default')
+    _TRACK_GENERATION = True
+    _NAME_KEYABLE = True
+    # Walking speed in m/s used for the expected duration
+    _WALKING_SPEED = 1.4
 
     name = ndb.StringProperty(required = True)
     waypoints = ndb.KeyProperty(kind = 'MissionWaypoint', repeated = True)
@@ -15,8 +26,31 @@ class Mission(GenericModel):
     tags = ndb.StringProperty(repeated=True)
     created_by = ndb.KeyProperty(kind='User')
     created_on = ndb.DateProperty(auto_now_add=True)
+    # Route geometry computed on every put: length in meters, walking time in
+    # seconds and the box around the waypoints as north, east, south, west.
     distance = ndb.FloatProperty()
     expected_duration = ndb.FloatProperty()
+    bounding_box = ndb.FloatProperty(repeated=True, indexed=False)
+    # Denormalized copy of the first waypoint and its location, kept in sync
+    # on every put so missions can be searched by their starting point.
+    start_waypoint = ndb.KeyProperty(kind='MissionWaypoint')
+    start_location = ndb.GeoPtProperty(indexed=False)
+    start_geocells = ndb.StringProperty(repeated=True)
+
+    def __init__(self, *args, **kwargs):
+        super(Mission, self).__init__(*args, **kwargs)
+        # Waypoints the route fields were last computed for, None if they
+        # must be computed on the next put
+        self._route_waypoints = None
+
+    @classmethod
+    def _from_pb(cls, pb, set_key=True, ent=None, key=None):
+        mission = super(Mission, cls)._from_pb(pb, set_key, ent, key)
+        # The stored route fields match the stored waypoints, unless the
+        # mission was stored before they existed
+        if mission.start_waypoint is not None or not mission.waypoints:
+            mission._route_waypoints = list(mission.waypoints)
+        return mission
 
     @classmethod
     def query_by_waypoint(cls, candidate_waypoints,
@@ -29,11 +63,145 @@ class Mission(GenericModel):
             max_results = cls._MAX_QUERY_RESULTS
         if isinstance(candidate_waypoints, ndb.Key):
             candidate_waypoints = [candidate_waypoints]
-        qry = cls.query(cls.waypoints.IN(candidate_waypoints),
+        qry = cls.query(cls.start_waypoint.IN(candidate_waypoints),
                         ancestor = cls.default_ancestor())
         results = qry.fetch(max_results)
         return results
 
+    @classmethod
+    def query_containing_waypoint(cls, waypoint_key):
+        '''
+        Query for the missions that visit the given waypoint at any point.
+        '''
+        qry = cls.query(cls.waypoints == waypoint_key,
+                        ancestor = cls.default_ancestor())
+        return qry.fetch()
+
+    @classmethod
+    def query_starting_in_box(cls, north, east, south, west,
+                              max_results=None):
+        '''
+        Query for the missions whose first waypoint is inside the given box.
+        This is a single query over the start geocells covering the box, the
+        results are then filtered by their exact start location.
+        '''
+        if max_results is None:
+            max_results = cls._MAX_QUERY_RESULTS
+        results = []
+        for mission in cls._query_start_cells(north, east, south, west):
+            location = mission.start_location
+            if geo.in_box(location.lat, location.lon,
+                          north, east, south, west):
+                results.append(mission)
+                if len(results) >= max_results:
+                    break
+        return results
+
+    @classmethod
+    def query_starting_near(cls, center, max_results=None, max_distance=0):
+        '''
+        Query for the missions whose first waypoint is within max_distance
+        meters of the center, sorted by distance. A max_distance of 0 does not
+        limit the distance. Limited queries are answered from the cached
+        candidates around the center when possible.
+        '''
+        if max_results is None:
+            max_results = cls._MAX_QUERY_RESULTS
+        keys = _PROXIMITY_CACHE.query_near(center.lat, center.lon,
+                                           max_results, max_distance)
+        if keys is not None:
+            return fetch_entities(keys)
+        if max_distance <= 0:
+            max_distance = geo.EARTH_RADIUS * math.pi
+        north, east, south, west = geo.bounding_box(center.lat, center.lon,
+                                                    max_distance)
+        candidates = list(cls._query_start_cells(north, east, south, west))
+        ranked = geo.nearest(
+            center.lat, center.lon,
+            [mission.start_location.lat for mission in candidates],
+            [mission.start_location.lon for mission in candidates],
+            max_results, max_distance)
+        return [candidates[index] for index in ranked]
+
+    @classmethod
+    def query_between(cls, start, end, max_distance, max_results=None):
+        '''
+        Query for the missions whose first waypoint is within max_distance
+        meters of start and whose last waypoint is within max_distance meters
+        of end, sorted by the distance of their first waypoint. The last
+        waypoints of the candidates are retrieved with a single batch get.
+        '''
+        if max_results is None:
+            max_results = cls._MAX_QUERY_RESULTS
+        candidates = cls.query_starting_near(start, max_distance=max_distance)
+        last_waypoints = ndb.get_multi([mission.waypoints[-1]
+                                        for mission in candidates])
+        results = []
+        for mission, waypoint in zip(candidates, last_waypoints):
+            if waypoint is not None and \
+                geo.distance(waypoint.location.lat, waypoint.location.lon,
+                             end.lat, end.lon) <= max_distance:
+                results.append(mission)
+                if len(results) >= max_results:
+                    break
+        return results
+
+    @classmethod
+    def _entries_in_box(cls, north, east, south, west, max_results):
+        return [(mission.start_location.lat, mission.start_location.lon,
+                 mission.key)
+                for mission in cls.query_starting_in_box(north, east, south,
+                                                         west, max_results)]
+
+    @classmethod
+    def _query_start_cells(cls, north, east, south, west):
+        # Boxes crossing the antimeridian are covered as two boxes
+        if west <= east:
+            boxes = [(north, east, south, west)]
+        else:
+            boxes = [(north, 180.0, south, west), (north, east, south, -180.0)]
+        cells = set()
+        for box in boxes:
+            cells.update(geocell.best_bbox_search_cells(
+                Box(*box), geocell.default_cost_function))
+        qry = cls.query(cls.start_geocells.IN(list(cells)),
+                        ancestor = cls.default_ancestor())
+        return qry.iter()
+
+    @classmethod
+    def update_routes(cls, missions):
+        '''
+        Compute the denormalized start and the route geometry of the given
+        missions, all their waypoints are retrieved with a single batch get.
+        The missions are not stored.
+
+        Returns:
+            The given list of missions.
+        '''
+        waypoints = cls.fetch_waypoints(missions)
+        for mission in missions:
+            route = [waypoints[key] for key in mission.waypoints
+                     if key in waypoints]
+            mission._set_start(route[0] if route else None)
+            mission._set_geometry([waypoint.location for waypoint in route])
+            mission._route_waypoints = list(mission.waypoints)
+        return missions
+
+    @classmethod
+    def fetch_waypoints(cls, missions):
+        '''
+        Retrieve the waypoints referenced by the given missions with a single
+        batch get, waypoints shared between missions are fetched only once.
+        Returns a dictionary that maps each waypoint key to its entity, keys
+        that no longer point to a stored waypoint are left out.
+        '''
+        waypoint_keys = list(set(waypoint_key for mission in missions
+                                 for waypoint_key in mission.waypoints))
+        waypoints = ndb.get_multi(waypoint_keys)
+        return dict((key, waypoint)
+                    for key, waypoint in zip(waypoint_keys, waypoints)
+                    if waypoint is not None)
+
     @classmethod
     def default_ancestor(cls):
         '''
@@ -41,10 +209,41 @@ class Mission(GenericModel):
         '''
         return cls._DEFAULT_MISSION_ROOT
 
+    def _set_start(self, waypoint):
+        if waypoint is None:
+            self.start_waypoint = None
+            self.start_location = None
+            self.start_geocells = []
+            return
+        self.start_waypoint = waypoint.key
+        self.start_location = waypoint.location
+        self.start_geocells = geocell.generate_geocells(
+            Point(waypoint.location.lat, waypoint.location.lon))
+
+    def _set_geometry(self, locations):
+        if not locations:
+            self.distance = None
+            self.expected_duration = None
+            self.bounding_box = []
+            return
+        latitudes = [location.lat for location in locations]
+        longitudes = [location.lon for location in locations]
+        self.distance = geo.path_length(latitudes, longitudes)
+        self.expected_duration = self.distance / self._WALKING_SPEED
+        self.bounding_box = [max(latitudes), max(longitudes),
+                             min(latitudes), min(longitudes)]
+
+    def _pre_put_hook(self):
+        super(Mission, self)._pre_put_hook()
+        if self._route_waypoints != self.waypoints:
+            self.update_routes([self])
+
     def remove_waypoint(self, waypoint_key):
         self.waypoints.remove(waypoint_key)
         if len(self.waypoints):
-            self.start_waypoint = self.waypoints[0]
             self.put()
         else:
-            self.delete()
\ No newline at end of file
+            self.delete()
+
+
+_PROXIMITY_CACHE = ProximityCache(Mission, Mission._entries_in_box)
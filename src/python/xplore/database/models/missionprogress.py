@@ -1,43 +1,205 @@
+from datetime import datetime
 from google.appengine.ext import ndb
 
 from . import GenericModel
 
 
-__all__ = ['MissionProgress']
+__all__ = ['MissionProgress', 'MissionProgressEvent']
 
-class _MissionProgressEvent(GenericModel):
-    timestamp = ndb.DateTimeProperty(auto_now_add=True)
+class MissionProgressEvent(GenericModel):
+    """Single event in the progress of an user in a mission. Events are
+    stored as children of their MissionProgress with their sequence number as
+    id, so recording one never rewrites the previous ones.
+    """
+    MISSION_STARTED = 'mission_started'
+    WAYPOINT_COMPLETED = 'waypoint_completed'
+    MISSION_FINISHED = 'mission_finished'
+
+    _DESCRIPTIONS = {MISSION_STARTED: 'Mission started',
+                     WAYPOINT_COMPLETED: 'Waypoint completed',
+                     MISSION_FINISHED: 'Mission finished'}
 
-class _MissionStarted(_MissionProgressEvent):
-    description = ndb.StringProperty(default='Mission started')
+    event_type = ndb.StringProperty(choices=_DESCRIPTIONS.keys(),
+                                    required=True)
+    sequence = ndb.IntegerProperty(required=True)
+    timestamp = ndb.DateTimeProperty(required=True)
+    waypoint = ndb.KeyProperty(kind='MissionWaypoint')
 
-class _WaypointCompleted(_MissionProgressEvent):
-    description = ndb.StringProperty(default='Waypoint completed')
-    waypoint = ndb.KeyProperty(kind='MissionWaypoint', required=True)
+    @property
+    def description(self):
+        return self._DESCRIPTIONS[self.event_type]
 
-class _MissionFinished(_MissionProgressEvent):
-    description = ndb.StringProperty(default='Mission finished')
+class _LegacyEvent(ndb.Model):
+    """Event as stored in the events structured property of MissionProgress
+    before events were child entities, only read to convert them.
+    """
+    timestamp = ndb.DateTimeProperty()
+    description = ndb.StringProperty()
+    waypoint = ndb.KeyProperty(kind='MissionWaypoint')
 
 class MissionProgress(GenericModel):
     """MissionProgress model that records the progress of an user in a given
     mission as a series of events.
+
+    The entity itself is a small summary of the current state, the events
+    are stored as MissionProgressEvent children which are only loaded when
+    the history is requested through the events property. Events are
+    recorded in transactions, so concurrent ones get consecutive sequence
+    numbers.
+
+    Progress stored before events were child entities keeps them in the
+    legacy_events property until it is converted, either when the next
+    event is recorded or by the progress-events migration.
+
+    Properties:
+    * event_count: Number of events recorded so far.
+    * current_waypoint: Last waypoint completed by the user.
+    * completed_waypoints: Waypoints completed by the user, in order.
+    * started_on, finished_on: Times when the mission was started and
+        finished, if it was.
     """
+    _EVENT_TYPES = dict((description, event_type) for event_type, description
+                        in MissionProgressEvent._DESCRIPTIONS.iteritems())
 
     user = ndb.KeyProperty(kind='User', required=True)
     mission = ndb.KeyProperty(kind='Mission', required=True)
-    events = ndb.StructuredProperty(_MissionProgressEvent, repeated=True)
+    event_count = ndb.IntegerProperty(default=0)
+    current_waypoint = ndb.KeyProperty(kind='MissionWaypoint')
+    completed_waypoints = ndb.KeyProperty(kind='MissionWaypoint',
+                                          repeated=True)
+    started_on = ndb.DateTimeProperty()
+    finished_on = ndb.DateTimeProperty()
+    updated_on = ndb.DateTimeProperty(auto_now=True)
+    legacy_events = ndb.StructuredProperty(_LegacyEvent, repeated=True,
+                                           name='events')
+
+    @property
+    def events(self):
+        """Full history of events in the order they were recorded."""
+        if self.key is None:
+            return []
+        return self._merged_events()
+
+    @classmethod
+    @ndb.transactional
+    def convert_legacy_events(cls, key):
+        """Move the legacy events of the given progress to child entities.
+
+        Returns:
+            Whether there were legacy events to convert.
+        """
+        progress = key.get()
+        if progress is None or not progress.legacy_events:
+            return False
+        progress._convert_legacy_events()
+        return True
 
     def start_mission(self):
-        start_event = _MissionStarted()
-        self.events.append(start_event)
-        self.put()
+        self._record_event(MissionProgressEvent.MISSION_STARTED,
+                           datetime.utcnow())
 
     def finish_mission(self):
-        finish_event = _MissionFinished()
-        self.events.append(finish_event)
-        self.put()
+        self._record_event(MissionProgressEvent.MISSION_FINISHED,
+                           datetime.utcnow())
 
     def complete_waypoint(self, waypoint):
-        waypoint_complete_event = _WaypointCompleted(waypoint=waypoint)
-        self.events.append(waypoint_complete_event)
-        self.put()
+        self._record_event(MissionProgressEvent.WAYPOINT_COMPLETED,
+                           datetime.utcnow(), waypoint)
+
+    def _apply_event(self, event):
+        """Update the summary with an event."""
+        if event.event_type == MissionProgressEvent.MISSION_STARTED:
+            self.started_on = event.timestamp
+        elif event.event_type == MissionProgressEvent.MISSION_FINISHED:
+            self.finished_on = event.timestamp
+        else:
+            self.current_waypoint = event.waypoint
+            if event.waypoint not in self.completed_waypoints:
+                self.completed_waypoints.append(event.waypoint)
+
+    def _record_event(self, event_type, timestamp, waypoint=None):
+        """Store the summary together with a new event, the cost does not
+        depend on the number of previous events. The summary is read again
+        in the transaction and copied back to this entity.
+        """
+        if self.key is None:
+            first_id, _ = MissionProgress.allocate_ids(1)
+            self.key = ndb.Key(MissionProgress, first_id)
+        progress = self._store_event(self.key, self.user, self.mission,
+                                     event_type, timestamp, waypoint)
+        for name in ('event_count', 'current_waypoint', 'completed_waypoints',
+                     'started_on', 'finished_on', 'updated_on',
+                     'legacy_events'):
+            setattr(self, name, getattr(progress, name))
+
+    @staticmethod
+    @ndb.transactional
+    def _store_event(key, user, mission, event_type, timestamp, waypoint):
+        progress = key.get()
+        if progress is None:
+            progress = MissionProgress(key=key, user=user, mission=mission)
+        elif progress.legacy_events:
+            progress._convert_legacy_events()
+        event = MissionProgressEvent(parent=key,
+                                     id=progress.event_count + 1,
+                                     event_type=event_type,
+                                     sequence=progress.event_count + 1,
+                                     timestamp=timestamp,
+                                     waypoint=waypoint)
+        progress._apply_event(event)
+        progress.event_count = event.sequence
+        ndb.put_multi([progress, event])
+        return progress
+
+    def _merged_events(self):
+        """Build the full history, the legacy events go first followed by
+        the child events renumbered after them. Waypoints of legacy events
+        may not be aligned with them, so they are matched in order with the
+        waypoint completed events.
+        """
+        waypoints = [legacy.waypoint for legacy in self.legacy_events
+                     if legacy.waypoint is not None]
+        events = []
+        for legacy in self.legacy_events:
+            event_type = self._EVENT_TYPES.get(legacy.description)
+            if event_type is None:
+                continue
+            waypoint = None
+            if event_type == MissionProgressEvent.WAYPOINT_COMPLETED and \
+                    waypoints:
+                waypoint = waypoints.pop(0)
+            events.append(MissionProgressEvent(parent=self.key,
+                                               id=len(events) + 1,
+                                               event_type=event_type,
+                                               sequence=len(events) + 1,
+                                               timestamp=legacy.timestamp,
+                                               waypoint=waypoint))
+        qry = MissionProgressEvent.query(ancestor=self.key).order(
+            MissionProgressEvent.sequence)
+        offset = len(events)
+        for event in qry.fetch():
+            if offset:
+                event = MissionProgressEvent(parent=self.key,
+                                             id=event.sequence + offset,
+                                             event_type=event.event_type,
+                                             sequence=event.sequence + offset,
+                                             timestamp=event.timestamp,
+                                             waypoint=event.waypoint)
+            events.append(event)
+        return events
+
+    def _convert_legacy_events(self):
+        """Store the merged history as child entities and rebuild the summary
+        from it, this must run in a transaction. Renumbered child events
+        overwrite the previous ones since the ids only grow.
+        """
+        events = self._merged_events()
+        self.legacy_events = []
+        self.current_waypoint = None
+        self.completed_waypoints = []
+        self.started_on = None
+        self.finished_on = None
+        for event in events:
+            self._apply_event(event)
+        self.event_count = len(events)
+        ndb.put_multi(events + [self])
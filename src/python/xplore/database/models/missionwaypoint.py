@@ -1,14 +1,61 @@
-from google.appengine.api.images import get_serving_url
-from google.appengine.ext import ndb
-from google.appengine.ext.blobstore import BlobInfo
+from google.appengine.api import memcache
+from google.appengine.api.images import delete_serving_url, \
+    get_serving_url_async
+from google.appengine.ext import blobstore, ndb
 
 from geomodel import GeoModel
 from geotypes import Box
+from xplore.database.proximitycache import ProximityCache
+from xplore.database.spatialindex import SpatialIndex, fetch_entities
 from xplore.database.utils import get_missions_for_waypoint
+from xplore.utils.cache import LRUCache
 
 from . import GenericModel
 
-__all__ = ['MissionWaypoint']
+__all__ = ['ImageVariant', 'MissionWaypoint']
+
+
+# Base serving URLs by blob key, the per-instance layer in front of memcache.
+_SERVING_URL_CACHE = LRUCache(2000)
+_SERVING_URL_MEMCACHE_PREFIX = 'serving-url:'
+
+
+def _sized_serving_url(base_url, image_size):
+    '''
+    Build the serving URL for the given size from a base serving URL. A size
+    of 0 serves the image in its original size, the bare base URL would serve
+    it downscaled to 512 pixels.
+    '''
+    return '%s=s%d' % (base_url, image_size)
+
+
+def _closest_variant(variants, image_size):
+    '''
+    Pick the smallest variant that covers the given size, the largest one if
+    none does or if the size is 0.
+    '''
+    largest = max(variants, key=lambda variant: variant.size)
+    if not image_size:
+        return largest
+    covering = [variant for variant in variants if variant.size >= image_size]
+    if not covering:
+        return largest
+    return min(covering, key=lambda variant: variant.size)
+
+
+class ImageVariant(ndb.Model):
+    """Pre-generated size of a waypoint image, stored in the blobstore.
+
+    Properties:
+    * name: Name of the step in the size ladder, e.g. thumbnail.
+    * size: Longest edge of the image in pixels.
+    * image: Key for the resized image stored in the Blobstore.
+    * serving_url: Serving URL for the image at its own size.
+    """
+    name = ndb.StringProperty(required=True)
+    size = ndb.IntegerProperty(required=True)
+    image = ndb.BlobKeyProperty(required=True)
+    serving_url = ndb.StringProperty(required=True)
 
 
 class MissionWaypoint(GenericModel, GeoModel):
@@ -18,8 +65,18 @@ class MissionWaypoint(GenericModel, GeoModel):
     * name: Name of the waypoint, unique across the namespace. This is the only
         required argument
     * image: Key for the waypoint image stored in the Blobstore.
+    * image_serving_url: Base serving URL for image, sized variants are built
+        from it without calling the images service.
     * image_url: URL pointing to the image, this can be provided in place of
         image.
+    * image_hash: Perceptual hash of the image, computed in the background
+        after the image is set. It is None while pending and empty if the
+        image could not be decoded.
+    * duplicate_of: Another waypoint with the same image hash, found when the
+        hash was computed.
+    * image_variants: Pre-generated sizes of the image, from either image or
+        image_url, generated in the background after the image is set.
+    * variants_pending: Whether the image variants must be (re)generated.
     * description: Description of the waypoint, if any.
     * tags: List of tags associated with the waypoint.
     * created_by: Creator of the waypoint. This points to a valid user
@@ -28,10 +85,17 @@ class MissionWaypoint(GenericModel, GeoModel):
     * difficulty: Difficulty scale for the waypoint.
     """
     _DEFAULT_MISSION_WAYPOINT_ROOT = ndb.Key('MissionWaypointRoot', 'default')
+    _TRACK_GENERATION = True
+    _NAME_KEYABLE = True
 
     name = ndb.StringProperty(required=True)
     image = ndb.BlobKeyProperty()
+    image_serving_url = ndb.StringProperty(indexed=False)
     image_url = ndb.StringProperty()
+    image_hash = ndb.StringProperty()
+    duplicate_of = ndb.KeyProperty(kind='MissionWaypoint')
+    image_variants = ndb.LocalStructuredProperty(ImageVariant, repeated=True)
+    variants_pending = ndb.BooleanProperty(default=True)
     description = ndb.StringProperty()
     tags = ndb.StringProperty(repeated=True)
     created_by = ndb.KeyProperty(kind='User')
@@ -41,8 +105,21 @@ class MissionWaypoint(GenericModel, GeoModel):
 
     @classmethod
     def query_near(cls, center, max_results=None, max_distance=0):
+        """Retrieve the waypoints closest to the center, sorted by distance.
+        The query is answered from the cached candidates around the center or
+        the in-process spatial index, geomodel's proximity fetch is used only
+        if both are cold.
+        """
         if max_results is None:
             max_results = cls._MAX_QUERY_RESULTS
+        keys = _PROXIMITY_CACHE.query_near(center.lat, center.lon,
+                                           max_results, max_distance)
+        if keys is not None:
+            return fetch_entities(keys)
+        grid = _SPATIAL_INDEX.grid()
+        if grid is not None:
+            return fetch_entities(grid.query_near(center.lat, center.lon,
+                                                  max_results, max_distance))
         base_query = cls.query()
         results = cls.proximity_fetch(base_query, center,
                                       max_results, max_distance)
@@ -50,30 +127,216 @@ class MissionWaypoint(GenericModel, GeoModel):
 
     @classmethod
     def query_box(cls, north, east, south, west, max_results=None):
+        """Retrieve the waypoints inside the given box. The query is answered
+        from the in-process spatial index, geomodel's bounding box fetch is
+        used only if the index is cold.
+        """
         if max_results is None:
             max_results = cls._MAX_QUERY_RESULTS
+        grid = _SPATIAL_INDEX.grid()
+        if grid is not None:
+            return fetch_entities(grid.query_box(north, east, south, west,
+                                                 max_results))
         query_box = Box(north, east, south, west)
         base_query = cls.query()
         results = cls.bounding_box_fetch(base_query, query_box, max_results)
         return results
 
+    @classmethod
+    def _entries_in_box(cls, north, east, south, west, max_results):
+        return [(waypoint.location.lat, waypoint.location.lon, waypoint.key)
+                for waypoint in cls.query_box(north, east, south, west,
+                                              max_results)]
+
     @classmethod
     def default_ancestor(cls):
         return cls._DEFAULT_MISSION_WAYPOINT_ROOT
 
+    @classmethod
+    def serving_urls(cls, waypoints):
+        """Resolve the base serving URLs for the blobstore images of the given
+        waypoints.
+
+        URLs are looked up in the entity itself, then in the per-instance
+        cache and then in memcache. The remaining ones are requested from the
+        images service with parallel asynchronous calls and stored in both
+        caches.
+
+        Returns:
+            A dictionary that maps the string blob keys to base serving URLs.
+        """
+        results = {}
+        missing = set()
+        for waypoint in waypoints:
+            if waypoint.image is None:
+                continue
+            blob_key = str(waypoint.image)
+            base_url = waypoint.image_serving_url or \
+                _SERVING_URL_CACHE.get(blob_key)
+            if base_url is None:
+                missing.add(blob_key)
+            else:
+                results[blob_key] = base_url
+        if not missing:
+            return results
+
+        cached = memcache.get_multi(list(missing),
+                                    key_prefix=_SERVING_URL_MEMCACHE_PREFIX)
+        rpcs = {}
+        for blob_key in missing:
+            if blob_key in cached:
+                results[blob_key] = cached[blob_key]
+                _SERVING_URL_CACHE.set(blob_key, cached[blob_key])
+            else:
+                rpcs[blob_key] = get_serving_url_async(blob_key)
+        fetched = {}
+        for blob_key, rpc in rpcs.iteritems():
+            fetched[blob_key] = rpc.get_result()
+            _SERVING_URL_CACHE.set(blob_key, fetched[blob_key])
+        if fetched:
+            memcache.set_multi(fetched,
+                               key_prefix=_SERVING_URL_MEMCACHE_PREFIX)
+        results.update(fetched)
+        return results
+
+    @classmethod
+    def set_serving_urls(cls, waypoints):
+        """Resolve the serving URLs of the images of the given waypoints in
+        one batch and store them in the entities, so that putting them needs
+        no images service call per waypoint.
+        """
+        serving_urls = cls.serving_urls(waypoints)
+        for waypoint in waypoints:
+            if waypoint.image is not None:
+                waypoint.image_serving_url = serving_urls[str(waypoint.image)]
+
+    @classmethod
+    def query_pending_hash(cls):
+        """Query the waypoints whose image hash has not been computed."""
+        return cls.query(cls.image_hash == None,
+                         ancestor=cls.default_ancestor())
+
+    @classmethod
+    def query_pending_variants(cls):
+        """Query the waypoints whose image variants must be generated."""
+        return cls.query(cls.variants_pending == True,
+                         ancestor=cls.default_ancestor())
+
+    @classmethod
+    def get_keys_by_image_hash(cls, image_hashes):
+        """Find the waypoints with any of the given image hashes with batched
+        IN queries.
+
+        Returns:
+            Dictionary from image hash to the list of keys of the waypoints
+            with that hash, hashes without waypoints are left out.
+        """
+        image_hashes = list(set(image_hashes))
+        futures = []
+        for i in xrange(0, len(image_hashes), cls._MAX_IN_VALUES):
+            qry = cls.query(
+                cls.image_hash.IN(image_hashes[i:i + cls._MAX_IN_VALUES]),
+                ancestor=cls.default_ancestor())
+            futures.append(qry.fetch_async())
+        keys_by_hash = {}
+        for future in futures:
+            for waypoint in future.get_result():
+                keys_by_hash.setdefault(waypoint.image_hash,
+                                        []).append(waypoint.key)
+        return keys_by_hash
+
+    @classmethod
+    def remember_serving_url(cls, blob_key, base_url):
+        """Seed the serving URL caches with an URL obtained elsewhere, e.g.
+        when the image is uploaded.
+        """
+        blob_key = str(blob_key)
+        _SERVING_URL_CACHE.set(blob_key, base_url)
+        memcache.set(_SERVING_URL_MEMCACHE_PREFIX + blob_key, base_url)
+
+    @classmethod
+    def to_jsonizable_multi(cls, waypoints, image_size):
+        """Serialize a list of waypoints, resolving all their serving URLs in
+        one batch. Waypoints with image variants need no serving URL lookup.
+        """
+        serving_urls = cls.serving_urls([waypoint for waypoint in waypoints
+                                         if not waypoint.image_variants])
+        return [waypoint.to_jsonizable(image_size, serving_urls)
+                for waypoint in waypoints]
+
+    def _pre_put_hook(self):
+        super(MissionWaypoint, self)._pre_put_hook()
+        if self.image is not None and self.image_serving_url is None:
+            self.image_serving_url = self.serving_urls([self])[str(self.image)]
+
+    def replace_image(self, image):
+        """Swap the blobstore image of the waypoint, the previous image and
+        its variants are deleted from the blobstore and their serving URLs are
+        invalidated. The waypoint must be stored afterwards to persist the
+        change.
+        """
+        if image == self.image:
+            return
+        if self.image is not None:
+            self._invalidate_image()
+        self.set_image_variants(None)
+        self.image = image
+        self.image_serving_url = None
+        self.image_hash = None
+        self.duplicate_of = None
+
+    def set_image_variants(self, variants):
+        """Replace the image variants of the waypoint, the previous ones are
+        deleted from the blobstore. None marks the variants as pending.
+        """
+        delete_variants(self.image_variants)
+        self.image_variants = variants or []
+        self.variants_pending = variants is None
+
+    def _invalidate_image(self):
+        blob_key = str(self.image)
+        _SERVING_URL_CACHE.delete(blob_key)
+        memcache.delete(_SERVING_URL_MEMCACHE_PREFIX + blob_key)
+        delete_serving_url(self.image)
+        blobstore.delete(self.image)
+
     def delete(self):
         related_missions = get_missions_for_waypoint(self.key)
         map(lambda x: x.remove_waypoint(self.key), related_missions)
-        BlobInfo.get(self.image).delete()
+        if self.image is not None:
+            self._invalidate_image()
+        delete_variants(self.image_variants)
         self.key.delete()
 
-    def to_jsonizable(self, image_size):
+    def to_jsonizable(self, image_size, serving_urls=None):
         result = {'latitude': self.location.lat,
                   'longitude': self.location.lon,
                   'name': self.name}
-        if self.image is not None:
-            result['image_url'] = get_serving_url(self.image, size=image_size)
+        if self.image_variants:
+            result['image_url'] = _closest_variant(self.image_variants,
+                                                   image_size).serving_url
+            if self.image is not None:
+                result['image_key'] = str(self.image)
+        elif self.image is not None:
+            if serving_urls is None:
+                serving_urls = self.serving_urls([self])
+            result['image_url'] = _sized_serving_url(
+                serving_urls[str(self.image)], image_size)
             result['image_key'] = str(self.image)
         elif self.image_url is not None:
             result['image_url'] = self.image_url
         return result
+
+
+def delete_variants(variants):
+    '''Delete image variants from the blobstore with their serving URLs.'''
+    if not variants:
+        return
+    for variant in variants:
+        delete_serving_url(variant.image)
+    blobstore.delete([variant.image for variant in variants])
+
+
+_SPATIAL_INDEX = SpatialIndex(MissionWaypoint)
+_PROXIMITY_CACHE = ProximityCache(MissionWaypoint,
+                                  MissionWaypoint._entries_in_box)
@@ -8,9 +8,23 @@ __all__ = ['UserSubmission']
 
 class UserSubmission(GenericModel, GeoModel):
 
+    # Score of the submissions that have not been scored yet
+    PENDING_SCORE = -1
+    # Score of the submissions whose scoring kept failing, they are kept
+    # as they are and never scored again
+    UNSCORABLE_SCORE = -2
+
     owner = ndb.KeyProperty(kind = 'User', required = True)
     mission = ndb.KeyProperty(kind = 'Mission', required = True)
     waypoint = ndb.KeyProperty(kind = 'MissionWaypoint', required = True)
     image = ndb.BlobKeyProperty(required = True)
     created_on = ndb.DateTimeProperty(auto_now_add = True)
-    score = ndb.FloatProperty(default = -1)
\ No newline at end of file
+    score = ndb.FloatProperty(default = PENDING_SCORE)
+
+    @classmethod
+    def query_pending(cls):
+        """Query the submissions that have not been scored yet."""
+        return cls.query(cls.score == cls.PENDING_SCORE)
+
+    def is_pending(self):
+        return self.score == self.PENDING_SCORE
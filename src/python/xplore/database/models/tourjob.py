@@ -0,0 +1,49 @@
+from google.appengine.ext import ndb
+
+from . import GenericModel
+
+
+__all__ = ['TourJob']
+
+class TourJob(GenericModel):
+    """Request for a new tour to the tour generator service. Jobs are created
+    by the missions resource and processed in the tours task queue, the
+    resulting missions are recorded on the job once the generator responds.
+
+    Properties:
+    * status: One of pending, running, done or failed.
+    * start_location, end_location: Requested start and end of the tour.
+    * alternatives: Number of alternative tours requested.
+    * mission: First mission materialized from the generator response.
+    * missions: All the missions materialized, one per alternative tour.
+    * error: Explanation of the failure for failed jobs.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    status = ndb.StringProperty(choices=[PENDING, RUNNING, DONE, FAILED],
+                                default=PENDING)
+    start_location = ndb.GeoPtProperty(required=True)
+    end_location = ndb.GeoPtProperty(required=True)
+    alternatives = ndb.IntegerProperty(default=1)
+    mission = ndb.KeyProperty(kind='Mission')
+    missions = ndb.KeyProperty(kind='Mission', repeated=True)
+    error = ndb.StringProperty(indexed=False)
+    created_on = ndb.DateTimeProperty(auto_now_add=True)
+    updated_on = ndb.DateTimeProperty(auto_now=True)
+
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    def finish(self, mission_keys):
+        self.status = self.DONE
+        self.mission = mission_keys[0] if mission_keys else None
+        self.missions = mission_keys
+        self.put()
+
+    def fail(self, error):
+        self.status = self.FAILED
+        self.error = error
+        self.put()
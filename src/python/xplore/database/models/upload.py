@@ -0,0 +1,194 @@
+from google.appengine.ext import ndb
+import datetime
+import uuid
+
+from . import GenericModel
+from xplore.utils import gcs
+
+
+__all__ = ['UploadChunk', 'UploadSession', 'UploadedFile']
+
+class UploadChunk(GenericModel):
+    """Piece of a resumable upload, child of its UploadSession and keyed by
+    its offset in the file.
+    """
+    data = ndb.BlobProperty(required=True)
+
+
+class UploadedFile(GenericModel):
+    """Record of a file assembled from a resumable upload, keyed by its blob
+    key. Assembled files have no BlobInfo and outlive their session, the
+    records tell they exist without reading them from GCS.
+    """
+    created_on = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_for(cls, blob_key):
+        return ndb.Key(cls, str(blob_key))
+
+    @classmethod
+    def recorded(cls, blob_keys):
+        """Return the set of the given blob keys that are recorded, with a
+        single batch get.
+        """
+        records = ndb.get_multi([cls.key_for(blob_key)
+                                 for blob_key in blob_keys])
+        return set(blob_key for blob_key, record in zip(blob_keys, records)
+                   if record is not None)
+
+
+class UploadSession(GenericModel):
+    """Resumable upload of an image in chunks. Chunks must be sent in order,
+    a client that lost track of an upload asks for the received size and
+    continues from there. Once complete, the chunks are assembled in a GCS
+    file whose blob key is kept in the session, so finishing an upload
+    again returns the same image. The blob key is recorded in an
+    UploadedFile too. Sessions are deleted with their chunks by a periodic
+    task once expired.
+
+    Sessions are keyed by a random id, which is the only credential needed
+    to continue an upload.
+
+    Properties:
+    * size: Declared size in bytes of the complete file.
+    * received: Number of bytes received so far.
+    * content_type: Declared MIME type of the file.
+    * status: uploading while chunks are received, assembling while the GCS
+        file is written and done once its blob key is stored.
+    * blob_key: Blob key of the assembled file, once done.
+    """
+    UPLOADING = 'uploading'
+    ASSEMBLING = 'assembling'
+    DONE = 'done'
+
+    # Larger chunks would not fit in a datastore entity
+    MAX_CHUNK_SIZE = 512 * 1024
+    # Sessions are deleted this long after they were started
+    EXPIRATION = datetime.timedelta(days=1)
+    # Folder of the bucket with the assembled files
+    GCS_FOLDER = 'uploads'
+
+    size = ndb.IntegerProperty(required=True, indexed=False)
+    received = ndb.IntegerProperty(default=0, indexed=False)
+    content_type = ndb.StringProperty(required=True, indexed=False)
+    created_on = ndb.DateTimeProperty(auto_now_add=True)
+    status = ndb.StringProperty(choices=[UPLOADING, ASSEMBLING, DONE],
+                                default=UPLOADING, indexed=False)
+    blob_key = ndb.BlobKeyProperty(indexed=False)
+
+    @classmethod
+    def start(cls, size, content_type):
+        session = cls(id=uuid.uuid4().hex, size=size,
+                      content_type=content_type)
+        session.put()
+        return session
+
+    @classmethod
+    def query_expired(cls, now=None):
+        """Query the sessions started before the expiration period."""
+        now = now or datetime.datetime.now()
+        return cls.query(cls.created_on < now - cls.EXPIRATION)
+
+    def is_complete(self):
+        return self.received == self.size
+
+    def gcs_file_name(self):
+        """GCS file where the upload is assembled, fixed per session so an
+        interrupted assembly is simply written again.
+        """
+        return gcs.file_name(self.GCS_FOLDER, self.key.id())
+
+    @ndb.transactional
+    def append(self, offset, data):
+        """Store a chunk of the file starting at offset. Chunks that were
+        already received are ignored, so resending the last chunk after a
+        lost response is harmless.
+
+        Returns:
+            The number of bytes received so far.
+
+        Raises:
+            ValueError: If the chunk does not continue the received data or
+                exceeds the declared size.
+        """
+        session = self.key.get()
+        if offset + len(data) <= session.received:
+            return session.received
+        if offset != session.received:
+            raise ValueError('Expected a chunk at offset %d.' %
+                             session.received)
+        if offset + len(data) > session.size:
+            raise ValueError('The chunk exceeds the declared size.')
+        session.received += len(data)
+        ndb.put_multi([session, UploadChunk(parent=session.key, id=offset + 1,
+                                            data=data)])
+        self.received = session.received
+        return session.received
+
+    @ndb.transactional
+    def _begin_assembly(self):
+        session = self.key.get()
+        if session.status == self.UPLOADING:
+            if not session.is_complete():
+                raise ValueError('The upload is not complete.')
+            session.status = self.ASSEMBLING
+            session.put()
+        return session
+
+    @ndb.transactional(xg=True)
+    def _finish_assembly(self, blob_key):
+        session = self.key.get()
+        if session.status != self.DONE:
+            session.status = self.DONE
+            session.blob_key = blob_key
+            ndb.put_multi([session,
+                           UploadedFile(key=UploadedFile.key_for(blob_key))])
+        return session
+
+    def _chunk_keys(self):
+        return UploadChunk.query(ancestor=self.key).fetch(keys_only=True)
+
+    def assemble(self):
+        """Concatenate the chunks of a complete upload in a GCS file. It
+        can be called again, concurrently too, and always returns the same
+        file. The chunks are kept until the session expires, so a concurrent
+        assembly still writes the complete file.
+
+        Returns:
+            The blob key of the assembled file.
+
+        Raises:
+            ValueError: If the upload is not complete.
+        """
+        session = self._begin_assembly()
+        if session.status == self.DONE:
+            return session.blob_key
+        chunk_keys = self._chunk_keys()
+        chunk_keys.sort(key=lambda key: key.id())
+        gcs_file_name = self.gcs_file_name()
+        with gcs.open_file(gcs_file_name, self.content_type) as gcs_file:
+            # Chunks are read in small groups to bound the memory used
+            for i in xrange(0, len(chunk_keys), 8):
+                for chunk in ndb.get_multi(chunk_keys[i:i + 8]):
+                    gcs_file.write(chunk.data)
+        return self._finish_assembly(gcs.get_blob_key(gcs_file_name)).blob_key
+
+    @classmethod
+    def delete_expired(cls, batch_size=20):
+        """Delete a batch of expired sessions with their chunks. The GCS file
+        of an assembly that never finished is deleted too, assembled files
+        are kept since they belong to the uploader.
+
+        Returns:
+            A (deleted, more) pair with the number of sessions deleted and
+            whether there may be more expired ones.
+        """
+        sessions = cls.query_expired().fetch(batch_size)
+        keys = []
+        for session in sessions:
+            keys.extend(session._chunk_keys())
+            keys.append(session.key)
+            if session.status == cls.ASSEMBLING:
+                gcs.delete_file(session.gcs_file_name())
+        ndb.delete_multi(keys)
+        return len(sessions), len(sessions) == batch_size
@@ -0,0 +1,110 @@
+'''
+Module with the pagination helpers for collection resources.
+
+Pages expose an opaque cursor token for the next page. Datastore queries use
+datastore cursors, while results computed in memory, e.g. geo queries, use
+offsets. Clients must treat both as opaque strings.
+'''
+import base64
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+
+from xplore.database.errors import InvalidCursorError
+
+
+_QUERY_CURSOR = 'q'
+_OFFSET_CURSOR = 'o'
+
+
+def _encode(cursor_type, value):
+    return base64.urlsafe_b64encode('%s:%s' % (cursor_type, value))
+
+
+def _decode(token, cursor_type):
+    try:
+        decoded_type, value = base64.urlsafe_b64decode(
+            str(token)).split(':', 1)
+    except (TypeError, ValueError):
+        raise InvalidCursorError()
+    if decoded_type != cursor_type:
+        raise InvalidCursorError()
+    return value
+
+
+def decode_offset(token):
+    '''
+    Return the offset encoded in a cursor for in-memory results, 0 if no
+    cursor is given.
+    '''
+    if not token:
+        return 0
+    try:
+        offset = int(_decode(token, _OFFSET_CURSOR))
+    except ValueError:
+        raise InvalidCursorError()
+    if offset < 0:
+        raise InvalidCursorError()
+    return offset
+
+
+class QueryPage(object):
+    '''
+    Iterable over a page of results from a datastore query. Entities are
+    fetched lazily in batches while iterating, the cursor for the next page
+    is available once the page is exhausted.
+    '''
+
+    def __init__(self, query, page_size, token=None, batch_size=None):
+        start_cursor = None
+        if token:
+            try:
+                start_cursor = Cursor(urlsafe=_decode(token, _QUERY_CURSOR))
+            except datastore_errors.BadValueError:
+                raise InvalidCursorError()
+        self._iterator = query.iter(limit=page_size,
+                                    start_cursor=start_cursor,
+                                    produce_cursors=True,
+                                    batch_size=batch_size)
+        self._page_size = page_size
+        self._count = 0
+
+    def __iter__(self):
+        for entity in self._iterator:
+            self._count += 1
+            yield entity
+
+    def next_cursor(self):
+        '''
+        Return the token for the next page, or None if this is the last one.
+        Since the page is fetched lazily, a full last page still returns a
+        token for a next page which is empty.
+        '''
+        if self._count < self._page_size:
+            return None
+        return _encode(_QUERY_CURSOR, self._iterator.cursor_after().urlsafe())
+
+
+class ListPage(object):
+    '''
+    Iterable over a page of results computed in memory. The given results
+    must start at the first element of the collection and should include at
+    least one element past the page, so it is known if there are more pages.
+    '''
+
+    def __init__(self, results, page_size, token=None):
+        self._offset = decode_offset(token)
+        self._page_size = page_size
+        self._results = results[self._offset:self._offset + page_size]
+        self._has_next = len(results) > self._offset + page_size
+
+    def __iter__(self):
+        return iter(self._results)
+
+    def next_cursor(self):
+        '''Return the token for the next page, or None if this is the last
+        one.
+        '''
+        if not self._has_next:
+            return None
+        return _encode(_OFFSET_CURSOR, self._offset + self._page_size)
@@ -0,0 +1,115 @@
+'''
+Module that defines a memcache cache of candidates for proximity queries.
+
+Queries from users standing around the same spot only differ in the last
+decimals of their center. The center is snapped to a geocell whose size
+follows the query radius, and the radius is rounded up to a power of two
+class. The cached candidates for a cell and radius class are the entities
+that may be within that radius of any point of the cell, so every query
+snapped to them is answered by filtering and sorting the candidates by exact
+distance. Entries are versioned with the generation counter of the model.
+'''
+import math
+
+from google.appengine.api import memcache
+
+import geocell
+from geotypes import Point
+from xplore.utils import geo
+from xplore.utils.cache import HitCounter
+
+
+_MEMCACHE_PREFIX = 'proximity:'
+# Smallest radius class in meters
+_MIN_RADIUS = 100
+# Latitude span in meters of the whole geocell grid, each resolution splits
+# the cells of the previous one in a 4x4 grid.
+_CELL_SPAN = geo.EARTH_RADIUS * math.pi
+_GRID_SIZE = 4
+
+
+def radius_class(max_distance):
+    '''
+    Round the radius up to the next power of two multiple of _MIN_RADIUS.
+    '''
+    classes = math.ceil(math.log(max(max_distance, _MIN_RADIUS) /
+                                 _MIN_RADIUS, 2))
+    return int(_MIN_RADIUS * 2 ** classes)
+
+
+def cell_resolution(radius):
+    '''
+    Return the finest geocell resolution whose cells are at least as tall as
+    the radius, so the candidate box spans only a few radii.
+    '''
+    resolution = int(math.log(_CELL_SPAN / radius, _GRID_SIZE))
+    return max(1, min(resolution, geocell.MAX_GEOCELL_RESOLUTION))
+
+
+class ProximityCache(object):
+    '''
+    Cache of proximity query candidates for a geolocated model.
+
+    Attributes:
+        model_class: Model class queried, it must track its generation.
+        fetch_box: Function that receives north, east, south, west and
+            max_results and returns the (lat, lon, key) entries of the
+            entities inside the box.
+        max_candidates: Maximum number of candidates cached for a cell,
+            queries over denser areas are left to the caller.
+    '''
+
+    def __init__(self, model_class, fetch_box, max_candidates=2000):
+        self.model_class = model_class
+        self.fetch_box = fetch_box
+        self.max_candidates = max_candidates
+        self.counter = HitCounter('proximity-' + model_class._get_kind())
+
+    def _candidates(self, generation, lat, lon, max_distance):
+        '''
+        Return the candidate entries for the snapped query, None if there are
+        too many of them to cache.
+        '''
+        radius = radius_class(max_distance)
+        cell = geocell.compute(Point(lat, lon), cell_resolution(radius))
+        cache_key = '%s%s:%d:%s:%d' % (_MEMCACHE_PREFIX,
+                                       self.model_class._get_kind(),
+                                       generation, cell, radius)
+        candidates = memcache.get(cache_key)
+        if candidates is not None:
+            self.counter.hit()
+            return candidates
+        self.counter.miss()
+        box = geocell.compute_box(cell)
+        candidates = self.fetch_box(*geo.expand_box(box.north, box.east,
+                                                    box.south, box.west,
+                                                    radius),
+                                    max_results=self.max_candidates + 1)
+        if len(candidates) > self.max_candidates:
+            return None
+        memcache.set(cache_key, candidates)
+        return candidates
+
+    def query_near(self, lat, lon, max_results, max_distance):
+        '''
+        Return the keys of the entities within max_distance meters of the
+        center sorted by distance.
+
+        Returns:
+            The list of keys, or None if the cache can not answer the query
+            because memcache is unavailable, max_distance is not limited or
+            the area is too dense.
+        '''
+        if max_distance <= 0:
+            return None
+        generation = self.model_class.generation()
+        if generation is None:
+            return None
+        candidates = self._candidates(generation, lat, lon, max_distance)
+        if candidates is None:
+            return None
+        ranked = geo.nearest(lat, lon,
+                             [entry[0] for entry in candidates],
+                             [entry[1] for entry in candidates],
+                             max_results, max_distance)
+        return [candidates[index][2] for index in ranked]
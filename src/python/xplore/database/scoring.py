@@ -0,0 +1,370 @@
+'''
+Module that scores user submissions against the image of their waypoint.
+
+The reference image of every waypoint is reduced once to a perceptual hash
+stored in the waypoint, so by default a submission is scored by hashing its
+own image and comparing both hashes. Waypoints are hashed in batches in the
+background after their image is set, which also flags duplicated images. The
+hashes are stored transactionally and only for waypoints whose image did not
+change meanwhile.
+
+Every new submission is scored by a task that is given its key, submissions
+given together are scored with a pool of threads since the work is dominated
+by blobstore, urlfetch and images service calls. Only submissions that are
+still pending, those with the default score of -1, are scored and each score
+is stored transactionally, so a duplicated task has no effect. Submissions
+that score below the minimum are deleted together with their images and
+those that keep failing are given a terminal score of -2.
+
+The scorer is pluggable, settings can be overriden in appengine_config.py
+with the xplore_ prefix:
+
+* SUBMISSION_SCORER: Function that receives the image data of a submission
+    and of its waypoint and returns a similarity score between 0 and 1, e.g.
+    histogram_score. None compares the image hashes.
+* SUBMISSION_MIN_SCORE: Submissions scoring below it with the configured
+    scorer are deleted.
+* SUBMISSION_MIN_HASH_SCORE: Submissions whose image hash is less similar to
+    the one of their waypoint are deleted. Unrelated images already share
+    about half of the hash bits, so it is much higher than the minimum score
+    of the histogram scorer.
+'''
+from google.appengine.api import images, lib_config, urlfetch
+from google.appengine.ext import blobstore, ndb
+import logging
+import Queue
+import threading
+
+from xplore.database.models import MissionWaypoint, UserSubmission
+from xplore.utils import imagehash
+
+
+config = lib_config.register('xplore', {
+    'SUBMISSION_SCORER': None,
+    'SUBMISSION_MIN_SCORE': 0.3,
+    'SUBMISSION_MIN_HASH_SCORE': 0.8})
+
+# Submissions scored by a batch and threads scoring them concurrently.
+BATCH_SIZE = 50
+_WORKERS = 10
+
+
+def histogram_score(image_data, reference_data):
+    '''
+    Default scorer, the intersection of the normalized color histograms of
+    both images averaged over the RGB channels.
+    '''
+    score = 0.0
+    for channel, reference_channel in zip(images.histogram(image_data),
+                                          images.histogram(reference_data)):
+        total = float(sum(channel))
+        reference_total = float(sum(reference_channel))
+        if not total or not reference_total:
+            continue
+        score += sum(min(count / total, reference_count / reference_total)
+                     for count, reference_count in zip(channel,
+                                                       reference_channel))
+    return score / 3
+
+
+def get_scorer():
+    '''Return the configured scorer, None to compare image hashes.'''
+    return config.SUBMISSION_SCORER
+
+
+def get_min_score(scorer):
+    '''Return the minimum score of the submissions scored by the scorer.'''
+    if scorer is None:
+        return config.SUBMISSION_MIN_HASH_SCORE
+    return config.SUBMISSION_MIN_SCORE
+
+
+def read_blob(blob_key):
+    return blobstore.BlobReader(blob_key).read()
+
+
+def read_waypoint_image(waypoint):
+    '''
+    Read the image data of a waypoint, from the blobstore or from its image
+    URL.
+    '''
+    if waypoint.image is not None:
+        return read_blob(waypoint.image)
+    response = urlfetch.fetch(waypoint.image_url, deadline=30)
+    if response.status_code != 200:
+        raise IOError('The image of waypoint %s could not be fetched.' %
+                      waypoint.name)
+    return response.content
+
+
+def map_concurrently(function, items, workers):
+    '''
+    Apply the function to every item with a pool of threads, the results are
+    returned in the order of the items.
+    '''
+    results = [None] * len(items)
+    indices = Queue.Queue()
+    for index in xrange(len(items)):
+        indices.put(index)
+
+    def work():
+        while True:
+            try:
+                index = indices.get_nowait()
+            except Queue.Empty:
+                return
+            results[index] = function(items[index])
+
+    threads = [threading.Thread(target=work)
+               for _ in xrange(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def hash_image(image_data):
+    '''Hash an image, an empty hash if it can not be decoded.'''
+    try:
+        return imagehash.dhash(image_data)
+    except IOError:
+        return ''
+
+
+def index_waypoint_images(waypoints, workers=_WORKERS):
+    '''
+    Compute the image hash of the given waypoints concurrently and flag those
+    whose hash is already used by another waypoint. The waypoints are not
+    stored. Only images that can not be decoded get the empty hash, those
+    that can not be read, e.g. after a fetch timeout, are left pending with
+    a None hash so they are retried.
+
+    Returns:
+        The given list of waypoints.
+    '''
+    def index(waypoint):
+        try:
+            image_data = read_waypoint_image(waypoint)
+        except Exception:
+            logging.exception('The image of waypoint %s could not be read.',
+                              waypoint.name)
+            return None
+        return hash_image(image_data)
+
+    for waypoint, image_hash in zip(waypoints,
+                                    map_concurrently(index, waypoints,
+                                                     workers)):
+        waypoint.image_hash = image_hash
+        waypoint.duplicate_of = None
+
+    keys_by_hash = MissionWaypoint.get_keys_by_image_hash(
+        [waypoint.image_hash for waypoint in waypoints
+         if waypoint.image_hash])
+    for waypoint in waypoints:
+        if not waypoint.image_hash:
+            continue
+        keys = keys_by_hash.setdefault(waypoint.image_hash, [])
+        others = [key for key in keys if key != waypoint.key]
+        if others:
+            waypoint.duplicate_of = others[0]
+            logging.warning('Waypoint %s has the same image as %s.',
+                            waypoint.name, others[0])
+        if waypoint.key not in keys:
+            keys.append(waypoint.key)
+    return waypoints
+
+
+@ndb.transactional
+def store_image_hashes(waypoints):
+    '''
+    Store the image hash and duplicate flag computed for the given
+    waypoints, which share the default ancestor. Each waypoint is read again
+    and only those two fields are set, and only if its image is unchanged,
+    so concurrent edits of the waypoints are not overwritten. Waypoints
+    whose hash is still pending are skipped.
+
+    Returns:
+        The number of waypoints updated.
+    '''
+    updated = []
+    waypoints = [waypoint for waypoint in waypoints
+                 if waypoint.image_hash is not None]
+    for waypoint, latest in zip(waypoints, ndb.get_multi(
+            [waypoint.key for waypoint in waypoints])):
+        if latest is None or latest.image != waypoint.image or \
+                latest.image_url != waypoint.image_url:
+            continue
+        latest.image_hash = waypoint.image_hash
+        latest.duplicate_of = waypoint.duplicate_of
+        updated.append(latest)
+    MissionWaypoint.put_multi_untracked(updated)
+    return len(updated)
+
+
+def index_waypoints(waypoint_keys, workers=_WORKERS):
+    '''
+    Compute and store the image hash of the given waypoints whose hash is
+    still pending, the others are skipped so a duplicated task has nothing
+    left to do.
+
+    Returns:
+        A (hashed, pending) pair with the number of waypoints hashed and the
+        keys of those left pending because their image could not be read.
+    '''
+    waypoints = [waypoint for waypoint in ndb.get_multi(waypoint_keys)
+                 if waypoint is not None and waypoint.image_hash is None]
+    hashed = store_image_hashes(index_waypoint_images(waypoints, workers))
+    return hashed, [waypoint.key for waypoint in waypoints
+                    if waypoint.image_hash is None]
+
+
+def index_pending_waypoints(batch_size=BATCH_SIZE, workers=_WORKERS):
+    '''
+    Compute and store the image hash of a batch of waypoints whose hash is
+    pending. Waypoints whose image changed meanwhile or could not be read
+    are left pending.
+
+    Returns:
+        A (hashed, more) pair with the number of waypoints hashed and whether
+        there may be more pending ones, which is never the case for a batch
+        that could not hash any.
+    '''
+    waypoints = MissionWaypoint.query_pending_hash().fetch(batch_size)
+    hashed = store_image_hashes(index_waypoint_images(waypoints, workers))
+    return hashed, hashed > 0 and len(waypoints) == batch_size
+
+
+@ndb.transactional
+def _store_score(submission_key, submission_score):
+    '''
+    Store the score of a submission if it is still pending.
+
+    Returns:
+        True if the score was stored, False if the submission was gone or
+        already scored.
+    '''
+    submission = submission_key.get()
+    if submission is None or not submission.is_pending():
+        return False
+    submission.score = submission_score
+    submission.put()
+    return True
+
+
+@ndb.transactional
+def _mark_unscorable(submission_key):
+    submission = submission_key.get()
+    if submission is not None and submission.is_pending():
+        submission.score = UserSubmission.UNSCORABLE_SCORE
+        submission.put()
+
+
+def mark_unscorable(submission_keys):
+    '''
+    Give the terminal unscorable score to the given submissions that are
+    still pending.
+    '''
+    for submission_key in submission_keys:
+        _mark_unscorable(submission_key)
+
+
+def score_submissions(submission_keys, workers=_WORKERS, scorer=None):
+    '''
+    Score the given submissions with the given scorer, the configured one by
+    default. Without a scorer the image hash of the submission is compared
+    with the one of its waypoint, which is computed here if it is still
+    pending. Submissions that are gone or no longer pending are skipped and
+    those that can not be scored are left pending. Scores are stored in a
+    transaction per submission that checks it is still pending, those below
+    the minimum score are deleted instead with a single batch delete, images
+    included.
+
+    Returns:
+        A (scored, failed) pair with the number of submissions scored and
+        the keys of the submissions that could not be scored.
+    '''
+    submissions = [submission for submission
+                   in ndb.get_multi(submission_keys)
+                   if submission is not None and submission.is_pending()]
+    if not submissions:
+        return 0, []
+    waypoint_keys = list(set(submission.waypoint
+                             for submission in submissions))
+    waypoints = dict(zip(waypoint_keys, ndb.get_multi(waypoint_keys)))
+    references = {}
+    scorer = scorer or get_scorer()
+
+    def score(submission):
+        waypoint = waypoints[submission.waypoint]
+        if waypoint is None:
+            # The waypoint is gone, nothing to compare against
+            return submission, 0.0
+        try:
+            if scorer is None:
+                if waypoint.image_hash is None:
+                    waypoint.image_hash = hash_image(
+                        read_waypoint_image(waypoint))
+                if not waypoint.image_hash:
+                    raise IOError('The image of waypoint %s can not be '
+                                  'decoded.' % waypoint.name)
+                submission_hash = hash_image(read_blob(submission.image))
+                if not submission_hash:
+                    return submission, 0.0
+                return submission, imagehash.similarity(submission_hash,
+                                                        waypoint.image_hash)
+            if waypoint.key not in references:
+                references[waypoint.key] = read_waypoint_image(waypoint)
+            return submission, float(scorer(read_blob(submission.image),
+                                            references[waypoint.key]))
+        except Exception:
+            logging.exception('Submission %s could not be scored.',
+                              submission.key.urlsafe())
+            return submission, None
+
+    min_score = get_min_score(scorer)
+    scored = 0
+    failed = []
+    rejected = []
+    for submission, submission_score in map_concurrently(score, submissions,
+                                                         workers):
+        if submission_score is None:
+            failed.append(submission.key)
+        elif submission_score < min_score:
+            rejected.append(submission.key)
+        elif _store_score(submission.key, submission_score):
+            scored += 1
+
+    # Rejected submissions still pending are deleted with a single batch
+    # delete, images included. A duplicated task deleting them too does no
+    # harm since their score is the same.
+    rejected = [submission for submission in ndb.get_multi(rejected)
+                if submission is not None and submission.is_pending()]
+    if rejected:
+        futures = ndb.delete_multi_async([submission.key
+                                          for submission in rejected])
+        blobstore.delete([submission.image for submission in rejected])
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+    return scored + len(rejected), failed
+
+
+def score_pending_submissions(batch_size=BATCH_SIZE, workers=_WORKERS,
+                              scorer=None):
+    '''
+    Score a batch of the pending submissions found by a query, e.g. those
+    created before they were scored by key. The query is eventually
+    consistent, so it may miss recent submissions or return some already
+    scored, which are skipped. Submissions that can not be scored are marked
+    unscorable right away so the batches always make progress.
+
+    Returns:
+        A (scored, more) pair with the number of submissions scored and
+        whether there may be more pending ones.
+    '''
+    submission_keys = UserSubmission.query_pending().fetch(batch_size,
+                                                          keys_only=True)
+    scored, failed = score_submissions(submission_keys, workers, scorer)
+    mark_unscorable(failed)
+    return scored, len(submission_keys) == batch_size
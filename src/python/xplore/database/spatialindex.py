@@ -0,0 +1,156 @@
+'''
+Module that defines an in-process spatial index for geolocated models.
+
+The index is a grid of fixed-size cells holding the key and coordinates of
+every entity of a model. It is built lazily from the datastore and kept in
+the memory of the instance, its freshness is checked against the generation
+counter of the model kind in memcache which is bumped on every write.
+'''
+import math
+import numpy
+import threading
+
+from google.appengine.ext import ndb
+
+from xplore.utils import geo
+
+
+class _Grid(object):
+    '''
+    Immutable grid of buckets built from a list of (lat, lon, key) entries.
+    The coordinates are also packed in arrays for the vectorized distance
+    ranking. Queries return entity keys, the caller is responsible of
+    fetching the entities.
+    '''
+
+    def __init__(self, entries, cell_size):
+        self.cell_size = cell_size
+        self.entries = entries
+        self.latitudes = numpy.array([entry[0] for entry in entries],
+                                     dtype=float)
+        self.longitudes = numpy.array([entry[1] for entry in entries],
+                                      dtype=float)
+        self.buckets = {}
+        for index, entry in enumerate(entries):
+            self.buckets.setdefault(self._cell(entry[0], entry[1]),
+                                    []).append(index)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)))
+
+    def _candidates(self, north, east, south, west):
+        '''
+        Return the indices of the entries in the cells overlapping the given
+        box, these must still be checked against the exact box. None stands
+        for all the entries.
+        '''
+        south_row, west_col = self._cell(south, west)
+        north_row, east_col = self._cell(north, east)
+        if west_col > east_col:
+            # The box crosses the antimeridian
+            col_ranges = [(west_col, self._cell(0, 180)[1]),
+                          (self._cell(0, -180)[1], east_col)]
+        else:
+            col_ranges = [(west_col, east_col)]
+        cell_count = (north_row - south_row + 1) * \
+            sum(last - first + 1 for first, last in col_ranges)
+        if cell_count >= len(self.buckets):
+            return None
+        candidates = []
+        for row in xrange(south_row, north_row + 1):
+            for first, last in col_ranges:
+                for col in xrange(first, last + 1):
+                    candidates.extend(self.buckets.get((row, col), ()))
+        return candidates
+
+    def query_near(self, lat, lon, max_results, max_distance=0):
+        '''
+        Return the keys of the entities closest to the given center sorted
+        by distance. A max_distance of 0 does not limit the distance.
+        '''
+        candidates = None
+        if max_distance > 0:
+            candidates = self._candidates(*geo.bounding_box(lat, lon,
+                                                            max_distance))
+        if candidates is None:
+            ranked = geo.nearest(lat, lon, self.latitudes, self.longitudes,
+                                 max_results, max_distance)
+            return [self.entries[index][2] for index in ranked]
+        candidates = numpy.array(candidates, dtype=int)
+        ranked = geo.nearest(lat, lon, self.latitudes[candidates],
+                             self.longitudes[candidates],
+                             max_results, max_distance)
+        return [self.entries[candidates[index]][2] for index in ranked]
+
+    def query_box(self, north, east, south, west, max_results):
+        '''
+        Return the keys of the entities inside the given box.
+        '''
+        candidates = self._candidates(north, east, south, west)
+        if candidates is None:
+            candidates = xrange(len(self.entries))
+        results = []
+        for index in candidates:
+            entry = self.entries[index]
+            if geo.in_box(entry[0], entry[1], north, east, south, west):
+                results.append(entry[2])
+                if len(results) >= max_results:
+                    break
+        return results
+
+
+class SpatialIndex(object):
+    '''
+    Lazily built grid index over the location property of a GeoModel
+    subclass.
+
+    Attributes:
+        model_class: Model class indexed, it must track its generation.
+        cell_size: Size of the grid cells in degrees.
+        max_entries: Maximum number of entities to keep in memory, if the
+            kind grows beyond it the index stays cold.
+    '''
+
+    def __init__(self, model_class, cell_size=0.01, max_entries=20000):
+        self.model_class = model_class
+        self.cell_size = cell_size
+        self.max_entries = max_entries
+        self._grid = None
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        entities = self.model_class.get_all(self.max_entries + 1)
+        if len(entities) > self.max_entries:
+            return None
+        entries = [(entity.location.lat, entity.location.lon, entity.key)
+                   for entity in entities]
+        return _Grid(entries, self.cell_size)
+
+    def grid(self):
+        '''
+        Return a grid that reflects the current generation of the model
+        kind, rebuilding it first if it is stale.
+
+        Returns:
+            The grid to query, or None if the index is cold, i.e. memcache is
+            unavailable or the kind has too many entities.
+        '''
+        generation = self.model_class.generation()
+        if generation is None:
+            return None
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    self._grid = self._build()
+                    self._generation = generation
+        return self._grid
+
+
+def fetch_entities(keys):
+    '''
+    Fetch the entities for the keys returned by an index query, dropping
+    those that were deleted since the index was built.
+    '''
+    return [entity for entity in ndb.get_multi(keys) if entity is not None]
@@ -0,0 +1,185 @@
+'''
+Module that pre-generates a fixed ladder of sizes for the waypoint images.
+
+Every waypoint image, uploaded to the blobstore or referenced by image_url,
+is read once and resized to each step of the ladder with the images service.
+The resized images are stored in GCS and recorded in the waypoint
+together with their serving URLs, so serializing a waypoint picks the closest
+size without calling any service and URL sourced images are no longer served
+at full size. Steps larger than the original image are not generated, the
+original size is used instead.
+
+The ladder can be overriden in appengine_config.py with the xplore_ prefix:
+
+* IMAGE_LADDER: List of (name, size) pairs, the size is the longest edge in
+    pixels.
+'''
+from google.appengine.api import images, lib_config
+from google.appengine.ext import ndb
+import logging
+
+from xplore.database.models import ImageVariant, MissionWaypoint
+from xplore.database.models.missionwaypoint import delete_variants
+from xplore.database.scoring import map_concurrently, read_waypoint_image
+from xplore.utils import gcs
+
+
+config = lib_config.register('xplore', {
+    'IMAGE_LADDER': [('thumbnail', 100), ('list', 400), ('full', 1600)]})
+
+# Waypoints processed by a batch and threads processing them concurrently,
+# kept low since every thread holds a full image in memory.
+BATCH_SIZE = 10
+_WORKERS = 4
+# Folder of the bucket with the image variants
+_GCS_FOLDER = 'variants'
+
+
+def write_blob(data, mime_type):
+    '''Store the data in a new GCS file and return its blob key.'''
+    return gcs.write_blob(data, mime_type, _GCS_FOLDER)
+
+
+def resize_image(image_data, ladder=None):
+    '''
+    Resize an image to every step of the ladder, steps that would enlarge the
+    image are replaced by the original size.
+
+    Returns:
+        A list of (name, size, data) tuples with the JPEG encoded images.
+
+    Raises:
+        images.Error: If the image can not be decoded.
+    '''
+    image = images.Image(image_data=image_data)
+    longest_edge = max(image.width, image.height)
+    results = []
+    for name, size in ladder or config.IMAGE_LADDER:
+        size = min(size, longest_edge)
+        if results and results[-1][1] == size:
+            continue
+        results.append((name, size,
+                        images.resize(image_data, size, size,
+                                      output_encoding=images.JPEG,
+                                      quality=85)))
+    return results
+
+
+def generate_variants(waypoint):
+    '''
+    Generate and store the image variants of a waypoint, the waypoint itself
+    is not modified.
+
+    Returns:
+        The list of ImageVariant, empty if the waypoint has no image or it
+        can not be decoded.
+    '''
+    if waypoint.image is None and waypoint.image_url is None:
+        return []
+    try:
+        resized = resize_image(read_waypoint_image(waypoint))
+    except images.Error:
+        logging.warning('The image of waypoint %s can not be decoded.',
+                        waypoint.name)
+        return []
+    blob_keys = [write_blob(data, 'image/jpeg') for _, _, data in resized]
+    rpcs = [images.get_serving_url_async(blob_key) for blob_key in blob_keys]
+    return [ImageVariant(name=name, size=size, image=blob_key,
+                         serving_url='%s=s%d' % (rpc.get_result(), size))
+            for (name, size, _), blob_key, rpc in zip(resized, blob_keys,
+                                                      rpcs)]
+
+
+def _generate_all(waypoints, workers):
+    '''
+    Generate the image variants of the given waypoints concurrently, None
+    for the waypoints that failed.
+    '''
+    def generate(waypoint):
+        try:
+            return generate_variants(waypoint)
+        except Exception:
+            logging.exception('The image variants of waypoint %s could not '
+                              'be generated.', waypoint.name)
+            return None
+
+    return map_concurrently(generate, waypoints, workers)
+
+
+@ndb.transactional
+def _store_variants(generated):
+    '''
+    Store the variants generated for each waypoint, given as (waypoint,
+    variants) pairs, in the waypoints that still have the same image and
+    pending variants. Each waypoint is read again and only its variant
+    fields are set, so concurrent edits are not overwritten. The put is
+    tracked since the variants change the serialized waypoints.
+
+    Returns:
+        A (stored, stale) pair with the number of waypoints updated and the
+        variants that were not stored.
+    '''
+    stored = []
+    stale = []
+    for (waypoint, variants), latest in zip(generated, ndb.get_multi(
+            [waypoint.key for waypoint, _ in generated])):
+        if latest is not None and latest.variants_pending and \
+                latest.image == waypoint.image and \
+                latest.image_url == waypoint.image_url:
+            latest.image_variants = variants
+            latest.variants_pending = False
+            stored.append(latest)
+        else:
+            stale.extend(variants)
+    ndb.put_multi(stored)
+    return len(stored), stale
+
+
+def add_image_variants(waypoints, workers=_WORKERS):
+    '''
+    Generate and store the image variants of the given waypoints, which
+    share the default ancestor. Waypoints that fail are left pending and the
+    variants generated for waypoints whose image changed meanwhile are
+    deleted.
+
+    Returns:
+        A (stored, failed) pair with the number of waypoints whose variants
+        were stored and the keys of those that failed.
+    '''
+    generated = zip(waypoints, _generate_all(waypoints, workers))
+    stored, stale = _store_variants([(waypoint, variants)
+                                     for waypoint, variants in generated
+                                     if variants is not None])
+    delete_variants(stale)
+    return stored, [waypoint.key for waypoint, variants in generated
+                    if variants is None]
+
+
+def process_variants(waypoint_keys, workers=_WORKERS):
+    '''
+    Generate and store the image variants of the given waypoints whose
+    variants are still pending, the others are skipped so a duplicated task
+    has nothing left to do.
+
+    Returns:
+        A (stored, failed) pair as returned by add_image_variants.
+    '''
+    return add_image_variants([waypoint for waypoint
+                               in ndb.get_multi(waypoint_keys)
+                               if waypoint is not None and
+                               waypoint.variants_pending], workers)
+
+
+def process_pending_variants(batch_size=BATCH_SIZE, workers=_WORKERS):
+    '''
+    Generate and store the image variants of a batch of waypoints whose
+    variants are pending, see add_image_variants.
+
+    Returns:
+        A (processed, more) pair with the number of waypoints processed and
+        whether there may be more pending ones, which is never the case for
+        a batch that could not store any.
+    '''
+    waypoints = MissionWaypoint.query_pending_variants().fetch(batch_size)
+    stored, _ = add_image_variants(waypoints, workers)
+    return stored, stored > 0 and len(waypoints) == batch_size
@@ -1,7 +1,13 @@
+from google.appengine.ext import ndb
+
 from .models import Mission
 
-__all__ = ['get_missions_for_waypoint']
+__all__ = ['get_missions_for_waypoint', 'update_missions_for_waypoint']
 
 def get_missions_for_waypoint(waypoint_key):
-    container_missions = Mission.query_by_waypoint(waypoint_key)
-    return container_missions
\ No newline at end of file
+    container_missions = Mission.query_containing_waypoint(waypoint_key)
+    return container_missions
+
+def update_missions_for_waypoint(waypoint_key):
+    container_missions = Mission.query_containing_waypoint(waypoint_key)
+    ndb.put_multi(Mission.update_routes(container_missions))
@@ -5,10 +5,26 @@ Created on Jan 16, 2014
 
 @author: diegob
 '''
+from google.appengine.api import datastore_errors, memcache
+from google.appengine.ext import ndb
+import hashlib
 import json
 import webapp2
 
+from xplore.database.errors import InvalidCursorError
+from xplore.database.pagination import decode_offset
 from xplore.handler.base import BaseHandler
+from xplore.utils.cache import HitCounter
+from xplore.webutils import jsonstream
+
+
+# Maximum number of results returned in a single page of a collection.
+MAX_PAGE_SIZE = 500
+# Maximum number of entities created by a single batch request.
+MAX_BATCH_SIZE = 500
+
+_RESPONSE_CACHE_PREFIX = 'response:'
+_RESPONSE_CACHE_COUNTER = HitCounter('responses')
 
 
 class QueryType:
@@ -74,3 +90,130 @@ class BaseResource(BaseHandler):
         self.response.headers['content-type'] = 'application/json'
         self.response.status = status_code
         return
+
+    def results_window(self, qry_params):
+        '''
+        Return the number of results that an in-memory query must compute to
+        serve the requested page, including one more result to know if there
+        is a next page.
+        '''
+        try:
+            offset = decode_offset(qry_params['cursor'])
+        except InvalidCursorError:
+            self.abort(400, detail='Invalid cursor.')
+        return offset + qry_params['max_results'] + 1
+
+    def write_page(self, name, page, serialize_batch):
+        '''
+        Stream a page of a collection as the JSON response. The items are
+        written as an array under name, followed by the next_cursor token
+        which is null on the last page.
+        '''
+        self.build_base_response()
+        jsonstream.write_collection(
+            self.response.out, name, page, serialize_batch,
+            extra=lambda: {'next_cursor': page.next_cursor()})
+
+    def write_cached(self, models, render):
+        '''
+        Serve a GET response through the response cache in memcache. Cached
+        responses are versioned with the query parameters and the generation
+        counters of the given models, so any write to those models makes them
+        stale. The version is also sent as ETag, clients that send it back in
+        If-None-Match get a 304 without any datastore access.
+
+        The generations are read before rendering and writes bump them only
+        after they commit, so a cached response never holds data older than
+        its version. Responses rendered while a write committed are not
+        cached since they may mix both states.
+
+        Args:
+            models: Model classes whose entities the response is built from,
+                they must track their generation.
+            render: Function without arguments that writes the response, it
+                is only called on a cache miss.
+        '''
+        generations = [model.generation() for model in models]
+        if None in generations:
+            # Memcache is not available
+            render()
+            return
+        version = hashlib.sha1(json.dumps([self.request.path,
+                                           sorted(self.request.GET.items()),
+                                           generations])).hexdigest()
+        etag = '"%s"' % version
+        if_none_match = self.request.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            _RESPONSE_CACHE_COUNTER.hit()
+            self.response.status = 304
+            self.response.headers['ETag'] = etag
+            return
+
+        cache_key = _RESPONSE_CACHE_PREFIX + version
+        body = memcache.get(cache_key)
+        if body is not None:
+            _RESPONSE_CACHE_COUNTER.hit()
+            self.build_base_response()
+            self.response.out.write(body)
+        else:
+            _RESPONSE_CACHE_COUNTER.miss()
+            render()
+            body = self.response.body
+            if self.response.status_int == 200 and \
+                len(body) < memcache.MAX_VALUE_SIZE and \
+                [model.generation() for model in models] == generations:
+                memcache.set(cache_key, body)
+        self.response.headers['ETag'] = etag
+
+    def parse_batch(self, name):
+        '''
+        Parse the JSON body of a batch request, which holds the list of items
+        to create under name. The whole batch is rejected if the list is
+        missing, empty or longer than MAX_BATCH_SIZE.
+        '''
+        parameters = self.parse_request_body(urlencoded_accepted=False)
+        items = parameters.get(name) if isinstance(parameters, dict) else None
+        if not isinstance(items, list) or not items:
+            self.abort(400, detail='Missing required argument %s.' % name)
+        if len(items) > MAX_BATCH_SIZE:
+            self.abort(413, detail='At most %d %s are accepted in a batch.' %
+                       (MAX_BATCH_SIZE, name))
+        if not all(isinstance(item, dict) for item in items):
+            self.abort(400, detail='Bad value for param %s.' % name)
+        return items
+
+    @staticmethod
+    def batch_error(item, detail):
+        '''Build the result of a rejected batch item.'''
+        return {'name': item.get('name'), 'status': 400, 'detail': detail}
+
+    def write_batch(self, results, entities, route_name):
+        '''
+        Store the entities created from the accepted items of a batch with
+        parallel asynchronous puts and write the result of every item.
+
+        Args:
+            results: List with the result of every item of the batch, None
+                for the accepted ones. They are replaced by the outcome of
+                their put.
+            entities: Entities created from the accepted items, in the same
+                order.
+            route_name: Name of the route of a single entity, for the
+                content_url of the created ones.
+        '''
+        futures = ndb.put_multi_async(entities)
+        accepted = [index for index, result in enumerate(results)
+                    if result is None]
+        for index, entity, future in zip(accepted, entities, futures):
+            try:
+                future.get_result()
+            except datastore_errors.Error:
+                results[index] = {'name': entity.name, 'status': 500,
+                                  'detail': 'The entity could not be stored.'}
+                continue
+            results[index] = {'name': entity.name, 'status': 201,
+                              'content_url': self.uri_for(route_name,
+                                                          name=entity.name,
+                                                          _full=True)}
+        self.build_base_response()
+        self.response.out.write(json.dumps({'results': results}))
@@ -10,10 +10,29 @@ from google.appengine.ext.blobstore import create_upload_url
 from google.appengine.ext.webapp import blobstore_handlers
 import json
 
+from xplore.database.models import MissionWaypoint, UploadSession
+from xplore.handler.api.base_service import BaseResource
 from xplore.handler.auth import login_required
 from xplore.handler.base import BaseHandler
 
 
+# Largest image accepted by resumable uploads, in bytes.
+MAX_UPLOAD_SIZE = 32 * 1024 * 1024
+
+
+def write_image_key(response, blob_key):
+    '''
+    Write the response for an uploaded image, with its blob key and serving
+    URL.
+    '''
+    serving_url = get_serving_url(blob_key)
+    MissionWaypoint.remember_serving_url(blob_key, serving_url)
+    response.headers['Content-Type'] = 'application/json'
+    response_results = {'image_key' : str(blob_key),
+                        'image_url' : serving_url}
+    response.out.write(json.dumps(response_results))
+
+
 class ImageUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
     '''
     Simple upload handler that stores the given file in the blobstore
@@ -33,10 +52,7 @@ class ImageUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
             # TODO: Weird, react somehow
             pass
         blob_info = uploaded_images[0]
-        self.response.headers['Content-Type'] = 'application/json'
-        response_results = {'image_key' : str(blob_info.key()),
-                            'image_url' : get_serving_url(blob_info)}
-        self.response.out.write(json.dumps(response_results))
+        write_image_key(self.response, blob_info.key())
 
 class ImageUploadUrlProvider(BaseHandler):
     '''
@@ -55,3 +71,99 @@ class ImageUploadUrlProvider(BaseHandler):
         self.response.headers['Content-Type'] = 'application/json'
         response_results = {'upload_url' : upload_url}
         self.response.out.write(json.dumps(response_results))
+
+class ResumableUploadResource(BaseResource):
+    '''
+    Resource for uploading images in chunks, so that an interrupted upload
+    continues where it stopped instead of starting over. The flow is:
+
+    1. POST /api/uploads with the size and content_type of the image, it
+       answers with the upload_id and the maximum chunk_size.
+    2. PUT /api/uploads/<upload_id>?offset=<offset> with every chunk as raw
+       body, in order. After an error, GET /api/uploads/<upload_id> tells how
+       many bytes were received.
+    3. POST /api/uploads/<upload_id>/finish assembles the image and answers
+       with its image_key and image_url, like the blobstore upload flow.
+       Finishing again answers with the same image.
+
+    Sessions expire a day after they were started.
+    '''
+
+    @login_required(redirect = False)
+    def post(self):
+        '''
+        Start a resumable upload, the required arguments are:
+            - size: Size in bytes of the image.
+            - content_type: MIME type of the image.
+        '''
+        parameters = self.parse_request_body()
+        try:
+            size = int(parameters.get('size', 0))
+        except (TypeError, ValueError):
+            size = 0
+        content_type = parameters.get('content_type') or ''
+        if size <= 0 or size > MAX_UPLOAD_SIZE:
+            self.abort(400, detail='Bad value for param size.')
+        if not content_type.startswith('image/'):
+            self.abort(400, detail='Bad value for param content_type.')
+        session = UploadSession.start(size, content_type)
+        self.build_base_response(status_code=201)
+        response_results = {'upload_id' : session.key.id(),
+                            'chunk_size' : UploadSession.MAX_CHUNK_SIZE,
+                            'content_url' : self.uri_for(
+                                'uploads-resource-named',
+                                upload_id=session.key.id(), _full=True)}
+        self.response.out.write(json.dumps(response_results))
+
+    def get(self, upload_id):
+        '''
+        Report the progress of an upload, the next chunk must start at the
+        received offset.
+        '''
+        session = self.get_session(upload_id)
+        self.write_progress(session)
+
+    def put(self, upload_id):
+        '''
+        Append the raw request body to the upload, the offset argument must
+        match the number of bytes received so far. Chunks already received
+        are accepted and ignored.
+        '''
+        session = self.get_session(upload_id)
+        data = self.request.body
+        try:
+            offset = int(self.request.get('offset'))
+        except ValueError:
+            self.abort(400, detail='Bad value for param offset.')
+        if not data or len(data) > UploadSession.MAX_CHUNK_SIZE:
+            self.abort(400, detail='Chunks must have between 1 and %d bytes.' %
+                       UploadSession.MAX_CHUNK_SIZE)
+        try:
+            session.append(offset, data)
+        except ValueError as ex:
+            self.abort(409, detail=str(ex))
+        self.write_progress(session)
+
+    def finish(self, upload_id):
+        '''
+        Assemble a complete upload into an image stored in GCS.
+        '''
+        session = self.get_session(upload_id)
+        try:
+            blob_key = session.assemble()
+        except ValueError as ex:
+            self.abort(409, detail=str(ex))
+        write_image_key(self.response, blob_key)
+
+    def get_session(self, upload_id):
+        session = UploadSession.get_by_id(upload_id)
+        if session is None:
+            self.abort(404, detail='Specified upload does not exist.')
+        return session
+
+    def write_progress(self, session):
+        self.build_base_response()
+        self.response.out.write(json.dumps({'upload_id' : session.key.id(),
+                                            'size' : session.size,
+                                            'received' : session.received,
+                                            'status' : session.status}))
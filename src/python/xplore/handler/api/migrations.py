@@ -0,0 +1,43 @@
+'''
+Module that provides the resource for admins to start datastore migrations.
+'''
+import json
+
+from xplore.handler.api.base_service import BaseResource
+from xplore.handler.auth import login_required
+from xplore.handler.tasks.migrations import enqueue_image_hash_backfill, \
+    enqueue_image_variant_backfill, enqueue_mission_route_backfill, \
+    enqueue_name_key_migration, enqueue_progress_event_backfill
+
+
+class MigrationResource(BaseResource):
+    '''
+    Webapp2 handler that starts the datastore migrations, these run in the
+    background through the task queue.
+    '''
+
+    _MIGRATIONS = {'name-keys': enqueue_name_key_migration,
+                   'mission-routes': enqueue_mission_route_backfill,
+                   'progress-events': enqueue_progress_event_backfill,
+                   'image-hashes': enqueue_image_hash_backfill,
+                   'image-variants': enqueue_image_variant_backfill}
+
+    @login_required(redirect=False, admin_only=True)
+    def post(self, name):
+        '''
+        Provides the POST verb for the migrations resource. It starts the
+        migration with the given name, the supported ones are:
+
+        * name-keys: Rewrites missions and waypoints so they are keyed by name.
+        * mission-routes: Fills the start and route geometry of existing
+          missions.
+        * progress-events: Moves the events of existing mission progress to
+          child entities, run it before name-keys.
+        * image-hashes: Computes the image hashes of existing waypoints.
+        * image-variants: Generates the image variants of existing waypoints.
+        '''
+        if name not in self._MIGRATIONS:
+            self.abort(404, detail='Specified migration does not exist.')
+        self._MIGRATIONS[name](self.uri_for)
+        self.build_base_response(status_code=202)
+        self.response.out.write(json.dumps({'migration': name}))
@@ -5,18 +5,26 @@ Created on Jan 10, 2014
 @author: diegob
 '''
 import json
-import uuid
 
 from geotypes import Point
-from google.appengine.api import urlfetch
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
-from xplore.database.models import Mission, MissionWaypoint, MissionProgress
-from xplore.handler.api.base_service import BaseResource, QueryType
-from xplore.webutils import parseutils
+from xplore.database.errors import InvalidCursorError, \
+    NonExistentEntitiesError
+from xplore.database.models import Mission, MissionWaypoint, \
+    MissionProgress, TourJob
+from xplore.database.pagination import ListPage
+from xplore.handler.api.base_service import BaseResource, QueryType, \
+    MAX_PAGE_SIZE
+from xplore.webutils import jsonstream, parseutils
 
 
-_TOUR_GENERATOR_URL = 'http://bandit06.ethz.ch:8082/'
-#_TOUR_GENERATOR_URL = 'http://localhost:8082/'
+# Seconds that clients are asked to wait before polling an unfinished tour
+# job again.
+_JOB_RETRY_AFTER = 2
+# Maximum number of alternative tours that a single job may request.
+_MAX_ALTERNATIVES = 5
 
 
 class NoMissionError(Exception):
@@ -54,7 +62,9 @@ class MissionResource(BaseResource):
 
         Additionally, this get verb can trigger the dynamic creation of
         missions. This is done by passing two lat,long locations and the flag
-        new_mission set to True value.
+        new_mission set to True value. The mission is generated in the
+        background, the response is a 202 with the id of the job that can be
+        polled at /api/missions/jobs/<job_id>.
 
         The current supported parameters are:
 
@@ -63,82 +73,34 @@ class MissionResource(BaseResource):
             retrieved, given a maximum distance.
         * max_distance: Maximum distance (in meters) to limit the query for
             mission starting points.
-        * max_results: Maximum number of results to return.
+        * max_results: Maximum number of results to return in a page, it is
+            capped at MAX_PAGE_SIZE which is also the default.
+        * cursor: Opaque token from the next_cursor member of a previous
+            response to retrieve the following page.
+        * detailed: Boolean flag to include the waypoints of each mission,
+            True by default. Every mission always includes its route distance
+            in meters, expected_duration in seconds and bounding_box, so
+            clients that only need these can set it to False.
         * end_longitude, end_latitude: Floating points numbers only used
             with queries that create a new mission, these are the ending points
             of the desired mission.
+        * alternatives: Number of alternative tours to generate in a query
+            that creates new missions, between 1 (the default) and
+            _MAX_ALTERNATIVES. Each tour is stored as a separate mission.
+
+        Listings are served from a cache that is invalidated by any write to
+        missions or waypoints. Responses carry an ETag, requests that send it
+        back in If-None-Match get a 304 while the data is unchanged.
         """
         qry_params = self.validate_parameters_get(self.request.params)
-        if name is not None:
-            results = Mission.get_by_property('name', name)
-        elif qry_params['type'] == QueryType.DISTANCE_FROM_CENTER:
-            # Generate a central point for query
-            centralpoint = Point(qry_params['lat'],
-                                 qry_params['lng'])
-
-            # Get all close waypoints
-            waypoints = MissionWaypoint.query_near(
-                centralpoint, max_distance=qry_params['distance'])
-            results = []
-            if waypoints:
-                waypoint_keys = [w.key for w in waypoints]
-                results = Mission.query_by_waypoint(waypoint_keys,
-                                                    qry_params['max_results'])
-        elif qry_params['type'] == QueryType.BOUNDING_BOX:
-            # Get all waypoints in the bounding box
-            waypoints = MissionWaypoint.query_box(qry_params['nelat'],
-                                                  qry_params['nelong'],
-                                                  qry_params['swlat'],
-                                                  qry_params['swlong'],
-                                                  qry_params['max_results'])
-            results = []
-            if waypoints:
-                waypoint_keys = [w.key for w in waypoints]
-                # Find all missions starting in any of the given waypoints
-                results = Mission.query_by_waypoint(waypoint_keys,
-                                                    qry_params['max_results'])
-        elif qry_params['type'] == QueryType.CREATE:
-            headers = {'content-type': 'application/json'}
-            params = {'start_location': (qry_params['lng'], qry_params['lat']),
-                      'end_location': (qry_params['end_lng'],
-                                       qry_params['end_lat'])}
-            response = urlfetch.fetch(_TOUR_GENERATOR_URL,
-                                      payload=json.dumps(params),
-                                      method='POST',
-                                      headers=headers,
-                                      deadline=30)
-            if response.status_code != 200:
-                self.abort(response.status_code, detail=response.content)
-            else:
-                json_response = json.loads(response.content)
-                waypoint_list = json_response['waypoints']
-                mission_waypoints = [MissionWaypoint.get_by_property(
-                    'name', 'Waypoint %s' % waypoint_id)[0].key
-                    for waypoint_id in waypoint_list]
-                if not all(mission_waypoints):
-                    self.abort(500, detail='Unknown waypoint was returned '
-                               'from the mission generator service.')
-                mission = Mission.create_with_default_ancestor(
-                    name=str(uuid.uuid1()),
-                    waypoints=mission_waypoints)
-                mission.put()
-                results = [mission]
-        else:
-            results = Mission.get_all(qry_params['max_results'])
-
-        # Build the JSON response
-        self.build_base_response()
-        response_results = {'missions': []}
-        for mission in results:
-            mission_object = {'name': mission.name,
-                              'waypoints': []}
-            if qry_params['detailed']:
-                for waypoint_key in mission.waypoints:
-                    waypoint = waypoint_key.get()
-                    mission_object['waypoints'].append(
-                        waypoint.to_jsonizable(image_size=0))
-            response_results['missions'].append(mission_object)
-        self.response.out.write(json.dumps(response_results))
+        if name is None and qry_params['type'] == QueryType.CREATE:
+            self.create_tour_job(qry_params)
+            return
+        models = [Mission]
+        if qry_params['detailed']:
+            models.append(MissionWaypoint)
+        self.write_cached(models,
+                          lambda: self.write_missions(name, qry_params))
 
     def post(self):
         """
@@ -172,6 +134,65 @@ class MissionResource(BaseResource):
                                                          _full=True)}
         self.response.out.write(json.dumps(response_results))
 
+    def post_batch(self):
+        """
+        Create several missions with a single request.
+
+        It accepts only a JSON body with the list of missions under the
+        missions key, at most MAX_BATCH_SIZE of them, each with the same
+        arguments as the POST verb. Names and waypoint references are
+        validated for the whole batch at once and the missions are stored with
+        parallel asynchronous puts.
+
+        The response lists the result of every mission in the given order,
+        with its name and status: 201 and its content_url if it was created,
+        400 and the error detail if it was rejected.
+        """
+        items = self.parse_batch('missions')
+        results = [None] * len(items)
+        accepted = {}
+        for index, item in enumerate(items):
+            waypoint_names = item.get('waypoints')
+            if not isinstance(item.get('name'), basestring) or \
+                not item['name']:
+                results[index] = self.batch_error(item,
+                                                  'Bad value for param name.')
+            elif not isinstance(waypoint_names, list) or \
+                not waypoint_names or \
+                not all(isinstance(waypoint_name, basestring)
+                        for waypoint_name in waypoint_names):
+                results[index] = self.batch_error(
+                    item, 'Bad value for param waypoints.')
+            else:
+                accepted[index] = item
+
+        existing = Mission.get_key_map_by_name(
+            [item['name'] for item in accepted.itervalues()])
+        waypoint_keys = MissionWaypoint.get_key_map_by_name(
+            [waypoint_name for item in accepted.itervalues()
+             for waypoint_name in item['waypoints']])
+        seen = set()
+        missions = []
+        for index in sorted(accepted):
+            item = accepted[index]
+            missing = sorted(set(item['waypoints']) - set(waypoint_keys))
+            if item['name'] in existing or item['name'] in seen:
+                results[index] = self.batch_error(
+                    item, 'Specified resource already exists.')
+            elif missing:
+                results[index] = self.batch_error(
+                    item, 'Specified waypoints do not exist: %s.' %
+                    ', '.join(missing))
+            else:
+                seen.add(item['name'])
+                missions.append(Mission.create_with_default_ancestor(
+                    name=item['name'],
+                    waypoints=[waypoint_keys[waypoint_name]
+                               for waypoint_name in item['waypoints']]))
+        # Compute the routes of all the missions with a single batch get
+        Mission.update_routes(missions)
+        self.write_batch(results, missions, 'missions-resource-named')
+
     def put(self, name):
         """
         Provides the PUT verb for the waypoints resource. It allows editing
@@ -220,6 +241,36 @@ class MissionResource(BaseResource):
         self.build_base_response()
         self.response.out.write(json.dumps(None))
 
+    def mission_job(self, job_id):
+        """Handler method to poll a tour generation job created by a GET
+        request with the new_mission flag.
+
+        The current status is returned right away, unfinished jobs carry a
+        Retry-After header with the seconds to wait before polling again.
+        Once the job is done, the generated missions are included in the
+        response as in the GET verb, one per alternative tour.
+        """
+        job = None
+        if job_id.isdigit():
+            job = TourJob.get_by_id(int(job_id))
+        if job is None:
+            self.abort(404, detail='Specified job does not exist.')
+
+        self.build_base_response()
+        if not job.is_finished():
+            self.response.headers['Retry-After'] = str(_JOB_RETRY_AFTER)
+        response_results = {'job_id': job.key.id(),
+                            'status': job.status}
+        if job.status == TourJob.DONE:
+            missions = ndb.get_multi(job.missions or [job.mission])
+            response_results['missions'] = self.serialize_missions(
+                [mission for mission in missions if mission is not None],
+                parseutils.parse_bool(self.request.params.get('detailed',
+                                                              'True')))
+        elif job.status == TourJob.FAILED:
+            response_results['error'] = job.error
+        self.response.out.write(json.dumps(response_results))
+
     def mission_start(self, name):
         """Handler method for reporting the start of a mission by an user in
         the mobile app. The user is identified by the access token provided
@@ -268,6 +319,103 @@ class MissionResource(BaseResource):
     # Utility methods
     ###########################################################################
 
+    def create_tour_job(self, qry_params):
+        """Store a new tour generation job and enqueue it in the tours task
+        queue. The response is a 202 pointing to the job resource that can be
+        polled for the result.
+        """
+        job = TourJob(start_location=ndb.GeoPt(qry_params['lat'],
+                                               qry_params['lng']),
+                      end_location=ndb.GeoPt(qry_params['end_lat'],
+                                             qry_params['end_lng']),
+                      alternatives=qry_params['alternatives'])
+        job.put()
+        taskqueue.add(queue_name='tours',
+                      url=self.uri_for('tour-job-worker'),
+                      params={'job_id': job.key.id()})
+
+        self.build_base_response(status_code=202)
+        response_results = {'job_id': job.key.id(),
+                            'status': job.status,
+                            'content_url': self.uri_for('missions-job',
+                                                        job_id=job.key.id(),
+                                                        _full=True)}
+        self.response.out.write(json.dumps(response_results))
+
+    def write_missions(self, name, qry_params):
+        """Write the page of missions selected by the validated GET
+        parameters as the response.
+        """
+        page_size = qry_params['max_results']
+        cursor = qry_params['cursor']
+        try:
+            if name is not None:
+                results = ListPage(Mission.get_by_property('name', name),
+                                   page_size, cursor)
+            elif qry_params['type'] == QueryType.DISTANCE_FROM_CENTER:
+                # Generate a central point for query
+                centralpoint = Point(qry_params['lat'],
+                                     qry_params['lng'])
+
+                # Find the missions starting close to the point
+                missions = Mission.query_starting_near(
+                    centralpoint, self.results_window(qry_params),
+                    qry_params['distance'])
+                results = ListPage(missions, page_size, cursor)
+            elif qry_params['type'] == QueryType.BOUNDING_BOX:
+                # Find all missions starting in the bounding box
+                missions = Mission.query_starting_in_box(
+                    qry_params['nelat'], qry_params['nelong'],
+                    qry_params['swlat'], qry_params['swlong'],
+                    self.results_window(qry_params))
+                results = ListPage(missions, page_size, cursor)
+            else:
+                results = Mission.get_page(
+                    page_size, cursor,
+                    batch_size=jsonstream.DEFAULT_BATCH_SIZE)
+        except InvalidCursorError:
+            self.abort(400, detail='Invalid cursor.')
+
+        # Stream the JSON response
+        self.write_page(
+            'missions', results,
+            lambda batch: self.serialize_missions(batch,
+                                                  qry_params['detailed']))
+
+    def serialize_missions(self, missions, detailed):
+        """Build the JSON-serializable representation of the given missions.
+        If detailed is set then the waypoints of all the missions are
+        retrieved in a single batch and included in the result, so the
+        missions of a large listing should be given in batches.
+        """
+        waypoints = {}
+        serving_urls = {}
+        if detailed:
+            waypoints = Mission.fetch_waypoints(missions)
+            serving_urls = MissionWaypoint.serving_urls(waypoints.values())
+
+        results = []
+        for mission in missions:
+            mission_object = {'name': mission.name,
+                              'distance': mission.distance,
+                              'expected_duration': mission.expected_duration,
+                              'bounding_box': None,
+                              'waypoints': []}
+            if mission.bounding_box:
+                mission_object['bounding_box'] = dict(
+                    zip(('north', 'east', 'south', 'west'),
+                        mission.bounding_box))
+            if detailed:
+                for waypoint_key in mission.waypoints:
+                    waypoint = waypoints.get(waypoint_key)
+                    if waypoint is None:
+                        continue
+                    mission_object['waypoints'].append(
+                        waypoint.to_jsonizable(image_size=0,
+                                               serving_urls=serving_urls))
+            results.append(mission_object)
+        return results
+
     def validate_parameters_get(self, parameters):
         """Validate the GET arguments for retrieving missions.
 
@@ -277,11 +425,9 @@ class MissionResource(BaseResource):
         object.
         """
         qry_params = {}
-        if 'max_results' in parameters:
-            qry_params['max_results'] = parseutils.parse_int(
-                parameters.get('max_results', '10'), 1)
-        else:
-            qry_params['max_results'] = None
+        qry_params['max_results'] = parseutils.parse_int(
+            parameters.get('max_results', MAX_PAGE_SIZE), 1, MAX_PAGE_SIZE)
+        qry_params['cursor'] = parameters.get('cursor')
         is_bounding_qry = parseutils.parse_bool(
             parameters.get('bounding_box', 'false'))
         is_create_qry = parseutils.parse_bool(
@@ -297,6 +443,8 @@ class MissionResource(BaseResource):
                     parameters['end_latitude'], -90, 90)
                 qry_params['end_lng'] = parseutils.parse_float(
                     parameters['end_longitude'], -180, 180)
+                qry_params['alternatives'] = parseutils.parse_int(
+                    parameters.get('alternatives', '1'), 1, _MAX_ALTERNATIVES)
                 qry_params['type'] = QueryType.CREATE
             else:
                 self.abort(400, detail='Start and end location must be '
@@ -354,13 +502,12 @@ class MissionResource(BaseResource):
         elif not check_existence:
             model_params['mission'] = stored_mission[0]
 
-        model_params['waypoints'] = []
-        for waypoint_name in parameters['waypoints']:
-            candidate_waypoint = MissionWaypoint.get_by_property('name',
-                                                                 waypoint_name)
-            if not candidate_waypoint:
-                self.abort(400, detail='Specified resource does not exist.')
-            model_params['waypoints'].append(candidate_waypoint[0].key)
+        try:
+            model_params['waypoints'] = MissionWaypoint.get_keys_by_name(
+                parameters['waypoints'])
+        except NonExistentEntitiesError as ex:
+            self.abort(400, detail='Specified waypoints do not exist: %s.' %
+                       ', '.join(ex.names))
 
         return model_params
 
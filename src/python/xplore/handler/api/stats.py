@@ -0,0 +1,26 @@
+'''
+Module that provides the resource reporting the state of the in-process
+caches of the instance answering the request.
+'''
+import json
+
+from xplore.handler.api.base_service import BaseResource
+from xplore.handler.auth import login_required
+from xplore.utils.cache import cache_stats
+
+
+class StatsResource(BaseResource):
+    '''
+    Webapp2 handler that exposes the hit and miss counters of the caches.
+    The counters are local to each instance, so consecutive requests may
+    report different values.
+    '''
+
+    @login_required(redirect=False, admin_only=True)
+    def get(self):
+        '''
+        Provides the GET verb for the stats resource, it returns the counters
+        of every registered cache keyed by cache name.
+        '''
+        self.build_base_response()
+        self.response.out.write(json.dumps({'caches': cache_stats()}))
@@ -8,8 +8,10 @@ Created on Jan 13, 2014
 from google.appengine.api.blobstore import BlobKey
 import json
 
+from xplore.database.errors import NonExistentEntitiesError
 from xplore.database.models import Mission, MissionWaypoint, UserSubmission
 from xplore.handler.api.base_service import BaseResource
+from xplore.handler.tasks.submissions import create_submission
 
 
 class SubmissionResource(BaseResource):
@@ -45,7 +47,7 @@ class SubmissionResource(BaseResource):
                                          mission=model_params['mission'],
                                          waypoint=model_params['waypoint'],
                                          image=model_params['image_key'])
-        submission_key = user_submission.put()
+        submission_key = create_submission(user_submission, self.uri_for)
 
         # Return a response with the newly created object id.
         self.build_base_response(status_code=201)
@@ -69,16 +71,16 @@ class SubmissionResource(BaseResource):
             if not parameters[param]:
                 self.abort(400, detail='Bad value for param %s.' % param)
 
-        reference_mission = Mission.get_by_property('name',
-                                                    parameters['mission'])
-        if not reference_mission:
+        try:
+            model_params['mission'] = Mission.get_keys_by_name(
+                [parameters['mission']])[0]
+        except NonExistentEntitiesError:
             self.abort(400, detail='The given mission id does not exist.')
-        reference_waypoint = MissionWaypoint.get_by_property('name',
-                                                             parameters['waypoint'])
-        if not reference_waypoint:
+        try:
+            model_params['waypoint'] = MissionWaypoint.get_keys_by_name(
+                [parameters['waypoint']])[0]
+        except NonExistentEntitiesError:
             self.abort(400, detail='The given waypoint id does not exist.')
-        model_params['mission'] = reference_mission[0].key
-        model_params['waypoint'] = reference_waypoint[0].key
 
         # TODO: Check for blob key existence
         model_params['image_key'] = BlobKey(parameters['image_key'])
@@ -1,12 +1,18 @@
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.blobstore import BlobKey
-from google.appengine.ext.blobstore import BlobInfo
 import json
 
 from geotypes import Point
-from xplore.database.models import MissionWaypoint
-from xplore.handler.api.base_service import BaseResource, QueryType
-from xplore.webutils import parseutils
+from xplore.database.errors import InvalidCursorError
+from xplore.database.models import MissionWaypoint, UploadedFile
+from xplore.database.pagination import ListPage
+from xplore.database.utils import update_missions_for_waypoint
+from xplore.handler.api.base_service import BaseResource, QueryType, \
+    MAX_PAGE_SIZE
+from xplore.handler.tasks.waypoints import enqueue_image_indexing, \
+    enqueue_image_variants
+from xplore.utils import gcs
+from xplore.webutils import jsonstream, parseutils
 
 
 class WaypointResource(BaseResource):
@@ -29,41 +35,22 @@ class WaypointResource(BaseResource):
           given a maximum distance.
         - max_distance: Maximum distance (in meters) to limit
           the query for waypoints.
-        - max_results: Maximum number of results to return.
+        - max_results: Maximum number of results to return in a page, it is
+          capped at MAX_PAGE_SIZE which is also the default.
+        - cursor: Opaque token from the next_cursor member of a previous
+          response to retrieve the following page.
         - swlongitude, swlatitude: Floating point numbers that indicate a
           bounding box query. This is the southwest corner of the box.
         - nelongitude, nelatitude: Floating point numbers that indicate a
           bounding box query. This is the northeast corner of the box.
+
+        Listings are served from a cache that is invalidated by any write to
+        waypoints. Responses carry an ETag, requests that send it back in
+        If-None-Match get a 304 while the data is unchanged.
         """
         qry_params = self.validate_parameters_get(self.request.params)
-        if name is not None:
-            results = MissionWaypoint.get_by_property('name', name)
-        elif qry_params['type'] == QueryType.DISTANCE_FROM_CENTER:
-            # Generate a central point for query
-            center = Point(qry_params['lat'], qry_params['lng'])
-            # Execute the query
-            results = MissionWaypoint.query_near(center,
-                                                 qry_params['max_results'],
-                                                 qry_params['distance'])
-        elif qry_params['type'] == QueryType.UNBOUNDED:
-            results = MissionWaypoint.get_all(qry_params['max_results'])
-        elif qry_params['type'] == QueryType.BOUNDING_BOX:
-            results = MissionWaypoint.query_box(qry_params['nelat'],
-                                                qry_params['nelong'],
-                                                qry_params['swlat'],
-                                                qry_params['swlong'],
-                                                qry_params['max_results'])
-        else:
-            self.abort(400, detail='Query not recognized for this resource.')
-
-        # Build the JSON response
-        self.build_base_response()
-        response_results = {'waypoints': []}
-        for result in results:
-            response_results['waypoints'].append(
-                result.to_jsonizable(
-                    image_size=qry_params.get('image_size', 0)))
-        self.response.out.write(json.dumps(response_results))
+        self.write_cached([MissionWaypoint],
+                          lambda: self.write_waypoints(name, qry_params))
 
     def post(self):
         """Provides the POST verb for the waypoints resource. It creates a new
@@ -89,21 +76,10 @@ class WaypointResource(BaseResource):
         model_params = self.validate_parameters_post(parameters)
 
         # Create the waypoint model object and store in the datastore
-        location = ndb.GeoPt(model_params['latitude'],
-                             model_params['longitude'])
-
-        if 'image_key' in model_params:
-            waypoint = MissionWaypoint.create_with_default_ancestor(
-                name=model_params['name'],
-                location=location,
-                image=BlobKey(model_params['image_key']))
-        else:
-            waypoint = MissionWaypoint.create_with_default_ancestor(
-                name=model_params['name'],
-                location=location,
-                image_url=model_params['image_url'])
-
+        waypoint = self.create_waypoint(model_params)
         waypoint.put()
+        enqueue_image_indexing(self.uri_for, [waypoint.key])
+        enqueue_image_variants(self.uri_for, [waypoint.key])
 
         # Return a response with the newly created object id.
         self.build_base_response(status_code=201)
@@ -114,6 +90,59 @@ class WaypointResource(BaseResource):
                                 _full=True)}
         self.response.out.write(json.dumps(response_results))
 
+    def post_batch(self):
+        """Create several mission waypoints with a single request.
+
+        It accepts only a JSON body with the list of waypoints under the
+        waypoints key, at most MAX_BATCH_SIZE of them, each with the same
+        arguments as the POST verb. Names and images are validated for the
+        whole batch at once and the waypoints are stored with parallel
+        asynchronous puts.
+
+        The response lists the result of every waypoint in the given order,
+        with its name and status: 201 and its content_url if it was created,
+        400 and the error detail if it was rejected.
+        """
+        items = self.parse_batch('waypoints')
+        results = [None] * len(items)
+        accepted = {}
+        for index, item in enumerate(items):
+            try:
+                accepted[index] = self.parse_waypoint(item)
+            except ValueError as ex:
+                results[index] = self.batch_error(item, str(ex))
+
+        existing = MissionWaypoint.get_key_map_by_name(
+            [model_params['name'] for model_params in accepted.itervalues()])
+        image_keys = [model_params['image_key']
+                      for model_params in accepted.itervalues()
+                      if 'image_key' in model_params]
+        images = dict(zip(image_keys,
+                          gcs.blobs_exist(image_keys, UploadedFile.recorded)))
+        seen = set()
+        waypoints = []
+        for index in sorted(accepted):
+            model_params = accepted[index]
+            if model_params['name'] in existing or \
+                model_params['name'] in seen:
+                results[index] = self.batch_error(
+                    items[index], 'Specified resource already exists.')
+            elif 'image_key' in model_params and \
+                not images[model_params['image_key']]:
+                results[index] = self.batch_error(
+                    items[index], 'Specified image does not exist.')
+            else:
+                seen.add(model_params['name'])
+                waypoints.append(self.create_waypoint(model_params))
+        MissionWaypoint.set_serving_urls(waypoints)
+        self.write_batch(results, waypoints, 'waypoints-resource-named')
+        waypoint_keys = [waypoint.key for waypoint in waypoints
+                         if waypoint.key is not None and
+                         waypoint.key.id() is not None]
+        if waypoint_keys:
+            enqueue_image_indexing(self.uri_for, waypoint_keys)
+            enqueue_image_variants(self.uri_for, waypoint_keys)
+
     def put(self, name):
         """
         Provides the PUT verb for the waypoint resource. It allows the update
@@ -138,6 +167,7 @@ class WaypointResource(BaseResource):
 
         # Update the waypoint object and store it back in the datastore
         waypoint_to_update = model_params['waypoint']
+        moved = False
         if 'latitude' in model_params \
             or 'longitude' in model_params:
             new_location = ndb.GeoPt(model_params.get(
@@ -146,15 +176,21 @@ class WaypointResource(BaseResource):
                                      model_params.get(
                                         'longitude',
                                         waypoint_to_update.location.lon))
+            moved = new_location != waypoint_to_update.location
             waypoint_to_update.location = new_location
 
         if 'image_key' in model_params:
-            image_key = BlobKey(parameters['image_key'])
-            if image_key != waypoint_to_update.image:
-                BlobInfo.get(waypoint_to_update.image).delete()
-                waypoint_to_update.image = image_key
+            waypoint_to_update.replace_image(
+                BlobKey(parameters['image_key']))
 
         waypoint_to_update.put()
+        if moved:
+            # Keep the route of the missions visiting the waypoint in sync
+            update_missions_for_waypoint(waypoint_to_update.key)
+        if waypoint_to_update.image_hash is None:
+            enqueue_image_indexing(self.uri_for, [waypoint_to_update.key])
+        if waypoint_to_update.variants_pending:
+            enqueue_image_variants(self.uri_for, [waypoint_to_update.key])
 
         # Return a response with the newly created object id.
         self.build_base_response()
@@ -189,6 +225,65 @@ class WaypointResource(BaseResource):
     # Utility methods
     ###########################################################################
 
+    @staticmethod
+    def create_waypoint(model_params):
+        """Build a waypoint model object from validated POST parameters."""
+        location = ndb.GeoPt(model_params['latitude'],
+                             model_params['longitude'])
+        if 'image_key' in model_params:
+            return MissionWaypoint.create_with_default_ancestor(
+                name=model_params['name'],
+                location=location,
+                image=BlobKey(model_params['image_key']))
+        return MissionWaypoint.create_with_default_ancestor(
+            name=model_params['name'],
+            location=location,
+            image_url=model_params['image_url'])
+
+    def write_waypoints(self, name, qry_params):
+        """Write the page of waypoints selected by the validated GET
+        parameters as the response.
+        """
+        page_size = qry_params['max_results']
+        cursor = qry_params['cursor']
+        try:
+            if name is not None:
+                results = ListPage(
+                    MissionWaypoint.get_by_property('name', name),
+                    page_size, cursor)
+            elif qry_params['type'] == QueryType.DISTANCE_FROM_CENTER:
+                # Generate a central point for query
+                center = Point(qry_params['lat'], qry_params['lng'])
+                # Execute the query
+                results = ListPage(
+                    MissionWaypoint.query_near(
+                        center, self.results_window(qry_params),
+                        qry_params['distance']),
+                    page_size, cursor)
+            elif qry_params['type'] == QueryType.UNBOUNDED:
+                results = MissionWaypoint.get_page(
+                    page_size, cursor,
+                    batch_size=jsonstream.DEFAULT_BATCH_SIZE)
+            elif qry_params['type'] == QueryType.BOUNDING_BOX:
+                results = ListPage(
+                    MissionWaypoint.query_box(
+                        qry_params['nelat'], qry_params['nelong'],
+                        qry_params['swlat'], qry_params['swlong'],
+                        self.results_window(qry_params)),
+                    page_size, cursor)
+            else:
+                self.abort(400,
+                           detail='Query not recognized for this resource.')
+        except InvalidCursorError:
+            self.abort(400, detail='Invalid cursor.')
+
+        # Stream the JSON response
+        image_size = qry_params.get('image_size', 0)
+        self.write_page(
+            'waypoints', results,
+            lambda batch: MissionWaypoint.to_jsonizable_multi(batch,
+                                                              image_size))
+
     def validate_parameters_get(self, parameters):
         '''
         Validate the GET arguments for retrieving waypoints. It checks existence
@@ -197,11 +292,9 @@ class WaypointResource(BaseResource):
         The input parameters must be a dictionary from the request WebOp object.
         '''
         qry_params = {}
-        if 'max_results' in parameters:
-            qry_params['max_results'] = parseutils.parse_int(parameters['max_results'],
-                                                             1)
-        else:
-            qry_params['max_results'] = None
+        qry_params['max_results'] = parseutils.parse_int(
+            parameters.get('max_results', MAX_PAGE_SIZE), 1, MAX_PAGE_SIZE)
+        qry_params['cursor'] = parameters.get('cursor')
         if 'image_size' in parameters:
             qry_params['image_size'] = parseutils.parse_int(parameters['image_size'], 100)
         is_bounding_qry = parseutils.parse_bool(parameters.get('bounding_box', 'false'))
@@ -230,6 +323,31 @@ class WaypointResource(BaseResource):
         existence and types and also casts the values if necessary.
         Returns a dictionary with the necessary parameters.
         '''
+        try:
+            model_params = self.parse_waypoint(parameters)
+        except ValueError as ex:
+            self.abort(400, detail=str(ex))
+
+        if MissionWaypoint.get_by_property('name', model_params['name']):
+            self.abort(400, detail='Specified resource already exists.')
+
+        return model_params
+
+    @staticmethod
+    def parse_waypoint(parameters):
+        '''
+        Check and cast the arguments of a new waypoint, without checking
+        that its name is free.
+
+        Raises:
+            ValueError: If an argument is missing, with the error detail.
+        '''
+        for param in ['latitude', 'longitude', 'name']:
+            if param not in parameters:
+                raise ValueError('Missing required argument %s.' % param)
+        if not isinstance(parameters['name'], basestring) or \
+            not parameters['name']:
+            raise ValueError('Bad value for param name.')
         model_params = {}
         model_params['latitude'] = parseutils.parse_float(
             parameters['latitude'], -90, 90)
@@ -241,12 +359,8 @@ class WaypointResource(BaseResource):
         elif 'image_url' in parameters:
             model_params['image_url'] = parameters['image_url']
         else:
-            self.abort(400, detail='Either an image_key or image_url must '
-                       'be provided to create a mission waypoint.')
-
-        if MissionWaypoint.get_by_property('name', model_params['name']):
-            self.abort(400, detail='Specified resource already exists.')
-
+            raise ValueError('Either an image_key or image_url must be '
+                             'provided to create a mission waypoint.')
         return model_params
 
     def validate_parameters_put(self, name, parameters):
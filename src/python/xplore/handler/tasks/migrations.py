@@ -0,0 +1,146 @@
+'''
+Module that defines the task handlers running datastore migrations in
+batches, each task processes one batch and enqueues the next one.
+'''
+from google.appengine.api import taskqueue
+import logging
+import webapp2
+
+from xplore.database.migrations import NAME_KEYED_KINDS, \
+    backfill_image_hashes, backfill_image_variants, backfill_mission_routes, \
+    backfill_progress_events, migrate_to_name_keys
+
+
+def enqueue_name_key_migration(uri_for, kind_index=0, cursor=None):
+    '''
+    Enqueue the task that migrates the next batch of name keyed kinds,
+    starting with the kind at kind_index in NAME_KEYED_KINDS.
+    '''
+    params = {'kind_index': kind_index}
+    if cursor is not None:
+        params['cursor'] = cursor
+    taskqueue.add(url=uri_for('name-key-migration-worker'), params=params)
+
+
+def enqueue_mission_route_backfill(uri_for, cursor=None):
+    '''
+    Enqueue the task that fills the start and route geometry of the next
+    batch of missions.
+    '''
+    params = {}
+    if cursor is not None:
+        params['cursor'] = cursor
+    taskqueue.add(url=uri_for('mission-route-migration-worker'),
+                  params=params)
+
+
+def enqueue_progress_event_backfill(uri_for, cursor=None):
+    '''
+    Enqueue the task that converts the legacy events of the next batch of
+    mission progress entities.
+    '''
+    params = {}
+    if cursor is not None:
+        params['cursor'] = cursor
+    taskqueue.add(url=uri_for('progress-event-migration-worker'),
+                  params=params)
+
+
+def enqueue_image_hash_backfill(uri_for, cursor=None):
+    '''
+    Enqueue the task that computes the image hashes of the next batch of
+    waypoints.
+    '''
+    params = {}
+    if cursor is not None:
+        params['cursor'] = cursor
+    taskqueue.add(url=uri_for('image-hash-migration-worker'), params=params)
+
+
+def enqueue_image_variant_backfill(uri_for, cursor=None):
+    '''
+    Enqueue the task that generates the image variants of the next batch of
+    waypoints.
+    '''
+    params = {}
+    if cursor is not None:
+        params['cursor'] = cursor
+    taskqueue.add(url=uri_for('image-variant-migration-worker'),
+                  params=params)
+
+
+class NameKeyMigrationWorker(webapp2.RequestHandler):
+    '''
+    Task handler that rewrites a batch of missions or waypoints so they are
+    keyed by their name.
+    '''
+
+    def post(self):
+        kind_index = int(self.request.get('kind_index', 0))
+        cursor = self.request.get('cursor') or None
+        model_class = NAME_KEYED_KINDS[kind_index]
+        next_cursor = migrate_to_name_keys(model_class, cursor)
+        if next_cursor is not None:
+            enqueue_name_key_migration(self.uri_for, kind_index, next_cursor)
+        elif kind_index + 1 < len(NAME_KEYED_KINDS):
+            enqueue_name_key_migration(self.uri_for, kind_index + 1)
+        else:
+            logging.info('Migration to name keys finished.')
+
+
+class MissionRouteMigrationWorker(webapp2.RequestHandler):
+    '''
+    Task handler that fills the denormalized start and route geometry of a
+    batch of missions.
+    '''
+
+    def post(self):
+        cursor = self.request.get('cursor') or None
+        next_cursor = backfill_mission_routes(cursor)
+        if next_cursor is not None:
+            enqueue_mission_route_backfill(self.uri_for, next_cursor)
+        else:
+            logging.info('Backfill of mission routes finished.')
+
+
+class ProgressEventMigrationWorker(webapp2.RequestHandler):
+    '''
+    Task handler that converts the legacy events of a batch of mission
+    progress entities to child entities.
+    '''
+
+    def post(self):
+        cursor = self.request.get('cursor') or None
+        next_cursor = backfill_progress_events(cursor)
+        if next_cursor is not None:
+            enqueue_progress_event_backfill(self.uri_for, next_cursor)
+        else:
+            logging.info('Backfill of progress events finished.')
+
+
+class ImageHashMigrationWorker(webapp2.RequestHandler):
+    '''
+    Task handler that computes the image hashes of a batch of waypoints.
+    '''
+
+    def post(self):
+        cursor = self.request.get('cursor') or None
+        next_cursor = backfill_image_hashes(cursor)
+        if next_cursor is not None:
+            enqueue_image_hash_backfill(self.uri_for, next_cursor)
+        else:
+            logging.info('Backfill of image hashes finished.')
+
+
+class ImageVariantMigrationWorker(webapp2.RequestHandler):
+    '''
+    Task handler that generates the image variants of a batch of waypoints.
+    '''
+
+    def post(self):
+        cursor = self.request.get('cursor') or None
+        next_cursor = backfill_image_variants(cursor)
+        if next_cursor is not None:
+            enqueue_image_variant_backfill(self.uri_for, next_cursor)
+        else:
+            logging.info('Backfill of image variants finished.')
@@ -0,0 +1,89 @@
+'''
+Module that defines the task handlers scoring user submissions in the
+background, see xplore.database.scoring.
+'''
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+import logging
+import webapp2
+
+from xplore.database.scoring import mark_unscorable, \
+    score_pending_submissions, score_submissions
+
+
+# Attempts after which the submissions that can not be scored are given the
+# unscorable score.
+_MAX_ATTEMPTS = 3
+
+
+def enqueue_submission_scoring(uri_for, submission_keys=(),
+                               transactional=False):
+    '''
+    Enqueue a task that scores the given submissions, one is enqueued for
+    every new submission. Without keys the task scores batches of the
+    pending submissions found by a query.
+    '''
+    taskqueue.add(queue_name='scoring',
+                  url=uri_for('submission-scoring-worker'),
+                  params={'submission_key': [submission_key.urlsafe()
+                                             for submission_key
+                                             in submission_keys]},
+                  transactional=transactional)
+
+
+@ndb.transactional
+def create_submission(submission, uri_for):
+    '''
+    Store a new submission and enqueue its scoring atomically, so it is
+    never left without a task to score it.
+
+    Returns:
+        The key of the submission.
+    '''
+    submission_key = submission.put()
+    enqueue_submission_scoring(uri_for, [submission_key], transactional=True)
+    return submission_key
+
+
+class SubmissionScoringWorker(webapp2.RequestHandler):
+    '''
+    Task handler that scores the submissions given by the submission_key
+    parameters. Answering with an error status asks the task queue to retry
+    the task later, the submissions that still can not be scored in the last
+    attempt are marked unscorable. Without submission keys it scores a batch
+    of pending submissions and enqueues the next batch while there may be
+    more of them, the cron job started by cron.yaml calls it this way with
+    GET so submissions left pending, e.g. from before they were scored by
+    key, are eventually scored.
+    '''
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        try:
+            submission_keys = [ndb.Key(urlsafe=urlsafe) for urlsafe
+                               in self.request.get_all('submission_key')]
+        except Exception:
+            logging.warning('Invalid submission keys: %s',
+                            self.request.get_all('submission_key'))
+            return
+        if not submission_keys:
+            scored, more = score_pending_submissions()
+            logging.info('Scored %d pending submissions.', scored)
+            if more:
+                enqueue_submission_scoring(self.uri_for)
+            return
+
+        scored, failed = score_submissions(submission_keys)
+        logging.info('Scored %d submissions.', scored)
+        if not failed:
+            return
+        attempt = int(self.request.headers.get('X-AppEngine-TaskRetryCount',
+                                               0)) + 1
+        if attempt >= _MAX_ATTEMPTS:
+            logging.warning('Marking %d submissions as unscorable.',
+                            len(failed))
+            mark_unscorable(failed)
+        else:
+            self.error(503)
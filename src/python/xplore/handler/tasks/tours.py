@@ -0,0 +1,109 @@
+'''
+Module that defines the task handlers which talk to the tour generator
+service on behalf of the missions resource, so no user-facing request waits
+on it.
+'''
+from google.appengine.ext import ndb
+import logging
+import uuid
+import webapp2
+
+from xplore.database.errors import NonExistentEntitiesError
+from xplore.database.models import Mission, MissionWaypoint, TourJob
+from xplore.webutils import tourclient
+
+
+# Attempts after which a job whose generator call keeps failing is failed.
+_MAX_ATTEMPTS = 3
+
+
+class TourJobWorker(webapp2.RequestHandler):
+    '''
+    Task handler that processes a single tour job. It requests the tour from
+    the generator service and materializes the resulting mission.
+    '''
+
+    def post(self):
+        '''
+        Process the job given by the job_id parameter. Answering with an error
+        status asks the task queue to retry the task later, any error in the
+        last attempt fails the job so pollers always get a final status.
+        '''
+        job_id = self.request.get('job_id')
+        job = TourJob.get_by_id(int(job_id)) if job_id.isdigit() else None
+        if job is None or job.is_finished():
+            return
+        job.status = TourJob.RUNNING
+        job.put()
+
+        attempt = int(self.request.headers.get('X-AppEngine-TaskRetryCount',
+                                               0)) + 1
+        try:
+            self.process(job)
+        except tourclient.TourGeneratorError as ex:
+            self.retry_or_fail(job, attempt, str(ex))
+        except Exception as ex:
+            logging.exception('Tour job %s failed unexpectedly.',
+                              job.key.id())
+            self.retry_or_fail(job, attempt, 'Internal error: %s' % ex)
+
+    def process(self, job):
+        '''
+        Request the tours of the job from the generator service and store
+        them as missions, or fail the job if they can not be stored. Stored
+        tours are remembered by the client as fallback for when the
+        generator is unavailable.
+        '''
+        client = tourclient.default_client()
+        start_location = (job.start_location.lon, job.start_location.lat)
+        end_location = (job.end_location.lon, job.end_location.lat)
+        tours = client.get_tours(start_location, end_location,
+                                 job.alternatives)
+
+        # Resolve the waypoints of all the tours at once
+        waypoint_ids = [waypoint_id for tour in tours for waypoint_id in tour]
+        try:
+            waypoint_keys = MissionWaypoint.get_keys_by_name(
+                [tourclient.WAYPOINT_NAME % waypoint_id
+                 for waypoint_id in waypoint_ids])
+        except NonExistentEntitiesError as ex:
+            job.fail('Unknown waypoints were returned from the mission '
+                     'generator service: %s.' % ', '.join(ex.names))
+            return
+        tour_waypoints = []
+        for tour in tours:
+            tour_waypoints.append(waypoint_keys[:len(tour)])
+            waypoint_keys = waypoint_keys[len(tour):]
+        self.materialize(job, tour_waypoints)
+        client.remember(start_location, end_location, tours, job.alternatives)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def materialize(job, tour_waypoints):
+        '''
+        Store the generated missions, one per list of waypoint keys, and mark
+        the job as done atomically, so a retried task never creates the
+        missions twice.
+        '''
+        job = job.key.get()
+        if job.is_finished():
+            return
+        missions = [Mission.create_with_default_ancestor(
+                        name=str(uuid.uuid1()),
+                        waypoints=mission_waypoints)
+                    for mission_waypoints in tour_waypoints]
+        Mission.update_routes(missions)
+        job.finish(ndb.put_multi(missions))
+
+    def retry_or_fail(self, job, attempt, error):
+        logging.warning('Tour job %s, attempt %d: %s', job.key.id(), attempt,
+                        error)
+        job = job.key.get()
+        if job is None or job.is_finished():
+            return
+        if attempt >= _MAX_ATTEMPTS:
+            job.fail(error)
+        else:
+            job.status = TourJob.PENDING
+            job.put()
+            self.error(503)
@@ -0,0 +1,31 @@
+'''
+Module that defines the task handlers deleting the expired resumable uploads,
+see xplore.database.models.upload.
+'''
+from google.appengine.api import taskqueue
+import logging
+import webapp2
+
+from xplore.database.models import UploadSession
+
+
+def enqueue_upload_cleanup(uri_for):
+    '''Enqueue a task that deletes the next batch of expired uploads.'''
+    taskqueue.add(url=uri_for('upload-cleanup-worker'))
+
+
+class UploadCleanupWorker(webapp2.RequestHandler):
+    '''
+    Task handler that deletes a batch of expired upload sessions with their
+    chunks, it enqueues the next batch while there may be more of them. The
+    cron job started by cron.yaml calls it with GET.
+    '''
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        deleted, more = UploadSession.delete_expired()
+        logging.info('Deleted %d expired uploads.', deleted)
+        if more:
+            enqueue_upload_cleanup(self.uri_for)
@@ -0,0 +1,139 @@
+'''
+Module that defines the task handlers computing the image hashes and the
+image variants of waypoints in the background, see xplore.database.scoring
+and xplore.database.thumbnails.
+'''
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+import logging
+import webapp2
+
+from xplore.database import scoring
+from xplore.database.scoring import index_pending_waypoints, \
+    index_waypoints
+from xplore.database import thumbnails
+from xplore.database.thumbnails import process_pending_variants, \
+    process_variants
+
+
+# Attempts after which the waypoints given to a task are left pending.
+_MAX_ATTEMPTS = 3
+
+
+def _waypoint_key_params(waypoint_keys, batch_size):
+    '''
+    Split the waypoint keys in the parameters of tasks processing at most
+    batch_size of them, a single task without keys if there are none.
+    '''
+    if not waypoint_keys:
+        return [{}]
+    return [{'waypoint_key': [waypoint_key.urlsafe() for waypoint_key
+                              in waypoint_keys[i:i + batch_size]]}
+            for i in xrange(0, len(waypoint_keys), batch_size)]
+
+
+def enqueue_image_indexing(uri_for, waypoint_keys=()):
+    '''
+    Enqueue the tasks that hash the given waypoints, whenever waypoint
+    images are set. Without keys a task hashes batches of the waypoints
+    whose image hash is pending.
+    '''
+    for params in _waypoint_key_params(list(waypoint_keys),
+                                       scoring.BATCH_SIZE):
+        taskqueue.add(queue_name='scoring',
+                      url=uri_for('image-index-worker'), params=params)
+
+
+def enqueue_image_variants(uri_for, waypoint_keys=()):
+    '''
+    Enqueue the tasks that generate the image variants of the given
+    waypoints, whenever waypoint images are set. Without keys a task
+    processes batches of the waypoints whose variants are pending.
+    '''
+    for params in _waypoint_key_params(list(waypoint_keys),
+                                       thumbnails.BATCH_SIZE):
+        taskqueue.add(queue_name='scoring',
+                      url=uri_for('image-variant-worker'), params=params)
+
+
+class WaypointTaskHandler(webapp2.RequestHandler):
+    '''
+    Base of the task handlers given waypoints by their waypoint_key
+    parameters.
+    '''
+
+    def get_waypoint_keys(self):
+        '''
+        Return the keys of the waypoints of the task, None if they are not
+        valid keys.
+        '''
+        try:
+            return [ndb.Key(urlsafe=urlsafe) for urlsafe
+                    in self.request.get_all('waypoint_key')]
+        except Exception:
+            logging.warning('Invalid waypoint keys: %s',
+                            self.request.get_all('waypoint_key'))
+            return None
+
+    def retry_pending(self, pending):
+        '''
+        Ask the task queue to retry the task if some of its waypoints are
+        left pending, they are given up in the last attempt.
+        '''
+        if not pending:
+            return
+        attempt = int(self.request.headers.get('X-AppEngine-TaskRetryCount',
+                                               0)) + 1
+        if attempt >= _MAX_ATTEMPTS:
+            logging.warning('Giving up on %d pending waypoints.',
+                            len(pending))
+        else:
+            self.error(503)
+
+
+class ImageIndexWorker(WaypointTaskHandler):
+    '''
+    Task handler that hashes the images of the waypoints given by the
+    waypoint_key parameters, the task is retried while some can not be
+    read. Without keys it hashes a batch of pending waypoints and enqueues
+    the next batch while there may be more of them.
+    '''
+
+    def post(self):
+        waypoint_keys = self.get_waypoint_keys()
+        if waypoint_keys is None:
+            return
+        if not waypoint_keys:
+            hashed, more = index_pending_waypoints()
+            logging.info('Hashed the images of %d waypoints.', hashed)
+            if more:
+                enqueue_image_indexing(self.uri_for)
+            return
+        hashed, pending = index_waypoints(waypoint_keys)
+        logging.info('Hashed the images of %d waypoints.', hashed)
+        self.retry_pending(pending)
+
+
+class ImageVariantWorker(WaypointTaskHandler):
+    '''
+    Task handler that generates the image variants of the waypoints given
+    by the waypoint_key parameters, the task is retried while some of them
+    fail. Without keys it processes a batch of pending waypoints and
+    enqueues the next batch while there may be more of them.
+    '''
+
+    def post(self):
+        waypoint_keys = self.get_waypoint_keys()
+        if waypoint_keys is None:
+            return
+        if not waypoint_keys:
+            processed, more = process_pending_variants()
+            logging.info('Generated the image variants of %d waypoints.',
+                         processed)
+            if more:
+                enqueue_image_variants(self.uri_for)
+            return
+        processed, failed = process_variants(waypoint_keys)
+        logging.info('Generated the image variants of %d waypoints.',
+                     processed)
+        self.retry_pending(failed)
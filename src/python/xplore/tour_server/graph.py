@@ -0,0 +1,171 @@
+'''
+Module with the waypoint graph used to compute tours. The waypoints are
+loaded once in compact arrays and linked to their k nearest neighbours, tours
+are shortest paths over this graph between the waypoints closest to the
+requested start and end locations.
+'''
+import heapq
+import math
+import os
+
+import numpy
+
+
+EARTH_RADIUS = 6371000.0
+# Factor applied to the length of the edges used by previous tours when
+# looking for alternative tours.
+ALTERNATIVE_PENALTY = 2.0
+DATA_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                         os.pardir, os.pardir, os.pardir,
+                                         os.pardir, 'data',
+                                         'valid_images.csv'))
+
+
+def distances(lat, lon, latitudes, longitudes):
+    '''
+    Haversine distances in meters from a point to every point in the given
+    arrays, all the coordinates in degrees.
+    '''
+    lat, lon = math.radians(lat), math.radians(lon)
+    latitudes = numpy.radians(latitudes)
+    longitudes = numpy.radians(longitudes)
+    a = numpy.sin((latitudes - lat) / 2) ** 2 + \
+        math.cos(lat) * numpy.cos(latitudes) * \
+        numpy.sin((longitudes - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+class WaypointGraph(object):
+    '''
+    Undirected graph that links every waypoint with its k nearest
+    neighbours.
+
+    Attributes:
+        ids: Identifiers of the waypoints, in the order of the arrays.
+        latitudes, longitudes: Arrays with the waypoint coordinates.
+        edges: List with the (neighbour, length) pairs of every waypoint.
+    '''
+
+    def __init__(self, ids, latitudes, longitudes, neighbours=8):
+        self.ids = ids
+        self.latitudes = numpy.asarray(latitudes, dtype=float)
+        self.longitudes = numpy.asarray(longitudes, dtype=float)
+        self.edges = self._link_neighbours(neighbours)
+
+    @classmethod
+    def load(cls, data_file=DATA_FILE, neighbours=8):
+        '''
+        Build the graph from a CSV file with id, photo id, latitude and
+        longitude in its first columns.
+        '''
+        ids = []
+        latitudes = []
+        longitudes = []
+        with open(data_file, 'r') as images:
+            for line in images:
+                tokens = line.strip().split(',')
+                if len(tokens) < 4:
+                    continue
+                ids.append(tokens[0])
+                latitudes.append(float(tokens[2]))
+                longitudes.append(float(tokens[3]))
+        return cls(ids, latitudes, longitudes, neighbours)
+
+    def _link_neighbours(self, neighbours):
+        count = len(self.ids)
+        neighbours = min(neighbours, count - 1)
+        edges = [dict() for _ in xrange(count)]
+        if neighbours <= 0:
+            return [[] for node_edges in edges]
+        for node in xrange(count):
+            lengths = distances(self.latitudes[node], self.longitudes[node],
+                                self.latitudes, self.longitudes)
+            lengths[node] = numpy.inf
+            # argpartition is missing from older numpy releases
+            if hasattr(numpy, 'argpartition'):
+                closest = numpy.argpartition(lengths,
+                                             neighbours - 1)[:neighbours]
+            else:
+                closest = numpy.argsort(lengths)[:neighbours]
+            for neighbour in closest:
+                neighbour = int(neighbour)
+                length = float(lengths[neighbour])
+                edges[node][neighbour] = length
+                edges[neighbour][node] = length
+        return [sorted(node_edges.iteritems()) for node_edges in edges]
+
+    def nearest(self, lat, lon):
+        '''Return the index of the waypoint closest to the location.'''
+        return int(numpy.argmin(distances(lat, lon, self.latitudes,
+                                          self.longitudes)))
+
+    def shortest_path(self, source, target, penalties=None):
+        '''
+        Return the list of waypoint indices in the shortest path between the
+        two given waypoints, or None if they are not connected. Penalties is
+        an optional dictionary of factors for the length of given edges,
+        keyed by (node, neighbour) pairs.
+        '''
+        penalties = penalties or {}
+        lengths = {source: 0.0}
+        previous = {}
+        queue = [(0.0, source)]
+        while queue:
+            length, node = heapq.heappop(queue)
+            if node == target:
+                break
+            if length > lengths[node]:
+                continue
+            for neighbour, edge_length in self.edges[node]:
+                new_length = length + edge_length * \
+                    penalties.get((node, neighbour), 1.0)
+                if new_length < lengths.get(neighbour, numpy.inf):
+                    lengths[neighbour] = new_length
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (new_length, neighbour))
+        if target not in lengths:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        path.reverse()
+        return path
+
+    def tour(self, start_location, end_location):
+        '''
+        Compute the tour between two (longitude, latitude) locations.
+
+        Returns:
+            The list of ids of the waypoints in the tour.
+        '''
+        return self.tours(start_location, end_location, 1)[0]
+
+    def tours(self, start_location, end_location, count):
+        '''
+        Compute up to count distinct tours between two (longitude, latitude)
+        locations, the shortest first. Alternatives are found by penalizing
+        the edges of the tours found so far, so fewer tours are returned if
+        the graph offers no other way.
+
+        Returns:
+            The list of tours, each a list of waypoint ids.
+        '''
+        if not self.ids:
+            return [[]]
+        source = self.nearest(start_location[1], start_location[0])
+        target = self.nearest(end_location[1], end_location[0])
+        paths = []
+        penalties = {}
+        for _ in xrange(count * 2):
+            path = self.shortest_path(source, target, penalties)
+            if path is None:
+                path = [source, target]
+            if path not in paths:
+                paths.append(path)
+                if len(paths) >= count:
+                    break
+            for node, neighbour in zip(path, path[1:]):
+                for edge in ((node, neighbour), (neighbour, node)):
+                    penalties[edge] = penalties.get(edge, 1.0) * \
+                        ALTERNATIVE_PENALTY
+        return [[self.ids[node] for node in path] for path in paths]
@@ -1,18 +1,25 @@
-import os
-import random
+import threading
 
-_CHANCE = 0.3
+from graph import WaypointGraph
+
+_GRAPH = None
+_GRAPH_LOCK = threading.Lock()
+
+
+def load():
+    """Load the waypoint graph, the server calls it once at startup."""
+    global _GRAPH
+    with _GRAPH_LOCK:
+        if _GRAPH is None:
+            _GRAPH = WaypointGraph.load()
+    return _GRAPH
 
 
 def get_path(start, end):
-    data_file = os.path.abspath(os.path.join(__file__, os.pardir, os.pardir,
-                                             os.pardir, os.pardir, os.pardir,
-                                             'data/valid_images.csv'))
-    results = []
-    with open(data_file, 'r') as images:
-        for line in images:
-            tokens = line.strip().split(',')
-            if random.random() < _CHANCE:
-                results.append(tokens[0])
-    random.shuffle(results)
-    return results
+    graph = _GRAPH or load()
+    return graph.tour(start, end)
+
+
+def get_paths(start, end, count):
+    graph = _GRAPH or load()
+    return graph.tours(start, end, count)
@@ -1,4 +1,11 @@
+from collections import OrderedDict, deque
+import json
+import math
+import multiprocessing
+import Queue
 import sys
+import threading
+import time
 
 import cherrypy
 
@@ -8,21 +15,362 @@ except:
     import mock_pyor as pyor
 
 
+# Size in degrees of the cells used to snap tour requests, about 100 meters.
+_CELL_SIZE = 0.001
+_CACHE_SIZE = 1024
+# Tour requests waiting or being computed per worker process, requests
+# beyond this are rejected with a 503.
+_PENDING_PER_WORKER = 4
+# Seconds that rejected clients are asked to wait before retrying.
+_RETRY_AFTER = 5
+# Seconds after which a tour computation is abandoned.
+_COMPUTE_TIMEOUT = 60
+# Maximum number of alternative tours for a single pair.
+_MAX_ALTERNATIVES = 10
+# Compute times of the latest tours kept for the stats.
+_RECENT_SAMPLES = 100
+
+
+def _init_worker():
+    if hasattr(pyor, 'load'):
+        pyor.load()
+
+
+# The computations below run in the worker processes. They never raise, the
+# error is returned instead, so the completion callback that frees the slot
+# of the computation always runs.
+
+def _compute_tour(start_location, end_location):
+    start = time.time()
+    try:
+        waypoints = pyor.get_path(start_location, end_location)
+    except Exception as ex:
+        return None, time.time() - start, repr(ex)
+    return waypoints, time.time() - start, None
+
+
+def _compute_tours(request):
+    index, start_location, end_location, alternatives = request
+    start = time.time()
+    try:
+        if hasattr(pyor, 'get_paths'):
+            tours = pyor.get_paths(start_location, end_location,
+                                   alternatives)
+        else:
+            tours = [pyor.get_path(start_location, end_location)]
+    except Exception as ex:
+        return index, None, time.time() - start, repr(ex)
+    return index, tours, time.time() - start, None
+
+
+class TourCache(object):
+    """LRU cache of tours keyed by the cells of their start and end
+    locations, so popular origin/destination pairs are computed only once.
+    """
+
+    def __init__(self, max_size=_CACHE_SIZE):
+        self._max_size = max_size
+        self._tours = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(start_location, end_location, alternatives=None):
+        cells = tuple(int(math.floor(coordinate / _CELL_SIZE))
+                      for coordinate in tuple(start_location) +
+                      tuple(end_location))
+        return cells + (alternatives,)
+
+    def get(self, key):
+        with self._lock:
+            tour = self._tours.pop(key, None)
+            if tour is not None:
+                self._tours[key] = tour
+            return tour
+
+    def set(self, key, tour):
+        with self._lock:
+            self._tours.pop(key, None)
+            self._tours[key] = tour
+            while len(self._tours) > self._max_size:
+                self._tours.popitem(last=False)
+
+
+class TourWorkers(object):
+    """Process pool that computes tours outside of the server process, so
+    CPU-bound computations run in parallel. The number of pending requests
+    is bounded and the compute times are recorded for the stats. A slot is
+    held until its computation completes in the pool, even if the request
+    that asked for it timed out or its client went away.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_pending = self.processes * _PENDING_PER_WORKER
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_compute_time = 0.0
+        self.max_compute_time = 0.0
+        self.recent_compute_times = deque(maxlen=_RECENT_SAMPLES)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the pool, this must happen after the server daemonizes."""
+        self._pool = multiprocessing.Pool(self.processes, _init_worker)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _reserve(self, count):
+        with self._lock:
+            if self.pending + count > self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending += count
+            return True
+
+    def _release(self, count):
+        with self._lock:
+            self.pending -= count
+
+    def _finish(self, compute_time):
+        """Free the slot of a completed computation and record its time,
+        this runs in the result thread of the pool.
+        """
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+            self.total_compute_time += compute_time
+            self.max_compute_time = max(self.max_compute_time, compute_time)
+            self.recent_compute_times.append(compute_time)
+
+    def _submit(self, function, args, callback):
+        """Run the function in the pool, the slot reserved for it is freed
+        when it completes or right away if it can not be submitted.
+        """
+        try:
+            return self._pool.apply_async(function, args, callback=callback)
+        except Exception:
+            self._release(1)
+            raise
+
+    def compute(self, start_location, end_location):
+        """Compute a tour in the pool.
+
+        Returns:
+            The list of waypoints, or None if there are too many pending
+            requests.
+
+        Raises:
+            multiprocessing.TimeoutError: If the tour is not computed in
+                time, the computation keeps its slot until it completes.
+            RuntimeError: If the computation failed.
+        """
+        if not self._reserve(1):
+            return None
+        result = self._submit(_compute_tour, (start_location, end_location),
+                              lambda result: self._finish(result[1]))
+        waypoints, _, error = result.get(_COMPUTE_TIMEOUT)
+        if error is not None:
+            raise RuntimeError('The tour could not be computed: %s' % error)
+        return waypoints
+
+    def compute_batch(self, requests):
+        """Compute several tours in parallel in the pool. All of them are
+        submitted before returning, so their slots are freed as they
+        complete whether or not the results are consumed.
+
+        Args:
+            requests: List of (index, start_location, end_location,
+                alternatives) tuples.
+
+        Returns:
+            A generator of (index, tours, error) tuples in completion order,
+            or None if there are too many pending requests to take the
+            batch. The error is None unless the tours of the index could not
+            be computed, in time or at all.
+        """
+        if not self._reserve(len(requests)):
+            return None
+        completed = Queue.Queue()
+
+        def done(result):
+            self._finish(result[2])
+            completed.put(result)
+
+        for submitted, request in enumerate(requests):
+            try:
+                self._submit(_compute_tours, (request,), done)
+            except Exception:
+                # Free the slots of the requests not submitted yet
+                self._release(len(requests) - submitted - 1)
+                raise
+
+        def results():
+            remaining = set(request[0] for request in requests)
+            while remaining:
+                try:
+                    index, tours, _, error = completed.get(
+                        timeout=_COMPUTE_TIMEOUT)
+                except Queue.Empty:
+                    # The computations left keep their slots until they
+                    # complete, only their results are given up
+                    for index in sorted(remaining):
+                        yield index, None, 'The tour computation timed out.'
+                    return
+                remaining.discard(index)
+                yield index, tours, error
+        return results()
+
+    def stats(self):
+        with self._lock:
+            mean_compute_time = None
+            if self.completed:
+                mean_compute_time = self.total_compute_time / self.completed
+            recent = sorted(self.recent_compute_times)
+            return {'workers': self.processes,
+                    'queue_depth': self.pending,
+                    'max_queue_depth': self.max_pending,
+                    'completed': self.completed,
+                    'rejected': self.rejected,
+                    'mean_compute_time': mean_compute_time,
+                    'max_compute_time': self.max_compute_time,
+                    'recent_compute_times': list(self.recent_compute_times),
+                    'median_compute_time': _percentile(recent, 0.5),
+                    'p95_compute_time': _percentile(recent, 0.95)}
+
+
+def _percentile(values, fraction):
+    """Nearest-rank percentile of sorted values, None if there are none."""
+    if not values:
+        return None
+    return values[min(len(values) - 1,
+                      int(math.ceil(fraction * len(values))) - 1)]
+
+
+def _too_busy(message):
+    """Answer with a 503 asking the client to retry later. The status is
+    set on the response instead of raising an HTTPError, which would strip
+    the Retry-After header.
+    """
+    cherrypy.response.status = 503
+    cherrypy.response.headers['Retry-After'] = str(_RETRY_AFTER)
+    return message
+
+
 class TourService(object):
     """Controller that produces tours based on two input parameters.
 
     The input parameters are expected in a JSON-encoded body, two tuples
     with longitude and latitude of the start and end location of the tour.
+    If too many tours are pending it answers with a 503 and a Retry-After
+    header.
     """
     exposed = True
 
+    def __init__(self, workers, cache):
+        self.cache = cache
+        self.workers = workers
+
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def POST(self):
         params = cherrypy.request.json
         start_location = params['start_location']
         end_location = params['end_location']
-        return {'waypoints': pyor.get_path(start_location, end_location)}
+        key = TourCache.key(start_location, end_location)
+        waypoints = self.cache.get(key)
+        if waypoints is None:
+            waypoints = self.workers.compute(start_location, end_location)
+            if waypoints is None:
+                return _too_busy({'error': 'Too many pending tours.'})
+            self.cache.set(key, waypoints)
+        return {'waypoints': waypoints}
+
+
+class BatchTourService(object):
+    """Controller that produces several tours in a single request, computed
+    in parallel by the workers.
+
+    The JSON-encoded body has a tours member with a list of objects with the
+    start_location and end_location of each tour, as in TourService, and an
+    optional number of alternatives. The response is streamed as NDJSON, one
+    line per requested pair in completion order with its index in the
+    request and the list of computed tours, e.g.
+    {"index": 0, "tours": [["12", "57"], ["12", "31", "57"]]}. Pairs that
+    could not be computed get an error line instead, e.g.
+    {"index": 1, "error": "The tour computation timed out."}, and the other
+    results are still streamed. If too many tours are pending it answers
+    with a 503 and a Retry-After header.
+    """
+    exposed = True
+    _cp_config = {'response.stream': True}
+
+    def __init__(self, workers, cache):
+        self.workers = workers
+        self.cache = cache
+
+    @cherrypy.tools.json_in()
+    def POST(self):
+        params = cherrypy.request.json
+        lines = []
+        requests = []
+        for index, tour in enumerate(params['tours']):
+            alternatives = max(1, min(int(tour.get('alternatives', 1)),
+                                      _MAX_ALTERNATIVES))
+            key = TourCache.key(tour['start_location'], tour['end_location'],
+                                alternatives)
+            tours = self.cache.get(key)
+            if tours is not None:
+                lines.append(json.dumps({'index': index, 'tours': tours}))
+            else:
+                requests.append((index, tour['start_location'],
+                                 tour['end_location'], alternatives))
+        if len(requests) > self.workers.max_pending:
+            raise cherrypy.HTTPError(413, 'Too many tours in the batch.')
+        results = iter([])
+        if requests:
+            results = self.workers.compute_batch(requests)
+            if results is None:
+                cherrypy.response.headers['Content-Type'] = \
+                    'application/json'
+                return _too_busy(json.dumps(
+                    {'error': 'Too many pending tours.'}))
+        cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+        requests_by_index = dict((request[0], request)
+                                 for request in requests)
+
+        def stream():
+            for line in lines:
+                yield line + '\n'
+            for index, tours, error in results:
+                if error is not None:
+                    yield json.dumps({'index': index, 'error': error}) + '\n'
+                    continue
+                request = requests_by_index[index]
+                self.cache.set(TourCache.key(request[1], request[2],
+                                             request[3]), tours)
+                yield json.dumps({'index': index, 'tours': tours}) + '\n'
+        return stream()
+
+
+class StatsService(object):
+    """Controller that reports the queue depth and compute times of the
+    tour workers, used to size the generator machine. Besides the aggregate
+    mean and max, it lists the compute time of each of the latest tours with
+    their median and 95th percentile.
+    """
+    exposed = True
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    @cherrypy.tools.json_out()
+    def GET(self):
+        return self.workers.stats()
 
 
 def run_server():
@@ -35,10 +383,18 @@ def run_server():
         'log.access_file': 'access.log',
         'log.screen': False
     }
+    workers = TourWorkers()
+    cache = TourCache()
     d = cherrypy.process.plugins.Daemonizer(cherrypy.engine)
     d.subscribe()
+    # The pool is started once the daemonizer forked, each worker loads the
+    # waypoint data once when it starts.
+    cherrypy.engine.subscribe('start', workers.start, priority=80)
+    cherrypy.engine.subscribe('stop', workers.stop)
     cherrypy.config.update(server_conf)
-    cherrypy.quickstart(TourService(), '/', app_conf)
+    cherrypy.tree.mount(StatsService(workers), '/stats', app_conf)
+    cherrypy.tree.mount(BatchTourService(workers, cache), '/batch', app_conf)
+    cherrypy.quickstart(TourService(workers, cache), '/', app_conf)
 
 if __name__ == '__main__':
     sys.exit(run_server())
@@ -0,0 +1,104 @@
+'''
+Module with in-process caching utilities. The caches defined here live in the
+memory of a single instance and are shared by all the threads serving
+requests in it.
+'''
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    '''
+    Bounded mapping that evicts the least recently used entry once it
+    holds more than max_size entries. Access is serialized with a lock since
+    the application is configured as threadsafe.
+    '''
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''
+        Return the value stored for key and mark it as the most recently used
+        one, or default if the key is not cached.
+        '''
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        '''
+        Store the value for key, evicting the least recently used entry if
+        the cache is full.
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        '''Remove the entry for key if it is cached.'''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        '''Remove all the entries in the cache.'''
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_COUNTERS = {}
+
+
+class HitCounter(object):
+    '''
+    Hit and miss counters for a cache. Counters are registered by name when
+    created so that all of them can be reported together, the counts are
+    local to the instance.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        _COUNTERS[name] = self
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def hit_rate(self):
+        '''Fraction of lookups that were hits, None if there were none.'''
+        total = self.hits + self.misses
+        if not total:
+            return None
+        return float(self.hits) / total
+
+    def as_dict(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate()}
+
+
+def cache_stats():
+    '''
+    Return a dictionary with the counters of every registered cache keyed by
+    cache name.
+    '''
+    return dict((name, counter.as_dict())
+                for name, counter in _COUNTERS.iteritems())
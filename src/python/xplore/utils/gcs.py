@@ -0,0 +1,90 @@
+'''
+Module that stores files in Google Cloud Storage with the GCS client library,
+vendored in src/lib/cloudstorage. Every file gets a blob key, so it is read
+with BlobReader, served with the images service and deleted with
+blobstore.delete like the files uploaded to the blobstore.
+
+Settings can be overriden in appengine_config.py with the xplore_ prefix:
+
+* GCS_BUCKET: Bucket where the files are stored, None for the default bucket
+    of the application.
+'''
+from google.appengine.api import app_identity, lib_config
+from google.appengine.ext import blobstore
+import cloudstorage
+import uuid
+
+
+config = lib_config.register('xplore', {'GCS_BUCKET': None})
+
+
+def file_name(folder, name=None):
+    '''
+    Return the GCS file name of a file in the given folder of the bucket, a
+    random name is used if none is given.
+    '''
+    bucket = config.GCS_BUCKET or app_identity.get_default_gcs_bucket_name()
+    return '/%s/%s/%s' % (bucket, folder, name or uuid.uuid4().hex)
+
+
+def open_file(gcs_file_name, mime_type):
+    '''
+    Open a GCS file for writing, it replaces any previous file with the same
+    name once closed.
+    '''
+    return cloudstorage.open(gcs_file_name, 'w', content_type=mime_type)
+
+
+def get_blob_key(gcs_file_name):
+    '''Return the blob key of a GCS file.'''
+    return blobstore.BlobKey(blobstore.create_gs_key('/gs' + gcs_file_name))
+
+
+def delete_file(gcs_file_name):
+    '''Delete a GCS file, files that do not exist are ignored.'''
+    try:
+        cloudstorage.delete(gcs_file_name)
+    except cloudstorage.NotFoundError:
+        pass
+
+
+def write_blob(data, mime_type, folder):
+    '''
+    Store the data in a new GCS file in the given folder and return its blob
+    key.
+    '''
+    gcs_file_name = file_name(folder)
+    with open_file(gcs_file_name, mime_type) as gcs_file:
+        gcs_file.write(data)
+    return get_blob_key(gcs_file_name)
+
+
+def blobs_exist(blob_keys, recorded=None):
+    '''
+    Tell which of the blob keys refer to existing files, whether uploaded to
+    the blobstore or stored in GCS, which have no BlobInfo. The files without
+    BlobInfo are read unless recorded tells they exist.
+
+    Arguments:
+        recorded: Optional function that returns the set of the given blob
+            keys whose files are known to exist, called once with the keys
+            without BlobInfo.
+
+    Returns:
+        A list of booleans in the order of the blob keys.
+    '''
+    blob_infos = blobstore.BlobInfo.get(blob_keys)
+    known = set()
+    if recorded is not None:
+        known = recorded([blob_key for blob_key, blob_info
+                          in zip(blob_keys, blob_infos) if blob_info is None])
+    exist = []
+    for blob_key, blob_info in zip(blob_keys, blob_infos):
+        if blob_info is None and blob_key not in known:
+            try:
+                blobstore.fetch_data(blob_key, 0, 0)
+            except blobstore.Error:
+                exist.append(False)
+                continue
+        exist.append(True)
+    return exist
@@ -0,0 +1,127 @@
+'''
+Module with geographic helpers used by the in-process geo queries. Distances
+are computed on a spherical earth which is accurate enough at city scale.
+'''
+import math
+import numpy
+
+
+EARTH_RADIUS = 6371000.0
+_METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def distance(lat1, lon1, lat2, lon2):
+    '''
+    Great-circle distance in meters between two points given in degrees,
+    computed with the haversine formula.
+    '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = math.sin(dlat / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def distances(lat, lon, latitudes, longitudes):
+    '''
+    Great-circle distances in meters from a point to every point in the given
+    arrays, computed with the haversine formula in one vectorized pass.
+    '''
+    lat, lon = math.radians(lat), math.radians(lon)
+    latitudes = numpy.radians(latitudes)
+    longitudes = numpy.radians(longitudes)
+    a = numpy.sin((latitudes - lat) / 2) ** 2 + \
+        math.cos(lat) * numpy.cos(latitudes) * \
+        numpy.sin((longitudes - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def nearest(lat, lon, latitudes, longitudes, max_results, max_distance=0):
+    '''
+    Return the indices of the points closest to the given center sorted by
+    distance, at most max_results of them. A max_distance of 0 does not limit
+    the distance.
+    '''
+    if max_results <= 0 or not len(latitudes):
+        return []
+    ranked = distances(lat, lon, numpy.asarray(latitudes, dtype=float),
+                       numpy.asarray(longitudes, dtype=float))
+    indices = numpy.arange(len(ranked))
+    if max_distance > 0:
+        within = ranked <= max_distance
+        indices = indices[within]
+        ranked = ranked[within]
+    if len(ranked) > max_results:
+        # argpartition is missing from older numpy releases
+        if hasattr(numpy, 'argpartition'):
+            top = numpy.argpartition(ranked, max_results - 1)[:max_results]
+        else:
+            top = numpy.argsort(ranked)[:max_results]
+        indices = indices[top]
+        ranked = ranked[top]
+    return indices[numpy.argsort(ranked, kind='mergesort')].tolist()
+
+
+def path_length(latitudes, longitudes):
+    '''
+    Length in meters of the path that visits the given points in order. The
+    haversine distances of all the legs are computed at once with numpy.
+    '''
+    if len(latitudes) < 2:
+        return 0.0
+    latitudes = numpy.radians(numpy.asarray(latitudes, dtype=float))
+    longitudes = numpy.radians(numpy.asarray(longitudes, dtype=float))
+    dlat = numpy.diff(latitudes)
+    dlon = numpy.diff(longitudes)
+    a = numpy.sin(dlat / 2) ** 2 + \
+        numpy.cos(latitudes[:-1]) * numpy.cos(latitudes[1:]) * \
+        numpy.sin(dlon / 2) ** 2
+    legs = numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+    return float(2 * EARTH_RADIUS * numpy.sum(legs))
+
+
+def bounding_box(lat, lon, radius):
+    '''
+    Return a (north, east, south, west) box in degrees that contains every
+    point within radius meters of the given center. Longitudes are wrapped to
+    [-180, 180], so east can be smaller than west when the box crosses the
+    antimeridian.
+    '''
+    return expand_box(lat, lon, lat, lon, radius)
+
+
+def expand_box(north, east, south, west, radius):
+    '''
+    Return a (north, east, south, west) box in degrees that contains every
+    point within radius meters of the given box, with the same conventions
+    as bounding_box.
+    '''
+    dlat = radius / _METERS_PER_DEGREE
+    north = min(90.0, north + dlat)
+    south = max(-90.0, south - dlat)
+    if north == 90.0 or south == -90.0:
+        return north, 180.0, south, -180.0
+    dlon = dlat / max(math.cos(math.radians(max(abs(north), abs(south)))),
+                      1e-12)
+    if dlon >= 180:
+        return north, 180.0, south, -180.0
+    east = east + dlon
+    west = west - dlon
+    if east > 180:
+        east -= 360
+    if west < -180:
+        west += 360
+    return north, east, south, west
+
+
+def in_box(lat, lon, north, east, south, west):
+    '''
+    Check if the point is inside the box, taking into account boxes that
+    cross the antimeridian.
+    '''
+    if lat > north or lat < south:
+        return False
+    if west <= east:
+        return west <= lon <= east
+    return lon >= west or lon <= east
@@ -0,0 +1,51 @@
+'''
+Module with the perceptual hash used to compare waypoint and submission
+images without decoding both of them every time.
+
+The difference hash (dHash) shrinks the image to a 9x8 grayscale thumbnail and
+keeps one bit per pair of horizontally adjacent pixels, set if the left one is
+brighter. It survives scaling, re-encoding and small color changes, similar
+images have hashes within a small Hamming distance.
+'''
+from cStringIO import StringIO
+
+from PIL import Image
+
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def dhash(image_data):
+    '''
+    Compute the difference hash of an encoded image.
+
+    Returns:
+        The hash as a string of 16 hexadecimal digits.
+
+    Raises:
+        IOError: If the image can not be decoded.
+    '''
+    image = Image.open(StringIO(image_data))
+    # Let the JPEG decoder downscale while decoding, it is much cheaper
+    image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    image = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE),
+                                      Image.ANTIALIAS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in xrange(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in xrange(HASH_SIZE):
+            value = value << 1 | \
+                (pixels[offset + column] > pixels[offset + column + 1])
+    return '%016x' % value
+
+
+def distance(hash_a, hash_b):
+    '''Hamming distance between two hashes.'''
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def similarity(hash_a, hash_b):
+    '''Similarity between two hashes, from 0 to 1 for identical hashes.'''
+    return 1 - float(distance(hash_a, hash_b)) / HASH_BITS
@@ -0,0 +1,57 @@
+'''
+Module with helpers to write large JSON documents incrementally, so that the
+entities of a collection are pulled from the datastore and serialized in
+batches instead of building the whole document in memory first.
+'''
+import json
+
+
+DEFAULT_BATCH_SIZE = 100
+
+
+def batches(items, batch_size):
+    '''
+    Generator that groups the elements of an iterable in lists of at most
+    batch_size elements.
+    '''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_collection(out, name, items, serialize_batch,
+                     batch_size=DEFAULT_BATCH_SIZE, extra=None):
+    '''
+    Write a JSON object with the serialized items as an array under the given
+    name, e.g. {"waypoints": [...]}.
+
+    Args:
+        out: File-like object to write to, e.g. the response output.
+        name: Name of the array in the JSON object.
+        items: Iterable with the items to serialize, ideally a query iterator
+            so only one batch of entities is held in memory at a time.
+        serialize_batch: Function that receives a list of items and returns
+            a list with their JSON-serializable representations.
+        batch_size: Number of items to serialize at once.
+        extra: Dictionary with additional top-level members to write after
+            the array, if any. It can also be a function returning the
+            dictionary, called once all the items are written.
+    '''
+    out.write('{%s: [' % json.dumps(name))
+    separator = ''
+    for batch in batches(items, batch_size):
+        for element in serialize_batch(batch):
+            out.write(separator)
+            out.write(json.dumps(element))
+            separator = ', '
+    out.write(']')
+    if callable(extra):
+        extra = extra()
+    for key, value in (extra or {}).iteritems():
+        out.write(', %s: %s' % (json.dumps(key), json.dumps(value)))
+    out.write('}')
@@ -0,0 +1,395 @@
+'''
+Module with the client of the tour generator service.
+
+The client retries failed calls with jittered exponential backoff within a
+total deadline budget, hedges slow calls to the next backend when several are
+configured and stops calling the generator for a while once it keeps
+failing. While the generator is unavailable, tours remembered before for the
+same start and end are served as fallback, otherwise the default client looks
+up the generated tours stored as missions.
+
+Settings can be overriden in appengine_config.py with the xplore_ prefix:
+
+* TOUR_GENERATOR_URLS: Base URLs of the generator backends, in order of
+    preference.
+* TOUR_GENERATOR_DEADLINE: Total time budget in seconds for a request,
+    including retries.
+* TOUR_GENERATOR_ATTEMPT_DEADLINE: Time limit in seconds for a single call.
+* TOUR_GENERATOR_MAX_ATTEMPTS: Maximum number of attempts for a request.
+* TOUR_GENERATOR_HEDGE_DELAY: Seconds to wait for a backend before sending
+    the same call to the next one.
+* TOUR_GENERATOR_BREAKER_THRESHOLD: Consecutive failed requests that open
+    the circuit breaker.
+* TOUR_GENERATOR_BREAKER_RESET: Seconds the breaker stays open before a
+    trial request is let through.
+'''
+from google.appengine.api import apiproxy_rpc, apiproxy_stub_map, \
+    lib_config, urlfetch
+from google.appengine.ext import ndb
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+from xplore.database.models import Mission
+from xplore.utils.cache import LRUCache
+
+
+config = lib_config.register('xplore', {
+    'TOUR_GENERATOR_URLS': ['http://bandit06.ethz.ch:8082/'],
+    'TOUR_GENERATOR_DEADLINE': 30,
+    'TOUR_GENERATOR_ATTEMPT_DEADLINE': 10,
+    'TOUR_GENERATOR_MAX_ATTEMPTS': 3,
+    'TOUR_GENERATOR_HEDGE_DELAY': 2,
+    'TOUR_GENERATOR_BREAKER_THRESHOLD': 5,
+    'TOUR_GENERATOR_BREAKER_RESET': 60})
+
+# Size in degrees of the cells used to match fallback tours, about 100 m.
+_CELL_SIZE = 0.001
+_FALLBACK_TOURS = 1000
+# Maximum distance in meters between the requested start and end and those
+# of a stored mission served as fallback.
+_FALLBACK_DISTANCE = 100
+# Name of the waypoints stored for the waypoint ids of the generator.
+WAYPOINT_NAME = 'Waypoint %s'
+# Base delay in seconds of the backoff between attempts.
+_BACKOFF = 0.5
+# Seconds between the checks for a finished call while a hedge is due.
+_POLL_INTERVAL = 0.05
+
+
+class TourGeneratorError(Exception):
+    '''The tour generator could not produce the requested tours.'''
+
+
+class CircuitOpenError(TourGeneratorError):
+    '''The generator is not called because it failed repeatedly.'''
+
+
+def urlfetch_start(url, payload, deadline):
+    '''
+    Default transport of the client, it starts an asynchronous POST of the
+    JSON payload with urlfetch, which keeps the connections to the backends
+    alive between calls. The call is an RPC of the current request, so it
+    never outlives it.
+
+    Returns:
+        The urlfetch RPC of the call.
+    '''
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    urlfetch.make_fetch_call(rpc, url, payload=payload, method='POST',
+                             headers={'content-type': 'application/json'},
+                             follow_redirects=False)
+    return rpc
+
+
+def find_stored_tours(start_location, end_location, alternatives):
+    '''
+    Default lookup of the fallback tours not remembered by the client, the
+    tours of the missions stored between the (longitude, latitude) locations
+    whose waypoints were all named after generator waypoint ids, so they
+    are served even by a new instance.
+
+    Returns:
+        A list with up to alternatives tours, each a list of waypoint ids.
+    '''
+    missions = Mission.query_between(
+        ndb.GeoPt(start_location[1], start_location[0]),
+        ndb.GeoPt(end_location[1], end_location[0]),
+        _FALLBACK_DISTANCE, alternatives)
+    waypoints = Mission.fetch_waypoints(missions)
+    prefix = WAYPOINT_NAME % ''
+    tours = []
+    for mission in missions:
+        names = [waypoints[key].name for key in mission.waypoints
+                 if key in waypoints]
+        if len(names) == len(mission.waypoints) and \
+            all(name.startswith(prefix) for name in names):
+            tours.append([name[len(prefix):] for name in names])
+    return tours
+
+
+class CircuitBreaker(object):
+    '''
+    Circuit breaker shared by the requests of an instance. It opens after
+    failure_threshold consecutive failures, while open every request fails
+    fast. After reset_timeout seconds a single trial request is let through,
+    its outcome closes the breaker or opens it again.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_on = None
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                self._clock() - self._opened_on >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_on = self._clock()
+
+
+class TourClient(object):
+    '''
+    Client of the tour generator service.
+
+    Attributes:
+        urls: Base URLs of the generator backends, in order of preference.
+        deadline: Total time budget in seconds for a request.
+        attempt_deadline: Time limit in seconds for a single call.
+        max_attempts: Maximum number of attempts for a request.
+        hedge_delay: Seconds to wait for a backend before sending the same
+            call to the next one.
+        breaker: CircuitBreaker guarding the generator.
+        start_fetch: Transport function with the signature of
+            urlfetch_start.
+        wait_any: Function waiting for the first finished RPC, with the
+            signature of UserRPC.wait_any.
+        stored_tours: Function with the signature of find_stored_tours that
+            looks up fallback tours not remembered by the client, or None.
+    '''
+
+    def __init__(self, urls, deadline=30, attempt_deadline=10,
+                 max_attempts=3, hedge_delay=2, breaker=None,
+                 start_fetch=urlfetch_start,
+                 wait_any=apiproxy_stub_map.UserRPC.wait_any,
+                 stored_tours=None, clock=time.time, sleep=time.sleep):
+        self.urls = urls
+        self.deadline = deadline
+        self.attempt_deadline = attempt_deadline
+        self.max_attempts = max_attempts
+        self.hedge_delay = hedge_delay
+        self.breaker = breaker or CircuitBreaker(5, 60, clock)
+        self.start_fetch = start_fetch
+        self.wait_any = wait_any
+        self.stored_tours = stored_tours
+        self._clock = clock
+        self._sleep = sleep
+        self._fallback_tours = LRUCache(_FALLBACK_TOURS)
+
+    @staticmethod
+    def _fallback_key(start_location, end_location, alternatives):
+        cells = tuple(int(math.floor(coordinate / _CELL_SIZE))
+                      for coordinate in tuple(start_location) +
+                      tuple(end_location))
+        return cells + (alternatives,)
+
+    def remember(self, start_location, end_location, tours,
+                 alternatives=None):
+        '''
+        Store tours to serve as fallback for requests with close start and
+        end locations, e.g. tours stored as missions or generated ahead of
+        time. The tours are served to requests for the given number of
+        alternatives, by default the number of tours.
+        '''
+        self._fallback_tours.set(
+            self._fallback_key(start_location, end_location,
+                               alternatives or len(tours)),
+            tours)
+
+    def get_tours(self, start_location, end_location, alternatives=1):
+        '''
+        Request tours between two (longitude, latitude) locations.
+
+        Returns:
+            A list with up to alternatives tours, each a list of waypoint
+            ids.
+
+        Raises:
+            TourGeneratorError: If the generator failed and there is no
+                fallback tour for the locations. CircuitOpenError if the
+                generator was not even called.
+        '''
+        if not self.breaker.allow():
+            return self._fallback(start_location, end_location, alternatives,
+                                  CircuitOpenError('The tour generator is '
+                                                   'failing, not calling it.'))
+        params = {'start_location': start_location,
+                  'end_location': end_location}
+        succeeded = False
+        try:
+            if alternatives > 1:
+                params['alternatives'] = alternatives
+                content = self._request('batch', {'tours': [params]})
+                tours = []
+                for line in content.splitlines():
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    if 'error' in result:
+                        raise TourGeneratorError('The tour generator '
+                                                 'failed: %s' %
+                                                 result['error'])
+                    tours.extend(result['tours'])
+            else:
+                content = self._request('', params)
+                tours = [json.loads(content)['waypoints']]
+            succeeded = True
+        except (TourGeneratorError, ValueError, KeyError) as ex:
+            if not isinstance(ex, TourGeneratorError):
+                ex = TourGeneratorError('Invalid generator response: %s' % ex)
+            return self._fallback(start_location, end_location,
+                                  alternatives, ex)
+        finally:
+            # Any outcome, unexpected errors included, has to be recorded or
+            # a half-open breaker would never let another request through
+            if succeeded:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+        return tours
+
+    def _fallback(self, start_location, end_location, alternatives, error):
+        '''
+        Serve the tours remembered for the locations, or those found by
+        stored_tours which are then remembered, or raise the error.
+        '''
+        fallback_key = self._fallback_key(start_location, end_location,
+                                          alternatives)
+        tours = self._fallback_tours.get(fallback_key)
+        if tours is not None:
+            return tours
+        if self.stored_tours is not None:
+            try:
+                tours = self.stored_tours(start_location, end_location,
+                                          alternatives)
+            except Exception:
+                logging.exception('Could not look up the stored tours.')
+            if tours:
+                self._fallback_tours.set(fallback_key, tours)
+                return tours
+        raise error
+
+    def _request(self, path, params):
+        '''
+        Call the generator until it succeeds, retrying with jittered
+        exponential backoff while attempts and time budget are left.
+        '''
+        payload = json.dumps(params)
+        budget_end = self._clock() + self.deadline
+        attempt = 0
+        while True:
+            remaining = budget_end - self._clock()
+            if remaining <= 0:
+                raise TourGeneratorError('The tour generator deadline was '
+                                         'exceeded.')
+            try:
+                return self._hedged_fetch(path, payload, attempt,
+                                          min(self.attempt_deadline,
+                                              remaining))
+            except TourGeneratorError:
+                attempt += 1
+                delay = random.uniform(0, _BACKOFF * 2 ** attempt)
+                if attempt >= self.max_attempts or \
+                    self._clock() + delay >= budget_end:
+                    raise
+            self._sleep(delay)
+
+    @staticmethod
+    def _result(url, rpc):
+        try:
+            response = rpc.get_result()
+        except urlfetch.Error as ex:
+            raise TourGeneratorError('%s is unreachable: %s' % (url, ex))
+        if response.status_code != 200:
+            raise TourGeneratorError('%s failed with status %d: %s' %
+                                     (url, response.status_code,
+                                      response.content))
+        return response.content
+
+    def _hedged_fetch(self, path, payload, attempt, deadline):
+        '''
+        Make a call, if the backend does not answer within hedge_delay the
+        same call is started on the next backend and the first success wins.
+        Each attempt starts with a different backend. The calls are
+        asynchronous RPCs, those still running when a call succeeds are left
+        to their deadline.
+        '''
+        urls = self.urls[attempt % len(self.urls):] + \
+            self.urls[:attempt % len(self.urls)]
+        end = self._clock() + deadline
+        hedge_on = self._clock()
+        started = 0
+        running = []
+        error = TourGeneratorError('The tour generator timed out.')
+        while True:
+            now = self._clock()
+            if started < len(urls) and now < end and \
+                (not running or now >= hedge_on):
+                url = urls[started] + path
+                running.append((self.start_fetch(url, payload, end - now),
+                                url))
+                started += 1
+                hedge_on = now + self.hedge_delay
+            if not running:
+                raise error
+            if started < len(urls) and now < end:
+                # Check for a finished call until the next backend is due
+                finished = [call for call in running if call[0].state ==
+                            apiproxy_rpc.RPC.FINISHING]
+                if not finished:
+                    self._sleep(min(_POLL_INTERVAL, hedge_on - now))
+                    continue
+                call = finished[0]
+            else:
+                rpc = self.wait_any([rpc for rpc, _ in running])
+                if rpc is None:
+                    continue
+                call = [call for call in running if call[0] is rpc][0]
+            running.remove(call)
+            try:
+                return self._result(call[1], call[0])
+            except TourGeneratorError as ex:
+                error = ex
+
+
+_DEFAULT_CLIENT = None
+_DEFAULT_CLIENT_LOCK = threading.Lock()
+
+
+def default_client():
+    '''
+    Return the client configured by the settings, shared by all the
+    requests served by the instance so its breaker and fallback tours are
+    too.
+    '''
+    global _DEFAULT_CLIENT
+    with _DEFAULT_CLIENT_LOCK:
+        if _DEFAULT_CLIENT is None:
+            _DEFAULT_CLIENT = TourClient(
+                config.TOUR_GENERATOR_URLS,
+                deadline=config.TOUR_GENERATOR_DEADLINE,
+                attempt_deadline=config.TOUR_GENERATOR_ATTEMPT_DEADLINE,
+                max_attempts=config.TOUR_GENERATOR_MAX_ATTEMPTS,
+                hedge_delay=config.TOUR_GENERATOR_HEDGE_DELAY,
+                breaker=CircuitBreaker(
+                    config.TOUR_GENERATOR_BREAKER_THRESHOLD,
+                    config.TOUR_GENERATOR_BREAKER_RESET),
+                stored_tours=find_stored_tours)
+        return _DEFAULT_CLIENT
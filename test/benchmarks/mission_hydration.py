@@ -0,0 +1,107 @@
+'''
+Benchmark for the waypoint hydration of detailed mission listings.
+
+It compares the serial strategy, one datastore get per waypoint per mission,
+against the batched strategy in Mission.fetch_waypoints. Both run against the
+testbed datastore stub with the ndb caches disabled so every lookup is a real
+round trip to the stub. Latencies are those of the local stub, the relevant
+figure is how the number of round trips grows with the number of missions.
+
+Run it from the test directory with the App Engine SDK in the PYTHONPATH:
+
+    python benchmarks/mission_hydration.py
+'''
+import os.path
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+from harness import TestHarness
+from xplore.database.models import Mission, MissionWaypoint
+
+
+_MISSION_COUNTS = [1, 10, 50, 100]
+_WAYPOINTS_PER_MISSION = 10
+_POOL_SIZE = 200
+
+
+class RoundTripCounter(object):
+    '''Counts the calls made to the datastore service through the API
+    proxy.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'round-trip-counter', self, 'datastore_v3')
+
+    def __call__(self, service, call, request, response):
+        if call in ('Get', 'RunQuery', 'Next'):
+            self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+
+def create_dataset(mission_count):
+    waypoints = []
+    for i in xrange(_POOL_SIZE):
+        waypoints.append(MissionWaypoint.create_with_default_ancestor(
+            name='waypoint%d' % i,
+            location=ndb.GeoPt(47.0 + i * 1e-3, 8.0 + i * 1e-3),
+            image_url='http://example.com/%d.jpg' % i))
+    waypoint_keys = ndb.put_multi(waypoints)
+    missions = []
+    for i in xrange(mission_count):
+        offset = (i * _WAYPOINTS_PER_MISSION) % _POOL_SIZE
+        missions.append(Mission.create_with_default_ancestor(
+            name='mission%d' % i,
+            waypoints=waypoint_keys[offset:offset + _WAYPOINTS_PER_MISSION]))
+    ndb.put_multi(missions)
+    return Mission.get_all()
+
+
+def hydrate_serial(missions):
+    return [[key.get() for key in mission.waypoints] for mission in missions]
+
+
+def hydrate_batched(missions):
+    waypoints = Mission.fetch_waypoints(missions)
+    return [[waypoints[key] for key in mission.waypoints]
+            for mission in missions]
+
+
+def measure(strategy, missions, counter):
+    ndb.get_context().clear_cache()
+    counter.reset()
+    start = time.time()
+    strategy(missions)
+    elapsed = time.time() - start
+    return counter.count, elapsed * 1000
+
+
+def main():
+    print '%8s %16s %12s %16s %12s' % ('missions', 'serial trips',
+                                       'serial ms', 'batched trips',
+                                       'batched ms')
+    for mission_count in _MISSION_COUNTS:
+        harness = TestHarness()
+        harness.setup()
+        context = ndb.get_context()
+        context.set_cache_policy(False)
+        context.set_memcache_policy(False)
+        missions = create_dataset(mission_count)
+        counter = RoundTripCounter()
+        serial_trips, serial_ms = measure(hydrate_serial, missions, counter)
+        batched_trips, batched_ms = measure(hydrate_batched, missions,
+                                            counter)
+        print '%8d %16d %12.1f %16d %12.1f' % (mission_count, serial_trips,
+                                               serial_ms, batched_trips,
+                                               batched_ms)
+        harness.destroy()
+
+if __name__ == '__main__':
+    sys.exit(main())
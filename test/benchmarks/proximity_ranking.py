@@ -0,0 +1,81 @@
+'''
+Benchmark for the ranking stage of proximity queries.
+
+It ranks synthetic candidate waypoints around a center the way geomodel's
+proximity fetch does, one geomath.distance call per entity followed by a
+sort, and with the vectorized geo.nearest used by MissionWaypoint.query_near.
+Both rank the same candidates, so the datastore retrieval of the candidates
+is left out of the figures.
+
+Run it from the test directory with geomodel in the PYTHONPATH:
+
+    python benchmarks/proximity_ranking.py
+'''
+import os.path
+import random
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+import geomath
+from geotypes import Point
+from xplore.utils import geo
+
+
+_CANDIDATE_COUNTS = [1000, 10000, 100000]
+_CENTER = (47.3769, 8.5417)
+_SPREAD = 0.05
+_MAX_RESULTS = 50
+_MAX_DISTANCE = 2000
+_REPETITIONS = 5
+
+
+def create_candidates(count):
+    random.seed(count)
+    return [(_CENTER[0] + random.uniform(-_SPREAD, _SPREAD),
+             _CENTER[1] + random.uniform(-_SPREAD, _SPREAD),
+             'waypoint%d' % i) for i in xrange(count)]
+
+
+def rank_geomodel(candidates):
+    center = Point(*_CENTER)
+    ranked = []
+    for lat, lon, name in candidates:
+        distance = geomath.distance(center, Point(lat, lon))
+        if distance <= _MAX_DISTANCE:
+            ranked.append((distance, name))
+    ranked.sort()
+    return [name for _, name in ranked[:_MAX_RESULTS]]
+
+
+def rank_vectorized(candidates):
+    indices = geo.nearest(_CENTER[0], _CENTER[1],
+                          [candidate[0] for candidate in candidates],
+                          [candidate[1] for candidate in candidates],
+                          _MAX_RESULTS, _MAX_DISTANCE)
+    return [candidates[index][2] for index in indices]
+
+
+def measure(strategy, candidates):
+    best = None
+    for _ in xrange(_REPETITIONS):
+        start = time.time()
+        strategy(candidates)
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    print '%10s %14s %16s %10s' % ('candidates', 'geomodel ms',
+                                   'vectorized ms', 'speedup')
+    for count in _CANDIDATE_COUNTS:
+        candidates = create_candidates(count)
+        geomodel_ms = measure(rank_geomodel, candidates)
+        vectorized_ms = measure(rank_vectorized, candidates)
+        print '%10d %14.1f %16.1f %9.1fx' % (count, geomodel_ms,
+                                             vectorized_ms,
+                                             geomodel_ms / vectorized_ms)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,9 @@ from google.appengine.ext import ndb
 import json
 import unittest
 
-from xplore.database.models import MissionProgress, MissionWaypoint
+from xplore.database.models import MissionProgress, MissionWaypoint, TourJob
+from xplore.handler.tasks.tours import TourJobWorker
+from xplore.webutils import tourclient
 from harness import TestHarnessWithWeb
 from handlers_t.waypoints_t import create_blob
 from models_t.auth_t import create_mock_token
@@ -82,5 +84,126 @@ class TestMissionResource(unittest.TestCase):
         self.assertEqual(len(mission_progress_model.events), count + 1)
         self.assertEqual(mission_progress_model.events[-1].description, 'Mission finished')
 
+    def test_new_mission_job(self):
+        params = {'new_mission': 'true',
+                  'latitude': 47.3779,
+                  'longitude': 8.5403,
+                  'end_latitude': 47.3700,
+                  'end_longitude': 8.5441}
+        resp = self.testharness.testapp.get('/api/missions', params)
+        self.assertEqual(resp.status_int, 202)
+        self.assertEqual(resp.json['status'], 'pending')
+        tasks = self.testharness.taskqueue_stub.get_filtered_tasks(
+            queue_names=['tours'])
+        self.assertEqual(len(tasks), 1)
+        resp2 = self.testharness.testapp.get(resp.json['content_url'])
+        self.assertEqual(resp2.status_int, 200)
+        self.assertEqual(resp2.json['job_id'], resp.json['job_id'])
+        self.assertEqual(resp2.json['status'], 'pending')
+        self.assertEqual(resp2.headers['Retry-After'], '2')
+        self.assertNotIn('missions', resp2.json)
+        self.testharness.testapp.get('/api/missions/jobs/12345', status=404)
+
+    def test_job_unexpected_error(self):
+        """Check that unexpected errors are retried and fail the job in the
+        last attempt.
+        """
+        class BrokenClient(object):
+            def get_tours(self, start, end, alternatives):
+                raise TypeError('Broken client')
+
+        job = TourJob(start_location=ndb.GeoPt(47.3779, 8.5403),
+                      end_location=ndb.GeoPt(47.3700, 8.5441))
+        job.put()
+        default_client = tourclient.default_client
+        tourclient.default_client = BrokenClient
+        try:
+            self.testharness.testapp.post('/tasks/tours/generate',
+                                          {'job_id': job.key.id()},
+                                          status=503)
+            self.assertEqual(job.key.get().status, TourJob.PENDING)
+            self.testharness.testapp.post(
+                '/tasks/tours/generate', {'job_id': job.key.id()},
+                headers={'X-AppEngine-TaskRetryCount': '2'})
+        finally:
+            tourclient.default_client = default_client
+        job = job.key.get()
+        self.assertEqual(job.status, TourJob.FAILED)
+        self.assertIn('Broken client', job.error)
+
+    def test_job_remembers_tours(self):
+        """Check that the tours stored as missions are remembered by the
+        client as fallback.
+        """
+        for waypoint_id in ('1', '2'):
+            MissionWaypoint.create_with_default_ancestor(
+                name='Waypoint %s' % waypoint_id,
+                location=ndb.GeoPt(47.37, 8.54)).put()
+
+        class StubClient(object):
+            remembered = []
+
+            def get_tours(self, start, end, alternatives):
+                return [['1', '2']]
+
+            def remember(self, start, end, tours, alternatives=None):
+                self.remembered.append((start, end, tours, alternatives))
+
+        job = TourJob(start_location=ndb.GeoPt(47.3779, 8.5403),
+                      end_location=ndb.GeoPt(47.3700, 8.5441),
+                      alternatives=2)
+        job.put()
+        default_client = tourclient.default_client
+        tourclient.default_client = StubClient
+        try:
+            self.testharness.testapp.post('/tasks/tours/generate',
+                                          {'job_id': job.key.id()})
+        finally:
+            tourclient.default_client = default_client
+        self.assertEqual(job.key.get().status, TourJob.DONE)
+        self.assertEqual(StubClient.remembered,
+                         [((8.5403, 47.3779), (8.5441, 47.37), [['1', '2']],
+                           2)])
+
+    def test_alternative_missions_job(self):
+        params = {'new_mission': 'true',
+                  'latitude': 47.3779,
+                  'longitude': 8.5403,
+                  'end_latitude': 47.3700,
+                  'end_longitude': 8.5441,
+                  'alternatives': 2}
+        resp = self.testharness.testapp.get('/api/missions', params)
+        self.assertEqual(resp.status_int, 202)
+        job = TourJob.get_by_id(resp.json['job_id'])
+        self.assertEqual(job.alternatives, 2)
+        waypoints = [w.key for w in create_mock_waypoints()]
+        TourJobWorker.materialize(job, [waypoints[:3], waypoints[1:]])
+        resp2 = self.testharness.testapp.get(resp.json['content_url'])
+        self.assertEqual(resp2.json['status'], 'done')
+        self.assertEqual([len(m['waypoints']) for m in resp2.json['missions']],
+                         [3, 4])
+
+    def test_batch(self):
+        """Check that a batch validates names and waypoint references and only
+        stores the valid missions.
+        """
+        names = [w.name for w in create_mock_waypoints()]
+        missions = [{'name': 'TestMission', 'waypoints': names[:3]},
+                    {'name': 'TestMission2', 'waypoints': names[2:]},
+                    {'name': 'TestMission', 'waypoints': names},
+                    {'name': 'TestMission3', 'waypoints': ['bogus']},
+                    {'name': 'TestMission4', 'waypoints': []}]
+        resp = self.testharness.testapp.post(
+            '/api/missions:batch', json.dumps({'missions': missions}),
+            content_type='application/json')
+        results = resp.json['results']
+        self.assertEqual([result['status'] for result in results],
+                         [201, 201, 400, 400, 400])
+        self.assertIn('bogus', results[3]['detail'])
+        resp2 = self.testharness.testapp.get(results[1]['content_url'])
+        mission = resp2.json['missions'][0]
+        self.assertEqual([w['name'] for w in mission['waypoints']], names[2:])
+        self.assertTrue(mission['distance'] > 0)
+
 if __name__ == "__main__":
     unittest.main()
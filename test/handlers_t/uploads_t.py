@@ -0,0 +1,92 @@
+from google.appengine.ext import blobstore
+import unittest
+
+from harness import TestHarnessWithWeb
+from xplore.database.models import UploadChunk, UploadSession, UploadedFile
+from xplore.utils import gcs
+
+
+class TestResumableUploadResource(unittest.TestCase):
+
+    def setUp(self):
+        self.testharness = TestHarnessWithWeb()
+        self.testharness.setup()
+
+    def tearDown(self):
+        self.testharness.destroy()
+
+    def test_chunked_upload(self):
+        """Check that an upload resumes from the received offset and that
+        the assembled blob holds all the chunks in order.
+        """
+        contents = 'abcdefghij' * 3
+        session = UploadSession.start(len(contents), 'image/jpeg')
+        url = '/api/uploads/%s' % session.key.id()
+        resp = self.testharness.testapp.put(url + '?offset=0', contents[:10])
+        self.assertEqual(resp.json['received'], 10)
+        # A resent chunk is ignored and a gap is rejected
+        self.testharness.testapp.put(url + '?offset=0', contents[:10])
+        self.testharness.testapp.put(url + '?offset=20', contents[20:],
+                                     status=409)
+        self.testharness.testapp.post(url + '/finish', status=409)
+        resp2 = self.testharness.testapp.get(url)
+        self.assertEqual(resp2.json['received'], 10)
+        self.testharness.testapp.put(url + '?offset=10', contents[10:20])
+        self.testharness.testapp.put(url + '?offset=20', contents[20:])
+        resp3 = self.testharness.testapp.post(url + '/finish')
+        blob_key = resp3.json['image_key']
+        self.assertTrue(resp3.json['image_url'])
+        self.assertEqual(blobstore.BlobReader(blob_key).read(), contents)
+        self.assertEqual(self.testharness.testapp.get(url).json['status'],
+                         UploadSession.DONE)
+        # Finishing again, e.g. after a lost response, gives the same image
+        resp4 = self.testharness.testapp.post(url + '/finish')
+        self.assertEqual(resp4.json['image_key'], blob_key)
+
+    def test_uploaded_file(self):
+        """Check that the assembled files are recorded, so they are known to
+        exist without reading them.
+        """
+        session = UploadSession.start(10, 'image/jpeg')
+        session.append(0, 'abcdefghij')
+        blob_key = session.assemble()
+        missing = blobstore.BlobKey('missing')
+        self.assertEqual(UploadedFile.recorded([blob_key, missing]),
+                         set([blob_key]))
+        fetch_data = blobstore.fetch_data
+        fetched = []
+
+        def counting_fetch(blob, start_index, end_index):
+            fetched.append(blob)
+            return fetch_data(blob, start_index, end_index)
+        blobstore.fetch_data = counting_fetch
+        try:
+            self.assertEqual(gcs.blobs_exist([blob_key, missing],
+                                             UploadedFile.recorded),
+                             [True, False])
+        finally:
+            blobstore.fetch_data = fetch_data
+        self.assertEqual(fetched, [missing])
+
+    def test_cleanup(self):
+        """Check that the expired sessions are deleted with their chunks
+        and that their assembled images are kept.
+        """
+        expired = UploadSession.start(10, 'image/jpeg')
+        expired.append(0, 'abcdefghij')
+        blob_key = expired.assemble()
+        expired = expired.key.get()
+        expired.created_on -= UploadSession.EXPIRATION
+        expired.put()
+        current = UploadSession.start(10, 'image/jpeg')
+        current.append(0, 'abcde')
+        resp = self.testharness.testapp.get('/tasks/uploads/cleanup')
+        self.assertEqual(resp.status_int, 200)
+        self.assertIsNone(expired.key.get())
+        self.assertIsNotNone(current.key.get())
+        self.assertEqual(UploadChunk.query().count(), 1)
+        self.assertEqual(blobstore.BlobReader(blob_key).read(), 'abcdefghij')
+        self.assertEqual(UploadedFile.recorded([blob_key]), set([blob_key]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,10 @@
 from google.appengine.api import files
+from google.appengine.ext import ndb
+import json
 import unittest
 
 from harness import TestHarnessWithWeb
+from xplore.database.models import MissionWaypoint
 
 
 def create_blob(contents, mime_type):
@@ -87,6 +90,141 @@ class TestWaypointResource(unittest.TestCase):
         self.assertEqual(waypoint['longitude'], params['longitude'])
         self.assertEqual(waypoint['image_url'], params['image_url'])
 
+    def test_image_swap(self):
+        """Check that swapping the image of a waypoint invalidates its cached
+        serving URL.
+        """
+        params = {'name': 'TestWaypoint',
+                  'latitude': 24.38,
+                  'longitude': -133.23213,
+                  'image_key': create_blob('Really cool image',
+                                           'application/octet-stream')}
+        resp = self.testharness.testapp.post('/api/waypoints', params)
+        self.assertEqual(resp.status_int, 201)
+        resp2 = self.testharness.testapp.get(resp.json['content_url'])
+        old_url = resp2.json['waypoints'][0]['image_url']
+        new_key = create_blob('Even cooler image', 'application/octet-stream')
+        resp3 = self.testharness.testapp.put(resp.json['content_url'],
+                                             {'image_key': new_key})
+        self.assertEqual(resp3.status_int, 200)
+        resp4 = self.testharness.testapp.get(resp.json['content_url'])
+        waypoint = resp4.json['waypoints'][0]
+        self.assertEqual(waypoint['image_key'], str(new_key))
+        self.assertNotEqual(waypoint['image_url'], old_url)
+        stored = MissionWaypoint.get_by_property('name', params['name'])[0]
+        # Without image_size the image is served in its original size
+        self.assertEqual('%s=s0' % stored.image_serving_url,
+                         waypoint['image_url'])
+
+    def test_pagination(self):
+        """Page through the waypoints both in unbounded and proximity queries
+        and check that every waypoint is returned exactly once.
+        """
+        for i in xrange(5):
+            self.testharness.testapp.post('/api/waypoints',
+                                          {'name': 'TestWaypoint%d' % i,
+                                           'latitude': 47.37 + i * 1e-3,
+                                           'longitude': 8.54,
+                                           'image_url': 'http://example.com'})
+        for extra_params in [{}, {'latitude': 47.37, 'longitude': 8.54}]:
+            names = []
+            pages = 0
+            params = {'max_results': 2}
+            params.update(extra_params)
+            while True:
+                resp = self.testharness.testapp.get('/api/waypoints', params)
+                self.assertEqual(resp.status_int, 200)
+                self.assertTrue(len(resp.json['waypoints']) <= 2)
+                names.extend(w['name'] for w in resp.json['waypoints'])
+                pages += 1
+                if resp.json['next_cursor'] is None:
+                    break
+                params['cursor'] = resp.json['next_cursor']
+            self.assertEqual(sorted(names),
+                             ['TestWaypoint%d' % i for i in xrange(5)])
+            self.assertEqual(pages, 3)
+        self.testharness.testapp.get('/api/waypoints', {'cursor': 'bogus'},
+                                     status=400)
+
+    def test_cached_listing(self):
+        """Check that the ETag of a listing yields a 304 until a waypoint is
+        written.
+        """
+        waypoint = {'name': 'TestWaypoint',
+                    'latitude': 47.37,
+                    'longitude': 8.54,
+                    'image_url': 'http://example.com'}
+        self.testharness.testapp.post('/api/waypoints', waypoint)
+        resp = self.testharness.testapp.get('/api/waypoints')
+        etag = resp.headers['ETag']
+        self.assertEqual(len(resp.json['waypoints']), 1)
+        resp2 = self.testharness.testapp.get('/api/waypoints',
+                                             headers={'If-None-Match': etag},
+                                             status=304)
+        self.assertEqual(resp2.headers['ETag'], etag)
+        waypoint['name'] = 'TestWaypoint2'
+        self.testharness.testapp.post('/api/waypoints', waypoint)
+        resp3 = self.testharness.testapp.get('/api/waypoints',
+                                             headers={'If-None-Match': etag})
+        self.assertEqual(resp3.status_int, 200)
+        self.assertNotEqual(resp3.headers['ETag'], etag)
+        self.assertEqual(len(resp3.json['waypoints']), 2)
+
+    def test_cached_listing_transaction(self):
+        """Check that a write committed in a transaction invalidates the
+        cached listing.
+        """
+        self.testharness.testapp.post('/api/waypoints',
+                                      {'name': 'TestWaypoint',
+                                       'latitude': 47.37,
+                                       'longitude': 8.54,
+                                       'image_url': 'http://example.com'})
+        resp = self.testharness.testapp.get('/api/waypoints')
+        etag = resp.headers['ETag']
+        waypoint = MissionWaypoint.get_by_property('name', 'TestWaypoint')[0]
+
+        @ndb.transactional
+        def move():
+            waypoint.location = ndb.GeoPt(47.38, 8.55)
+            waypoint.put()
+        move()
+        resp2 = self.testharness.testapp.get('/api/waypoints',
+                                             headers={'If-None-Match': etag})
+        self.assertEqual(resp2.status_int, 200)
+        self.assertEqual(resp2.json['waypoints'][0]['latitude'], 47.38)
+
+    def test_batch(self):
+        """Check that a batch reports the status of every waypoint and only
+        stores the valid ones.
+        """
+        self.testharness.testapp.post('/api/waypoints',
+                                      {'name': 'Existing',
+                                       'latitude': 47.37,
+                                       'longitude': 8.54,
+                                       'image_url': 'http://example.com'})
+        waypoints = [{'name': 'TestWaypoint%d' % i,
+                      'latitude': 47.37,
+                      'longitude': 8.54,
+                      'image_url': 'http://example.com'} for i in xrange(3)]
+        waypoints[1]['image_key'] = create_blob('Really cool image',
+                                                'application/octet-stream')
+        del waypoints[1]['image_url']
+        waypoints.append(dict(waypoints[0]))
+        waypoints.append(dict(waypoints[0], name='Existing'))
+        waypoints.append({'name': 'NoLocation'})
+        resp = self.testharness.testapp.post(
+            '/api/waypoints:batch', json.dumps({'waypoints': waypoints}),
+            content_type='application/json')
+        self.assertEqual([result['status'] for result in resp.json['results']],
+                         [201, 201, 201, 400, 400, 400])
+        self.assertEqual([result['name'] for result in resp.json['results']],
+                         [waypoint['name'] for waypoint in waypoints])
+        resp2 = self.testharness.testapp.get('/api/waypoints')
+        self.assertEqual(len(resp2.json['waypoints']), 4)
+        self.testharness.testapp.post(
+            '/api/waypoints:batch', json.dumps({'waypoints': []}),
+            content_type='application/json', status=400)
+
 
 if __name__ == "__main__":
     unittest.main()
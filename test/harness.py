@@ -3,6 +3,7 @@ from google.appengine.ext import testbed
 import webtest
 
 from entry_point import app
+from root import APPLICATION_ROOT
 
 
 class TestHarness(object):
@@ -13,9 +14,13 @@ class TestHarness(object):
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
         self.testbed.init_urlfetch_stub()
+        self.testbed.init_app_identity_stub()
         self.testbed.init_blobstore_stub()
         self.testbed.init_files_stub()
         self.testbed.init_images_stub()
+        self.testbed.init_taskqueue_stub(root_path=APPLICATION_ROOT)
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
 
     def destroy(self):
         self.testbed.deactivate()
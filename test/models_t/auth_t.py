@@ -74,5 +74,40 @@ class AccessTokenTest(unittest.TestCase):
                           AccessToken.validate_token,
                           token_3.token_string)
 
+    def test_validate_cached(self):
+        """Check that validated tokens are served from the cache and that
+        invalidating them takes effect immediately.
+        """
+        test_user = user_t.test_user()
+        token = AccessToken.create(test_user)
+        stats = AccessToken.cache_stats()
+        self.assertEqual(AccessToken.validate_token(token.token_string),
+                         test_user.key)
+        self.assertEqual(AccessToken.validate_token(token.token_string),
+                         test_user.key)
+        new_stats = AccessToken.cache_stats()
+        self.assertEqual(new_stats['misses'] - stats['misses'], 1)
+        self.assertEqual(new_stats['hits'] - stats['hits'], 1)
+        AccessToken.invalidate_tokens(test_user)
+        self.assertRaises(InvalidTokenError,
+                          AccessToken.validate_token,
+                          token.token_string)
+
+    def test_invalidate_during_validate(self):
+        """Check that a validation that read the token before it was
+        revoked can not cache it as valid.
+        """
+        test_user = user_t.test_user()
+        token = AccessToken.create(test_user)
+        # A validation in flight reads the token while it is still valid
+        entry = AccessToken._load_token(token.token_string)
+        self.assertTrue(entry[2])
+        AccessToken.invalidate_tokens(test_user)
+        # And caches it only after the revocation
+        AccessToken._cache_token(token.token_string, entry)
+        self.assertRaises(InvalidTokenError,
+                          AccessToken.validate_token,
+                          token.token_string)
+
 if __name__ == "__main__":
     unittest.main()
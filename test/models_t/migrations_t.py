@@ -0,0 +1,71 @@
+from google.appengine.ext import ndb
+import unittest
+
+from harness import TestHarness
+from models_t.missionprogress_t import create_blob, create_mock_mission
+from models_t.user_t import test_user
+from xplore.database.migrations import migrate_to_name_keys
+from xplore.database.models import Mission, MissionProgress, \
+    MissionWaypoint, TourJob, UserSubmission
+
+
+class NameKeyMigrationTest(unittest.TestCase):
+    """Test suite for the migration of missions and waypoints to name keys"""
+
+    def setUp(self):
+        self.testharness = TestHarness()
+        self.testharness.setup()
+
+    def tearDown(self):
+        self.testharness.destroy()
+
+    def test_migrate(self):
+        """Migrate in batches smaller than the dataset and check that all the
+        entities and the references between them are rewritten.
+        """
+        mission = create_mock_mission()
+        old_waypoint_keys = mission.waypoints
+        user = test_user()
+        progress = MissionProgress(user=user.key, mission=mission.key)
+        progress.start_mission()
+        progress.complete_waypoint(old_waypoint_keys[0])
+        submission = UserSubmission(
+            owner=user.key, mission=mission.key,
+            waypoint=old_waypoint_keys[1],
+            image=create_blob('submission', 'application/octet-stream'))
+        job = TourJob(start_location=ndb.GeoPt(0, 0),
+                      end_location=ndb.GeoPt(1, 1))
+        job.finish([mission.key])
+        submission.put()
+        for model_class in (MissionWaypoint, Mission):
+            cursor = migrate_to_name_keys(model_class, batch_size=2)
+            while cursor is not None:
+                cursor = migrate_to_name_keys(model_class, cursor,
+                                              batch_size=2)
+
+        waypoints = MissionWaypoint.get_all()
+        self.assertEqual(len(waypoints), len(old_waypoint_keys))
+        self.assertTrue(all(w.key.id() == w.name for w in waypoints))
+        missions = Mission.get_all()
+        self.assertEqual(len(missions), 1)
+        self.assertEqual(missions[0].key.id(), mission.name)
+        self.assertEqual([key.id() for key in missions[0].waypoints],
+                         ['waypoint%d' % i for i in xrange(5)])
+        self.assertEqual(missions[0].start_waypoint.id(), 'waypoint0')
+
+        # References from other kinds point to the new keys
+        progress = progress.key.get()
+        self.assertEqual(progress.mission, missions[0].key)
+        self.assertEqual(progress.current_waypoint.id(), 'waypoint0')
+        self.assertEqual([key.id() for key in progress.completed_waypoints],
+                         ['waypoint0'])
+        self.assertEqual(progress.events[-1].waypoint.id(), 'waypoint0')
+        submission = submission.key.get()
+        self.assertEqual(submission.mission, missions[0].key)
+        self.assertEqual(submission.waypoint.id(), 'waypoint1')
+        job = job.key.get()
+        self.assertEqual(job.mission, missions[0].key)
+        self.assertEqual(job.missions, [missions[0].key])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+from google.appengine.ext import ndb
+import unittest
+
+from geotypes import Point
+from harness import TestHarness
+from models_t.missionwaypoint_t import create_waypoint
+from xplore.database.models import Mission
+from xplore.database.utils import update_missions_for_waypoint
+from xplore.utils import geo
+
+
+def create_mission(name, waypoints):
+    mission = Mission.create_with_default_ancestor(
+        name=name,
+        waypoints=[waypoint.key for waypoint in waypoints])
+    mission.put()
+    return mission
+
+
+class MissionTest(unittest.TestCase):
+    """Test suite for the queries on the start of missions."""
+
+    def setUp(self):
+        self.testharness = TestHarness()
+        self.testharness.setup()
+        self.hb = create_waypoint('hb', 47.3779, 8.5403)
+        self.polyterrasse = create_waypoint('polyterrasse', 47.3763, 8.5477)
+        self.uetliberg = create_waypoint('uetliberg', 47.3496, 8.4916)
+        create_mission('downtown', [self.hb, self.polyterrasse])
+        create_mission('hike', [self.uetliberg, self.hb])
+
+    def tearDown(self):
+        self.testharness.destroy()
+
+    def test_start_denormalized(self):
+        """Check that the start fields follow the first waypoint."""
+        mission = Mission.get_by_property('name', 'hike')[0]
+        self.assertEqual(mission.start_waypoint, self.uetliberg.key)
+        self.assertEqual(mission.start_location, self.uetliberg.location)
+        mission.remove_waypoint(self.uetliberg.key)
+        mission = mission.key.get()
+        self.assertEqual(mission.start_waypoint, self.hb.key)
+        self.assertEqual(mission.start_location, self.hb.location)
+
+    def test_query_between(self):
+        """Check that missions are found by their start and end."""
+        missions = Mission.query_between(self.hb.location,
+                                         self.polyterrasse.location, 100)
+        self.assertEqual([mission.name for mission in missions],
+                         ['downtown'])
+        self.assertEqual(Mission.query_between(self.polyterrasse.location,
+                                               self.hb.location, 100), [])
+        self.assertEqual(Mission.query_between(self.uetliberg.location,
+                                               self.polyterrasse.location,
+                                               100), [])
+
+    def test_route_geometry(self):
+        """Check the distance, duration and bounding box computed on put."""
+        mission = Mission.get_by_property('name', 'hike')[0]
+        expected = geo.distance(self.uetliberg.location.lat,
+                                self.uetliberg.location.lon,
+                                self.hb.location.lat, self.hb.location.lon)
+        self.assertAlmostEqual(mission.distance, expected, places=3)
+        self.assertAlmostEqual(mission.expected_duration,
+                               expected / Mission._WALKING_SPEED, places=3)
+        self.assertEqual(mission.bounding_box,
+                         [self.hb.location.lat, self.hb.location.lon,
+                          self.uetliberg.location.lat,
+                          self.uetliberg.location.lon])
+        mission.remove_waypoint(self.uetliberg.key)
+        mission = mission.key.get()
+        self.assertEqual(mission.distance, 0.0)
+
+    def test_route_cached(self):
+        """Check that putting a loaded mission only fetches its waypoints
+        when they changed.
+        """
+        mission = Mission.get_by_property('name', 'hike')[0]
+        original = Mission.__dict__['fetch_waypoints']
+        fetch_waypoints = Mission.fetch_waypoints
+        fetched = []
+
+        def counting_fetch(missions):
+            fetched.append(len(missions))
+            return fetch_waypoints(missions)
+        Mission.fetch_waypoints = staticmethod(counting_fetch)
+        try:
+            mission.description = 'Up the hill'
+            mission.put()
+            self.assertEqual(fetched, [])
+            mission.waypoints.append(self.polyterrasse.key)
+            mission.put()
+            self.assertEqual(fetched, [1])
+        finally:
+            Mission.fetch_waypoints = original
+        self.assertEqual(mission.key.get().bounding_box[1],
+                         self.polyterrasse.location.lon)
+
+    def test_query_starting_near(self):
+        """Check that only the first waypoint of a mission is matched and
+        that results are sorted by distance.
+        """
+        center = Point(47.3780, 8.5400)
+        results = Mission.query_starting_near(center, max_distance=1500)
+        self.assertEqual([m.name for m in results], ['downtown'])
+        results = Mission.query_starting_near(center, max_distance=10000)
+        self.assertEqual([m.name for m in results], ['downtown', 'hike'])
+        results = Mission.query_starting_near(center, max_results=1,
+                                              max_distance=10000)
+        self.assertEqual([m.name for m in results], ['downtown'])
+
+    def test_query_starting_in_box(self):
+        """Check bounding box queries and that moving the starting waypoint
+        updates the missions starting there.
+        """
+        results = Mission.query_starting_in_box(47.38, 8.55, 47.36, 8.53)
+        self.assertEqual([m.name for m in results], ['downtown'])
+        self.uetliberg.location = ndb.GeoPt(47.3700, 8.5441)
+        self.uetliberg.put()
+        update_missions_for_waypoint(self.uetliberg.key)
+        results = Mission.query_starting_in_box(47.38, 8.55, 47.36, 8.53)
+        self.assertEqual(set(m.name for m in results),
+                         set(['downtown', 'hike']))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
-from google.appengine.api import files
+from datetime import datetime, timedelta
+from google.appengine.api import datastore, files
 from google.appengine.ext import ndb
 import unittest
 
+from xplore.database.migrations import backfill_progress_events
 from xplore.database.models import Mission, MissionProgress, MissionWaypoint
 from harness import TestHarness
 from models_t.user_t import test_user
@@ -46,7 +48,7 @@ class MissionProgressTest(unittest.TestCase):
         self.testharness.destroy()
 
     def test_flow(self):
-        mission = test_mission()
+        mission = create_mock_mission()
         user = test_user()
         progress = MissionProgress(user=user.key,
                                    mission=mission.key)
@@ -54,7 +56,84 @@ class MissionProgressTest(unittest.TestCase):
         for waypoint in mission.waypoints:
             progress.complete_waypoint(waypoint)
         progress.finish_mission()
-        print MissionProgress.get_all()
+
+        stored = progress.key.get()
+        self.assertEqual(stored.event_count, len(mission.waypoints) + 2)
+        self.assertEqual(stored.completed_waypoints, mission.waypoints)
+        self.assertEqual(stored.current_waypoint, mission.waypoints[-1])
+        self.assertIsNotNone(stored.started_on)
+        self.assertIsNotNone(stored.finished_on)
+        events = stored.events
+        self.assertEqual([event.sequence for event in events],
+                         range(1, stored.event_count + 1))
+        self.assertEqual([event.waypoint for event in events[1:-1]],
+                         mission.waypoints)
+
+    def test_concurrent_events(self):
+        """Check that events recorded from stale copies of the progress get
+        consecutive sequence numbers and all reach the summary.
+        """
+        mission = create_mock_mission()
+        user = test_user()
+        progress = MissionProgress(user=user.key, mission=mission.key)
+        progress.start_mission()
+        first = progress.key.get()
+        second = progress.key.get()
+        first.complete_waypoint(mission.waypoints[0])
+        second.complete_waypoint(mission.waypoints[1])
+
+        stored = progress.key.get()
+        self.assertEqual(stored.event_count, 3)
+        self.assertEqual(stored.completed_waypoints, mission.waypoints[:2])
+        self.assertEqual(second.event_count, 3)
+        self.assertEqual([event.waypoint for event in stored.events],
+                         [None] + mission.waypoints[:2])
+
+    def create_legacy_progress(self, mission, user):
+        """Store a progress with its events in the legacy structured
+        property, the waypoints are only stored for the events having one.
+        """
+        start = datetime(2014, 1, 17)
+        entity = datastore.Entity('MissionProgress')
+        entity['user'] = user.key.to_old_key()
+        entity['mission'] = mission.key.to_old_key()
+        entity['events.timestamp'] = [start + timedelta(minutes=i)
+                                      for i in xrange(3)]
+        entity['events.description'] = ['Mission started',
+                                         'Waypoint completed',
+                                         'Waypoint completed']
+        entity['events.waypoint'] = [key.to_old_key()
+                                     for key in mission.waypoints[:2]]
+        return ndb.Key.from_old_key(datastore.Put(entity))
+
+    def test_legacy_events(self):
+        """Check that legacy events are part of the history and that they
+        are converted by the next event or by the migration.
+        """
+        mission = create_mock_mission()
+        user = test_user()
+        recorded_key = self.create_legacy_progress(mission, user)
+        migrated_key = self.create_legacy_progress(mission, user)
+
+        progress = recorded_key.get()
+        self.assertEqual([event.waypoint for event in progress.events],
+                         [None] + mission.waypoints[:2])
+        progress.finish_mission()
+        stored = recorded_key.get()
+        self.assertEqual(stored.legacy_events, [])
+        self.assertEqual(stored.event_count, 4)
+        self.assertEqual(stored.completed_waypoints, mission.waypoints[:2])
+        self.assertEqual(stored.started_on, datetime(2014, 1, 17))
+        self.assertIsNotNone(stored.finished_on)
+        self.assertEqual([event.sequence for event in stored.events],
+                         range(1, 5))
+
+        self.assertIsNone(backfill_progress_events())
+        stored = migrated_key.get()
+        self.assertEqual(stored.legacy_events, [])
+        self.assertEqual(stored.event_count, 3)
+        self.assertEqual(stored.current_waypoint, mission.waypoints[1])
+        self.assertEqual(len(stored.events), 3)
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,113 @@
+from google.appengine.ext import ndb
+import unittest
+
+from geotypes import Point
+from harness import TestHarness
+from xplore.database.errors import NonExistentEntitiesError
+from xplore.database.models import MissionWaypoint
+from xplore.database.models.missionwaypoint import _PROXIMITY_CACHE
+
+
+def create_waypoint(name, latitude, longitude):
+    waypoint = MissionWaypoint.create_with_default_ancestor(
+        name=name,
+        location=ndb.GeoPt(latitude, longitude),
+        image_url='http://example.com/%s.jpg' % name)
+    waypoint.put()
+    return waypoint
+
+
+class MissionWaypointTest(unittest.TestCase):
+    """Test suite for the geo queries of the MissionWaypoint model."""
+
+    def setUp(self):
+        self.testharness = TestHarness()
+        self.testharness.setup()
+        create_waypoint('hb', 47.3779, 8.5403)
+        create_waypoint('polyterrasse', 47.3763, 8.5477)
+        create_waypoint('grossmunster', 47.3700, 8.5441)
+        create_waypoint('uetliberg', 47.3496, 8.4916)
+
+    def tearDown(self):
+        self.testharness.destroy()
+
+    def test_query_near(self):
+        """Check that proximity queries are sorted by distance and limited by
+        both max_distance and max_results.
+        """
+        center = Point(47.3780, 8.5400)
+        results = MissionWaypoint.query_near(center, max_distance=1500)
+        self.assertEqual([w.name for w in results],
+                         ['hb', 'polyterrasse', 'grossmunster'])
+        results = MissionWaypoint.query_near(center, max_results=1)
+        self.assertEqual([w.name for w in results], ['hb'])
+
+    def test_query_box(self):
+        """Check bounding box queries and that writes are visible to the
+        index right away.
+        """
+        results = MissionWaypoint.query_box(47.38, 8.55, 47.36, 8.53)
+        self.assertEqual(set(w.name for w in results),
+                         set(['hb', 'polyterrasse', 'grossmunster']))
+        create_waypoint('bellevue', 47.3671, 8.5449)
+        results = MissionWaypoint.query_box(47.38, 8.55, 47.36, 8.53)
+        self.assertEqual(len(results), 4)
+        results[0].key.delete()
+        results = MissionWaypoint.query_box(47.38, 8.55, 47.36, 8.53)
+        self.assertEqual(len(results), 3)
+
+    def test_get_keys_by_name(self):
+        """Check that names are resolved in order and that all the missing
+        names are reported together.
+        """
+        names = ['uetliberg', 'hb', 'uetliberg']
+        keys = MissionWaypoint.get_keys_by_name(names)
+        self.assertEqual([key.get().name for key in keys], names)
+        try:
+            MissionWaypoint.get_keys_by_name(['hb', 'zoo', 'airport'])
+            self.fail('Missing names were not reported.')
+        except NonExistentEntitiesError as ex:
+            self.assertEqual(ex.names, ['airport', 'zoo'])
+
+    def test_query_near_cached(self):
+        """Check that nearby centers share the cached candidates and that
+        writes invalidate them.
+        """
+        counter = _PROXIMITY_CACHE.counter
+        hits = counter.hits
+        results = MissionWaypoint.query_near(Point(47.3780, 8.5400),
+                                             max_distance=900)
+        self.assertEqual([w.name for w in results], ['hb', 'polyterrasse'])
+        results = MissionWaypoint.query_near(Point(47.3781, 8.5401),
+                                             max_distance=850)
+        self.assertEqual([w.name for w in results], ['hb', 'polyterrasse'])
+        self.assertEqual(counter.hits, hits + 1)
+        create_waypoint('central', 47.3772, 8.5440)
+        results = MissionWaypoint.query_near(Point(47.3781, 8.5401),
+                                             max_distance=850)
+        self.assertEqual([w.name for w in results],
+                         ['hb', 'central', 'polyterrasse'])
+
+    def test_generation(self):
+        """Check that transactional writes bump the generation only after
+        the commit and that untracked writes do not bump it.
+        """
+        generation = MissionWaypoint.generation()
+        waypoint = MissionWaypoint.get_by_property('name', 'hb')[0]
+
+        @ndb.transactional
+        def move():
+            waypoint.location = ndb.GeoPt(47.3780, 8.5404)
+            waypoint.put()
+            self.assertEqual(MissionWaypoint.generation(), generation)
+        move()
+        self.assertGreater(MissionWaypoint.generation(), generation)
+
+        generation = MissionWaypoint.generation()
+        waypoint.image_hash = '0123456789abcdef'
+        MissionWaypoint.put_multi_untracked([waypoint])
+        self.assertEqual(MissionWaypoint.generation(), generation)
+        self.assertEqual(waypoint.key.get().image_hash, '0123456789abcdef')
+
+if __name__ == "__main__":
+    unittest.main()
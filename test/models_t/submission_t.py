@@ -0,0 +1,289 @@
+from cStringIO import StringIO
+from google.appengine.ext import blobstore, ndb
+from PIL import Image
+import unittest
+
+from handlers_t.waypoints_t import create_blob
+from harness import TestHarnessWithWeb
+from models_t.missionprogress_t import create_mock_mission
+from models_t.user_t import test_user
+from xplore.database.models import MissionWaypoint, UserSubmission
+from xplore.database import scoring
+from xplore.database.scoring import index_pending_waypoints, \
+    index_waypoint_images, score_pending_submissions, score_submissions, \
+    store_image_hashes
+from xplore.handler.tasks.submissions import create_submission
+
+
+def stand_in_scorer(image_data, reference_data):
+    """Deterministic scorer, the fraction of the reference bytes matched by
+    the submission at the same position.
+    """
+    matches = sum(1 for byte, reference_byte in zip(image_data,
+                                                    reference_data)
+                  if byte == reference_byte)
+    return float(matches) / len(reference_data)
+
+
+def create_image(brightness, width=36, height=32):
+    """Create a blob with a grayscale PNG whose pixel at (x, y) has the
+    brightness given by the function.
+    """
+    image = Image.new('L', (width, height))
+    image.putdata([brightness(x, y) for y in xrange(height)
+                   for x in xrange(width)])
+    data = StringIO()
+    image.save(data, 'PNG')
+    return create_blob(data.getvalue(), 'image/png')
+
+
+class SubmissionScoringTest(unittest.TestCase):
+    """Test suite for the scoring of user submissions."""
+
+    def setUp(self):
+        self.testharness = TestHarnessWithWeb()
+        self.testharness.setup()
+        self.mission = create_mock_mission()
+        self.user = test_user()
+        self.waypoint = MissionWaypoint.create_with_default_ancestor(
+            name='scored',
+            location=ndb.GeoPt(47.37, 8.54),
+            image=create_blob('abcdefghij', 'application/octet-stream'))
+        self.waypoint.put()
+
+    def tearDown(self):
+        self.testharness.destroy()
+
+    def create_submission(self, contents):
+        submission = UserSubmission(
+            owner=self.user.key,
+            mission=self.mission.key,
+            waypoint=self.waypoint.key,
+            image=create_blob(contents, 'application/octet-stream'))
+        submission.put()
+        return submission
+
+    def test_score_submissions(self):
+        """Check that submissions are scored by key, that low scores are
+        deleted with their image and that scored submissions are skipped.
+        """
+        good = self.create_submission('abcdefghij')
+        close = self.create_submission('abcdefghXX')
+        bad = self.create_submission('XXXXXXXXXj')
+        keys = [good.key, close.key, bad.key]
+        self.assertEqual(score_submissions(keys, scorer=stand_in_scorer),
+                         (3, []))
+        self.assertEqual(good.key.get().score, 1.0)
+        self.assertAlmostEqual(close.key.get().score, 0.8)
+        self.assertIsNone(bad.key.get())
+        self.assertIsNone(blobstore.BlobInfo.get(bad.image))
+        # A duplicated task has nothing left to score
+        self.assertEqual(score_submissions(keys, scorer=lambda *args: 0.0),
+                         (0, []))
+        self.assertEqual(good.key.get().score, 1.0)
+
+    def test_score_pending(self):
+        """Check that pending submissions are scored in batches and that the
+        ones that can not be scored are marked unscorable.
+        """
+        good = self.create_submission('abcdefghij')
+        broken = self.create_submission('broken')
+        self.create_submission('abcdefghij')
+
+        def scorer(image_data, reference_data):
+            if image_data == 'broken':
+                raise IOError('Broken image')
+            return stand_in_scorer(image_data, reference_data)
+
+        self.assertEqual(score_pending_submissions(batch_size=2,
+                                                   scorer=scorer)[1], True)
+        self.assertEqual(score_pending_submissions(batch_size=2,
+                                                   scorer=scorer)[1], False)
+        self.assertEqual(good.key.get().score, 1.0)
+        self.assertEqual(broken.key.get().score,
+                         UserSubmission.UNSCORABLE_SCORE)
+        self.assertEqual(UserSubmission.query_pending().count(), 0)
+        self.assertEqual(score_pending_submissions(scorer=scorer), (0, False))
+
+    def test_worker(self):
+        """Check that the task worker scores the given submissions with the
+        configured scorer, retries the failed ones and marks them unscorable
+        in the last attempt.
+        """
+        submission = self.create_submission('abcdefghij')
+        broken = self.create_submission('broken')
+
+        def scorer(image_data, reference_data):
+            if image_data == 'broken':
+                raise IOError('Broken image')
+            return stand_in_scorer(image_data, reference_data)
+
+        params = {'submission_key': [submission.key.urlsafe(),
+                                     broken.key.urlsafe()]}
+        get_scorer = scoring.get_scorer
+        scoring.get_scorer = lambda: scorer
+        try:
+            self.testharness.testapp.post('/tasks/submissions/score', params,
+                                          status=503)
+            self.assertEqual(submission.key.get().score, 1.0)
+            self.assertTrue(broken.key.get().is_pending())
+            resp = self.testharness.testapp.post(
+                '/tasks/submissions/score', params,
+                headers={'X-AppEngine-TaskRetryCount': '2'})
+        finally:
+            scoring.get_scorer = get_scorer
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(broken.key.get().score,
+                         UserSubmission.UNSCORABLE_SCORE)
+        tasks = self.testharness.taskqueue_stub.get_filtered_tasks(
+            queue_names=['scoring'])
+        self.assertEqual(len(tasks), 0)
+
+    def test_cron_sweep(self):
+        """Check that the cron job scores the submissions left pending."""
+        submission = self.create_submission('abcdefghij')
+        get_scorer = scoring.get_scorer
+        scoring.get_scorer = lambda: stand_in_scorer
+        try:
+            resp = self.testharness.testapp.get('/tasks/submissions/score')
+        finally:
+            scoring.get_scorer = get_scorer
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(submission.key.get().score, 1.0)
+
+    def test_create_submission(self):
+        """Check that a new submission is stored with the task scoring it."""
+        submission = UserSubmission(
+            owner=self.user.key,
+            mission=self.mission.key,
+            waypoint=self.waypoint.key,
+            image=create_blob('abcdefghij', 'application/octet-stream'))
+        submission_key = create_submission(
+            submission, lambda name: '/tasks/submissions/score')
+        tasks = self.testharness.taskqueue_stub.get_filtered_tasks(
+            queue_names=['scoring'])
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0].extract_params()['submission_key'],
+                         submission_key.urlsafe())
+
+    def test_image_hashes(self):
+        """Check that waypoint images are hashed once, that duplicates are
+        flagged and that submissions are scored against the hashes.
+        """
+        original = MissionWaypoint.create_with_default_ancestor(
+            name='original',
+            location=ndb.GeoPt(47.38, 8.55),
+            image=create_image(lambda x, y: x * 7))
+        duplicate = MissionWaypoint.create_with_default_ancestor(
+            name='duplicate',
+            location=ndb.GeoPt(47.38, 8.55),
+            image=create_image(lambda x, y: x * 7))
+        ndb.put_multi([original, duplicate])
+        # Two new waypoints plus the six created in setUp
+        self.assertEqual(index_pending_waypoints(), (8, False))
+        self.assertEqual(MissionWaypoint.query_pending_hash().count(), 0)
+        # The images of the waypoints from setUp are not valid images
+        self.assertEqual(self.waypoint.key.get().image_hash, '')
+        original, duplicate = ndb.get_multi([original.key, duplicate.key])
+        self.assertEqual(len(original.image_hash), 16)
+        self.assertEqual(duplicate.image_hash, original.image_hash)
+        flagged = [waypoint for waypoint in [original, duplicate]
+                   if waypoint.duplicate_of is not None]
+        self.assertEqual(len(flagged), 1)
+        self.assertIn(flagged[0].duplicate_of, [original.key, duplicate.key])
+        self.assertNotEqual(flagged[0].duplicate_of, flagged[0].key)
+
+        similar = UserSubmission(owner=self.user.key,
+                                 mission=self.mission.key,
+                                 waypoint=original.key,
+                                 image=create_image(lambda x, y: x * 6 + 10))
+        different = UserSubmission(owner=self.user.key,
+                                   mission=self.mission.key,
+                                   waypoint=original.key,
+                                   image=create_image(lambda x, y: 250 - x * 7))
+        ndb.put_multi([similar, different])
+        self.assertEqual(score_submissions([similar.key, different.key]),
+                         (2, []))
+        self.assertEqual(similar.key.get().score, 1.0)
+        self.assertIsNone(different.key.get())
+
+        # Unrelated images still share about half of the hash bits
+        unrelated = UserSubmission(
+            owner=self.user.key,
+            mission=self.mission.key,
+            waypoint=original.key,
+            image=create_image(lambda x, y: x * 7 if x < 18 else 250 - x * 7))
+        unrelated.put()
+        self.assertEqual(score_submissions([unrelated.key]), (1, []))
+        self.assertIsNone(unrelated.key.get())
+
+    def test_unreadable_images(self):
+        """Check that waypoints whose image can not be read are left pending
+        instead of being flagged as undecodable.
+        """
+        def read_waypoint_image(waypoint):
+            raise IOError('Fetch timed out')
+
+        read = scoring.read_waypoint_image
+        scoring.read_waypoint_image = read_waypoint_image
+        try:
+            self.assertEqual(index_pending_waypoints(), (0, False))
+        finally:
+            scoring.read_waypoint_image = read
+        self.assertIsNone(self.waypoint.key.get().image_hash)
+        self.assertEqual(index_pending_waypoints(), (6, False))
+        self.assertEqual(self.waypoint.key.get().image_hash, '')
+
+    def test_index_worker(self):
+        """Check that the task worker hashes only the given waypoints and
+        that it is retried while their image can not be read.
+        """
+        def read_waypoint_image(waypoint):
+            raise IOError('Fetch timed out')
+
+        params = {'waypoint_key': [self.waypoint.key.urlsafe()]}
+        read = scoring.read_waypoint_image
+        scoring.read_waypoint_image = read_waypoint_image
+        try:
+            self.testharness.testapp.post('/tasks/waypoints/index-images',
+                                          params, status=503)
+        finally:
+            scoring.read_waypoint_image = read
+        self.assertIsNone(self.waypoint.key.get().image_hash)
+        resp = self.testharness.testapp.post('/tasks/waypoints/index-images',
+                                             params)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(self.waypoint.key.get().image_hash, '')
+        self.assertEqual(MissionWaypoint.query_pending_hash().count(), 5)
+
+    def test_concurrent_hashing(self):
+        """Check that storing the image hashes keeps the edits made while
+        they were computed and skips waypoints whose image changed.
+        """
+        edited = MissionWaypoint.create_with_default_ancestor(
+            name='edited',
+            location=ndb.GeoPt(47.38, 8.55),
+            image=create_image(lambda x, y: x * 7))
+        replaced = MissionWaypoint.create_with_default_ancestor(
+            name='replaced',
+            location=ndb.GeoPt(47.38, 8.55),
+            image=create_image(lambda x, y: y * 7))
+        ndb.put_multi([edited, replaced])
+        waypoints = index_waypoint_images(
+            MissionWaypoint.query_pending_hash().fetch())
+
+        latest_edited, latest_replaced = ndb.get_multi([edited.key,
+                                                        replaced.key])
+        latest_edited.description = 'Edited meanwhile'
+        latest_replaced.replace_image(create_image(lambda x, y: x * 3))
+        ndb.put_multi([latest_edited, latest_replaced])
+        self.assertEqual(store_image_hashes(waypoints), len(waypoints) - 1)
+
+        latest_edited, latest_replaced = ndb.get_multi([edited.key,
+                                                        replaced.key])
+        self.assertEqual(latest_edited.description, 'Edited meanwhile')
+        self.assertEqual(len(latest_edited.image_hash), 16)
+        self.assertIsNone(latest_replaced.image_hash)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+from cStringIO import StringIO
+from google.appengine.ext import blobstore, ndb
+from PIL import Image
+import unittest
+
+from harness import TestHarnessWithWeb
+from models_t.submission_t import create_image
+from xplore.database.models import MissionWaypoint
+from xplore.database.thumbnails import add_image_variants, \
+    process_pending_variants
+from xplore.utils import gcs
+
+
+class ImageVariantTest(unittest.TestCase):
+    """Test suite for the pre-generated sizes of waypoint images."""
+
+    def setUp(self):
+        self.testharness = TestHarnessWithWeb()
+        self.testharness.setup()
+        self.waypoint = MissionWaypoint.create_with_default_ancestor(
+            name='large',
+            location=ndb.GeoPt(47.37, 8.54),
+            image=create_image(lambda x, y: (x + y) % 256, 500, 300))
+        self.waypoint.put()
+
+    def tearDown(self):
+        self.testharness.destroy()
+
+    def test_ladder(self):
+        """Check that the ladder stops at the original size and that the
+        closest variant is served.
+        """
+        self.assertEqual(process_pending_variants(), (1, False))
+        self.assertEqual(MissionWaypoint.query_pending_variants().count(), 0)
+        waypoint = self.waypoint.key.get()
+        variants = waypoint.image_variants
+        self.assertEqual([variant.name for variant in variants],
+                         ['thumbnail', 'list', 'full'])
+        self.assertEqual([variant.size for variant in variants],
+                         [100, 400, 500])
+        image = Image.open(StringIO(
+            blobstore.BlobReader(variants[1].image).read()))
+        self.assertEqual(image.size, (400, 240))
+
+        self.assertEqual(waypoint.to_jsonizable(150)['image_url'],
+                         variants[1].serving_url)
+        self.assertEqual(waypoint.to_jsonizable(0)['image_url'],
+                         variants[2].serving_url)
+        self.assertEqual(waypoint.to_jsonizable(1000)['image_url'],
+                         variants[2].serving_url)
+        self.assertEqual(waypoint.to_jsonizable(80)['image_key'],
+                         str(waypoint.image))
+
+        waypoint.replace_image(create_image(lambda x, y: x % 256))
+        waypoint.put()
+        self.assertTrue(waypoint.variants_pending)
+        self.assertFalse(any(gcs.blobs_exist([variant.image
+                                              for variant in variants])))
+
+    def test_concurrent_replacement(self):
+        """Check that storing the variants bumps the generation and skips a
+        waypoint whose image was replaced while they were generated.
+        """
+        generation = MissionWaypoint.generation()
+        self.assertEqual(add_image_variants([self.waypoint]), (1, []))
+        self.assertGreater(MissionWaypoint.generation(), generation)
+
+        waypoint = self.waypoint.key.get()
+        waypoint.replace_image(create_image(lambda x, y: x % 256))
+        waypoint.put()
+        stale = waypoint.key.get()
+        latest = waypoint.key.get()
+        latest.replace_image(create_image(lambda x, y: y % 256))
+        latest.put()
+        self.assertEqual(add_image_variants([stale]), (0, []))
+        waypoint = waypoint.key.get()
+        self.assertEqual(waypoint.image, latest.image)
+        self.assertTrue(waypoint.variants_pending)
+
+    def test_worker(self):
+        """Check that the task worker generates the pending variants, of
+        the given waypoints only when it is given their keys.
+        """
+        other = MissionWaypoint.create_with_default_ancestor(
+            name='other',
+            location=ndb.GeoPt(47.37, 8.54),
+            image=create_image(lambda x, y: y % 256, 200, 100))
+        other.put()
+        resp = self.testharness.testapp.post(
+            '/tasks/waypoints/image-variants',
+            {'waypoint_key': [self.waypoint.key.urlsafe()]})
+        self.assertEqual(resp.status_int, 200)
+        waypoint = self.waypoint.key.get()
+        self.assertFalse(waypoint.variants_pending)
+        self.assertEqual(len(waypoint.image_variants), 3)
+        self.assertTrue(other.key.get().variants_pending)
+        resp = self.testharness.testapp.post('/tasks/waypoints/image-variants')
+        self.assertEqual(resp.status_int, 200)
+        self.assertFalse(other.key.get().variants_pending)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+from google.appengine.api import apiproxy_rpc
+import json
+import unittest
+
+from harness import TestHarness
+from models_t.mission_t import create_mission
+from models_t.missionwaypoint_t import create_waypoint
+from xplore.webutils.tourclient import CircuitBreaker, CircuitOpenError, \
+    TourClient, TourGeneratorError, find_stored_tours
+
+
+class StandInRPC(object):
+    """Stand-in for a urlfetch RPC and its response, it is finished unless
+    it stalls.
+    """
+
+    def __init__(self, status_code, content, stalled=False):
+        self.status_code = status_code
+        self.content = content
+        self.state = apiproxy_rpc.RPC.RUNNING if stalled \
+            else apiproxy_rpc.RPC.FINISHING
+
+    def get_result(self):
+        return self
+
+
+def wait_any(rpcs):
+    finished = [rpc for rpc in rpcs
+                if rpc.state == apiproxy_rpc.RPC.FINISHING]
+    assert finished, 'Every call stalled.'
+    return finished[0]
+
+
+class StandInGenerator(object):
+    """Local stand-in for a tour generator backend, it answers with the
+    given statuses in turn and can stall.
+    """
+
+    def __init__(self, statuses=(200,), tour=('1', '2'), stalled=False):
+        self.statuses = list(statuses)
+        self.tour = list(tour)
+        self.stalled = stalled
+        self.calls = []
+
+    def __call__(self, url, payload, deadline):
+        self.calls.append(url)
+        status = self.statuses.pop(0) if len(self.statuses) > 1 \
+            else self.statuses[0]
+        if status != 200:
+            return StandInRPC(status, 'unavailable', self.stalled)
+        return StandInRPC(200, json.dumps({'waypoints': self.tour}),
+                          self.stalled)
+
+
+def create_client(start_fetch, urls=('http://a/',), **kwargs):
+    return TourClient(list(urls), start_fetch=start_fetch, wait_any=wait_any,
+                      sleep=lambda delay: None, **kwargs)
+
+
+class TourClientTest(unittest.TestCase):
+    """Test suite for the tour generator client."""
+
+    def setUp(self):
+        self.testharness = TestHarness()
+        self.testharness.setup()
+
+    def tearDown(self):
+        self.testharness.destroy()
+
+    def test_retries(self):
+        """Check that failed calls are retried up to max_attempts."""
+        generator = StandInGenerator([503, 503, 200])
+        client = create_client(generator, max_attempts=3)
+        self.assertEqual(client.get_tours((8.54, 47.37), (8.55, 47.38)),
+                         [['1', '2']])
+        self.assertEqual(len(generator.calls), 3)
+        generator = StandInGenerator([503])
+        client = create_client(generator, max_attempts=2)
+        self.assertRaises(TourGeneratorError, client.get_tours,
+                          (8.54, 47.37), (8.55, 47.38))
+        self.assertEqual(len(generator.calls), 2)
+
+    def test_hedged_request(self):
+        """Check that a stalled backend is hedged with the next one."""
+        stalled = StandInGenerator(tour=['stalled'], stalled=True)
+        generator = StandInGenerator()
+
+        def start_fetch(url, payload, deadline):
+            if url.startswith('http://a/'):
+                return stalled(url, payload, deadline)
+            return generator(url, payload, deadline)
+        client = create_client(start_fetch, urls=['http://a/', 'http://b/'],
+                               hedge_delay=0.01)
+        self.assertEqual(client.get_tours((8.54, 47.37), (8.55, 47.38)),
+                         [['1', '2']])
+        self.assertEqual(stalled.calls, ['http://a/'])
+        self.assertEqual(generator.calls, ['http://b/'])
+        # A backend that fails is replaced without waiting for the hedge
+        failing = StandInGenerator([503])
+        generator = StandInGenerator()
+
+        def start_fetch(url, payload, deadline):
+            if url.startswith('http://a/'):
+                return failing(url, payload, deadline)
+            return generator(url, payload, deadline)
+        client = create_client(start_fetch, urls=['http://a/', 'http://b/'],
+                               max_attempts=1, hedge_delay=60)
+        self.assertEqual(client.get_tours((8.54, 47.37), (8.55, 47.38)),
+                         [['1', '2']])
+        self.assertEqual(generator.calls, ['http://b/'])
+
+    def test_circuit_breaker(self):
+        """Check that the breaker fails fast and serves fallback tours."""
+        generator = StandInGenerator([200, 503])
+        client = create_client(generator, max_attempts=1,
+                               breaker=CircuitBreaker(2, 60))
+        start, end = (8.5405, 47.3705), (8.5505, 47.3805)
+        self.assertEqual(client.get_tours(start, end), [['1', '2']])
+        self.assertRaises(TourGeneratorError, client.get_tours, start, end)
+        # Failures are answered with the tours remembered between the same
+        # cells
+        client.remember(start, end, [['1', '2']])
+        self.assertEqual(client.get_tours((8.5408, 47.3708), end),
+                         [['1', '2']])
+        client.get_tours(start, end)
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+        calls = len(generator.calls)
+        self.assertEqual(client.get_tours(start, end), [['1', '2']])
+        self.assertRaises(CircuitOpenError, client.get_tours, end, start)
+        self.assertEqual(len(generator.calls), calls)
+
+    def test_stored_fallback(self):
+        """Check that the tours stored as missions are served while the
+        generator is failing, even if the client never remembered them.
+        """
+        waypoints = [create_waypoint('Waypoint 1', 47.3779, 8.5403),
+                     create_waypoint('Waypoint 2', 47.3763, 8.5477)]
+        create_mission('generated', waypoints)
+        create_mission('edited', waypoints + [create_waypoint(
+            'Bridge', 47.3770, 8.5480)])
+        generator = StandInGenerator([503])
+        client = create_client(generator, max_attempts=1,
+                               breaker=CircuitBreaker(1, 60),
+                               stored_tours=find_stored_tours)
+        start, end = (8.5404, 47.3779), (8.5477, 47.3764)
+        self.assertEqual(client.get_tours(start, end), [['1', '2']])
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(client.get_tours(start, end, alternatives=2),
+                         [['1', '2']])
+        self.assertRaises(CircuitOpenError, client.get_tours, end, start)
+        self.assertEqual(len(generator.calls), 1)
+
+    def test_half_open_error(self):
+        """Check that an unexpected error in the trial request opens the
+        breaker again instead of leaving it half-open.
+        """
+        now = [0]
+        calls = []
+
+        def broken_start(url, payload, deadline):
+            calls.append(url)
+            raise RuntimeError('Broken transport')
+
+        client = create_client(broken_start, max_attempts=1,
+                               breaker=CircuitBreaker(1, 60,
+                                                      lambda: now[0]))
+        start, end = (8.54, 47.37), (8.55, 47.38)
+        self.assertRaises(RuntimeError, client.get_tours, start, end)
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+        now[0] = 60
+        self.assertRaises(RuntimeError, client.get_tours, start, end)
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+        now[0] = 120
+        client.start_fetch = StandInGenerator()
+        self.assertEqual(client.get_tours(start, end), [['1', '2']])
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(len(calls), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import cherrypy
+from cherrypy import _cprequest
+import json
+import os.path
+import sys
+import unittest
+
+import xplore.tour_server
+# The server imports its mock generator as a top level module
+sys.path.append(os.path.dirname(xplore.tour_server.__file__))
+from xplore.tour_server import server
+
+
+class BusyWorkers(object):
+    """Stand-in for the tour workers, it rejects every computation."""
+    max_pending = 4
+
+    def compute(self, start_location, end_location):
+        return None
+
+    def compute_batch(self, requests):
+        return None
+
+
+class FailingWorkers(BusyWorkers):
+    """Stand-in for the tour workers, the first tour of a batch fails."""
+
+    def compute_batch(self, requests):
+        return iter([(requests[0][0], None, 'Timed out'),
+                     (requests[1][0], [['1', '2']], None)])
+
+
+def serve_request(body):
+    """Reset the thread-local CherryPy response and set the parsed JSON
+    body of the request, so a controller can be called directly.
+    """
+    cherrypy.serving.response = _cprequest.Response()
+    cherrypy.serving.request.json = body
+
+
+class TourServerTest(unittest.TestCase):
+    """Test suite for the controllers of the tour generator server."""
+
+    def test_busy(self):
+        """Check that rejected tours are answered with a 503 that keeps its
+        Retry-After header.
+        """
+        serve_request({'start_location': [8.54, 47.37],
+                       'end_location': [8.55, 47.38]})
+        service = server.TourService(BusyWorkers(), server.TourCache())
+        self.assertIn('error', service.POST())
+        self.assertEqual(cherrypy.response.status, 503)
+        self.assertEqual(cherrypy.response.headers['Retry-After'],
+                         str(server._RETRY_AFTER))
+
+    def test_batch_busy(self):
+        """Check that a rejected batch is answered with a 503 that keeps
+        its Retry-After header.
+        """
+        serve_request({'tours': [{'start_location': [8.54, 47.37],
+                                  'end_location': [8.55, 47.38]}]})
+        service = server.BatchTourService(BusyWorkers(), server.TourCache())
+        self.assertIn('error', json.loads(service.POST()))
+        self.assertEqual(cherrypy.response.status, 503)
+        self.assertEqual(cherrypy.response.headers['Retry-After'],
+                         str(server._RETRY_AFTER))
+
+    def test_batch_errors(self):
+        """Check that a tour that fails gets an error line and the other
+        results are still streamed.
+        """
+        serve_request({'tours': [{'start_location': [8.54, 47.37],
+                                  'end_location': [8.55, 47.38]},
+                                 {'start_location': [8.56, 47.37],
+                                  'end_location': [8.57, 47.38]}]})
+        service = server.BatchTourService(FailingWorkers(),
+                                          server.TourCache())
+        lines = [json.loads(line) for line in service.POST()]
+        self.assertEqual(lines, [{'index': 0, 'error': 'Timed out'},
+                                 {'index': 1, 'tours': [['1', '2']]}])
+
+    def test_stats(self):
+        """Check that the compute times of the latest tours are reported."""
+        workers = server.TourWorkers(processes=1)
+        for compute_time in [0.4, 0.1, 0.3, 0.2]:
+            self.assertTrue(workers._reserve(1))
+            workers._finish(compute_time)
+        stats = workers.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['recent_compute_times'], [0.4, 0.1, 0.3, 0.2])
+        self.assertEqual(stats['median_compute_time'], 0.2)
+        self.assertEqual(stats['p95_compute_time'], 0.4)
+        self.assertEqual(stats['max_compute_time'], 0.4)
+
+if __name__ == "__main__":
+    unittest.main()